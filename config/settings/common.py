@@ -426,6 +426,21 @@ SOCIALHOME_TOS_JURISDICTION = env("SOCIALHOME_TOS_JURISDICTION", default=None)
 SOCIALHOME_STREAMS_PRECACHE_SIZE = env.int("SOCIALHOME_STREAMS_PRECACHE_SIZE", default=100)
 SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS = env.int("SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS", default=90)
 SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE = env.int("SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE", default=0)
+# Also store stream precaches in the database, to fill them again if they are lost from Redis
+SOCIALHOME_STREAMS_DURABLE_TIMELINES = env.bool("SOCIALHOME_STREAMS_DURABLE_TIMELINES", default=False)
+# Seconds to groom precaches for per run, the next run continues where the previous stopped
+SOCIALHOME_STREAMS_PRECACHE_GROOM_TIME_LIMIT = env.int("SOCIALHOME_STREAMS_PRECACHE_GROOM_TIME_LIMIT", default=30*60)
+# Split adding new content to user streams into jobs of this many users
+SOCIALHOME_STREAMS_FANOUT_CHUNK_SIZE = env.int("SOCIALHOME_STREAMS_FANOUT_CHUNK_SIZE", default=500)
+# Merge content of profiles with at least this many local followers into followed streams on read. Zero disables.
+SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS = env.int("SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS", default=0)
+# Seconds without a heartbeat after which a websocket is no longer considered to be listening to a stream
+SOCIALHOME_STREAMS_PRESENCE_EXPIRY = env.int("SOCIALHOME_STREAMS_PRESENCE_EXPIRY", default=130)
+# Amount of recent notifications, and seconds to keep them, per stream for reconnecting websockets to catch up on
+SOCIALHOME_STREAMS_EVENT_LOG_SIZE = env.int("SOCIALHOME_STREAMS_EVENT_LOG_SIZE", default=100)
+SOCIALHOME_STREAMS_EVENT_LOG_SECONDS = env.int("SOCIALHOME_STREAMS_EVENT_LOG_SECONDS", default=10*60)
+# Milliseconds to collect stream notifications for, to send them to websockets as one batch. Zero disables.
+SOCIALHOME_STREAMS_NOTIFICATION_WINDOW_MS = env.int("SOCIALHOME_STREAMS_NOTIFICATION_WINDOW_MS", default=0)
 # Should the public stream be shown for anonymous users. This defaults as follows:
 # - if this is likely a single user instance, ie SOCIALHOME_ROOT_PROFILE is set, do not show a public stream
 # - otherwise, show a public stream by default, unless disabled
@@ -504,6 +519,9 @@ SOCIALHOME_EXPORTS_PATH = str(ROOT_DIR("var", "exports"))
 
 # How many seconds since we saw user activity do we consider the user have been recently active?
 SOCIALHOME_USER_ACTIVITY_SECONDS = 130
+# Mark users active from stream websocket heartbeats at most once per this many seconds per process.
+# Should be less than SOCIALHOME_USER_ACTIVITY_SECONDS.
+SOCIALHOME_USER_ACTIVITY_MARK_SECONDS = env.int("SOCIALHOME_USER_ACTIVITY_MARK_SECONDS", default=60)
 
 # How many days from now before a remote profile will be updated
 SOCIALHOME_PROFILE_UPDATE_FREQ = timedelta(days = int(env("SOCIALHOME_PROFILE_UPDATE_FREQ", default="7")))
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.26 on 2026-10-18 09:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("content", "0047_alter_content_sensitive"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="content",
+            index=models.Index(fields=["author", "-created"], name="content_content_author_created"),
+        ),
+    ]
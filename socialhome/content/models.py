@@ -187,6 +187,12 @@ class Content(models.Model):
 
     objects = ContentQuerySet.as_manager()
 
+    class Meta:
+        indexes = [
+            # Newest content of a profile, see ``ContentQuerySet.profile_authored``
+            models.Index(fields=["author", "-created"], name="%(app_label)s_%(class)s_author_created"),
+        ]
+
     def __str__(self):
         return f"{truncatechars(self.text, 30)} ({self.content_type}, {self.visibility}, {self.fid or self.guid})"
 
@@ -299,6 +305,9 @@ class Content(models.Model):
         if self.content_type == ContentType.CONTENT:
             return self
         elif self.content_type == ContentType.REPLY:
+            # Saved replies know their root, without walking the parents
+            if self.root_parent_id:
+                return self.root_parent.root
             return self.parent.root
         elif self.content_type == ContentType.SHARE:
             return self.share_of.root
@@ -1,7 +1,7 @@
 from typing import Dict, Tuple, TYPE_CHECKING, Any
 
 from django.db import models
-from django.db.models import Q, F, OuterRef, Subquery, Case, When, ObjectDoesNotExist
+from django.db.models import Q, F, OuterRef, Subquery, Case, When, Exists, ObjectDoesNotExist
 from django.db.utils import IntegrityError
 
 from socialhome.content.enums import ContentType
@@ -11,6 +11,25 @@ from socialhome.users.models import User
 if TYPE_CHECKING:
     from socialhome.content.models import Content
 
+# Maximum depth of replies loaded for a conversation, also guards against loops in the reply parents
+CONVERSATION_MAX_DEPTH = 1000
+
+# Replies of a content and of its shares, with their depth in the reply tree
+# Params: content id, content id, maximum depth, params of the visible replies query
+CONVERSATION_SQL = """
+WITH RECURSIVE conversation (id, depth) AS (
+    SELECT id, 0 FROM {table} WHERE id = %s OR share_of_id = %s
+    UNION ALL
+    SELECT reply.id, conversation.depth + 1 FROM {table} reply
+    INNER JOIN conversation ON reply.parent_id = conversation.id
+    WHERE conversation.depth < %s
+)
+SELECT {table}.*, conversation.depth FROM {table}
+INNER JOIN conversation ON {table}.id = conversation.id
+WHERE conversation.depth > 0 AND {table}.id IN ({visible})
+ORDER BY {table}.created, {table}.id
+"""
+
 
 class TagQuerySet(models.QuerySet):
     def get_by_cleaned_name(self, name):
@@ -25,27 +44,35 @@ class TagQuerySet(models.QuerySet):
 
 
 class ContentQuerySet(models.QuerySet):
+    def conversation(self, content_id, user, max_depth=CONVERSATION_MAX_DEPTH):
+        """Return the reply tree of a Content, visible to user, with one recursive query.
+
+        Includes the replies to the shares of the content. The replies are ordered by creation time and have a
+        ``depth`` attribute, 1 for direct replies of the content or its shares.
+
+        :param content_id: ID of the Content.
+        :param user: User the replies should be visible to.
+        :param max_depth: Maximum depth of replies to return.
+        :return: RawQuerySet of Content
+        """
+        visible = self.filter(content_type=ContentType.REPLY).visible_for_user(user).values("id")
+        visible_sql, visible_params = visible.query.sql_with_params()
+        sql = CONVERSATION_SQL.format(table=self.model._meta.db_table, visible=visible_sql)
+        return self.raw(sql, [content_id, content_id, max_depth, *visible_params])
+
     def full_conversation(self, parent_id, user):
         """Return replies for a Content visible to user..
 
-        Returns the direct replies and all replies for shares.
+        Returns all the replies and all replies for shares.
         """
-        qs = self.filter(content_type=ContentType.REPLY).visible_for_user(user)
-        ids = qs.filter(root_parent_id=parent_id).values_list("id", flat=True)
-        share_ids = qs.filter(root_parent__share_of_id=parent_id).values_list("id", flat=True)
-        all_ids = list(ids) + list(share_ids)
-        return qs.filter(id__in=all_ids).order_by("created")
+        return self.conversation(parent_id, user)
 
     def children(self, parent_id, user):
         """Return replies for a Content visible to user..
 
         Returns the direct replies and all replies for shares.
         """
-        qs = self.filter(content_type=ContentType.REPLY).visible_for_user(user)
-        ids = qs.filter(parent_id=parent_id).values_list("id", flat=True)
-        share_ids = qs.filter(parent__share_of_id=parent_id).values_list("id", flat=True)
-        all_ids = list(ids) + list(share_ids)
-        return qs.filter(id__in=all_ids).order_by("created")
+        return self.conversation(parent_id, user, max_depth=1)
 
     def fed(self, value: str, **params) -> models.QuerySet:
         """
@@ -81,18 +108,37 @@ class ContentQuerySet(models.QuerySet):
     def followed(self, user, single_id: int = None):
         """Get content from followed users.
 
-        This includes content shared by the followed users.
+        This includes content shared by the followed users. See ``followed_authored`` and ``followed_shared`` for
+        the same content as two queries that can each use an index.
         """
         profile = user.profile
         following_ids = profile.following.values_list("id", flat=True)
         qs = self.top_level()
         if single_id:
             qs = qs.filter(id=single_id)
+        shared = self.model.objects.filter(share_of_id=OuterRef("id"), author_id__in=following_ids)
         qs = qs.filter(
-            Q(shares__author_id__in=following_ids) | Q(author_id__in=following_ids)
+            Exists(shared) | Q(author_id__in=following_ids)
         )
         return qs.visible_for_user(user)
 
+    def followed_authored(self, user, single_id: int = None):
+        """Get content authored by followed users."""
+        following_ids = user.profile.following.values_list("id", flat=True)
+        qs = self.top_level()
+        if single_id:
+            qs = qs.filter(id=single_id)
+        return qs.filter(author_id__in=following_ids).visible_for_user(user)
+
+    def followed_shared(self, user, single_id: int = None):
+        """Get content shared by followed users."""
+        following_ids = user.profile.following.values_list("id", flat=True)
+        shared_ids = self.model.objects.filter(author_id__in=following_ids, share_of__isnull=False)
+        qs = self.top_level()
+        if single_id:
+            qs = qs.filter(id=single_id)
+        return qs.filter(id__in=shared_ids.values("share_of_id")).visible_for_user(user)
+
     def limited(self, user, single_id: int = None):
         qs = self.top_level()
         if single_id:
@@ -121,13 +167,28 @@ class ContentQuerySet(models.QuerySet):
         qs = self.top_level()
         if single_id:
             qs = qs.filter(id=single_id)
-        ids = qs.filter(author=profile).values_list("id", flat=True)
+        condition = Q(author=profile)
         if include_shares:
-            ids = list(ids) + list(Content.objects.filter(shares__author=profile).values_list("id", flat=True))
-        qs = qs.filter(
-            Q(id__in=ids) | Q(share_of_id__in=ids)
-        )
-        return qs.visible_for_user(user)
+            condition |= Exists(self.model.objects.filter(share_of_id=OuterRef("id"), author=profile))
+        return qs.filter(condition).visible_for_user(user)
+
+    def profile_authored(self, profile, user):
+        """Get content authored by a user profile.
+
+        Together with ``profile_shared`` the same content as ``profile``, as two queries that can each use an index.
+        """
+        from socialhome.content.models import Content
+        if not profile.visible_to_user(user):
+            return Content.objects.none()
+        return self.top_level().filter(author=profile).visible_for_user(user)
+
+    def profile_shared(self, profile, user):
+        """Get content shared by a user profile."""
+        from socialhome.content.models import Content
+        if not profile.visible_to_user(user):
+            return Content.objects.none()
+        shared_ids = self.model.objects.filter(author=profile, share_of__isnull=False).values("share_of_id")
+        return self.top_level().filter(id__in=shared_ids).visible_for_user(user)
 
     def profile_by_attr(self, attr, value, user, include_shares=True):
         """Filter for a user profile by attribute.
@@ -182,7 +243,10 @@ class ContentQuerySet(models.QuerySet):
         qs = self.top_level().visible_for_user(user)
         if single_id:
             qs = qs.filter(id=single_id)
-        return qs.filter(tags__in=user.profile.followed_tags.all())
+        # Fetched first, so that the tags are planned for with their own statistics
+        tag_ids = list(user.profile.followed_tags.values_list("id", flat=True))
+        tagged = self.model.tags.through.objects.filter(content_id=OuterRef("id"), tag_id__in=tag_ids)
+        return qs.filter(Exists(tagged))
 
     def top_level(self):
         # type: () -> ContentQuerySet
@@ -190,14 +254,21 @@ class ContentQuerySet(models.QuerySet):
 
     def visible_for_user(self, user):
         # type: (User) -> ContentQuerySet
-        """Filter by visibility to given user."""
+        """Filter by visibility to given user.
+
+        Limited visibility is checked with a subquery instead of a join, so that content with several recipients
+        is returned once without having to remove duplicates from the results.
+        """
         if not user.is_authenticated:
             return self.filter(visibility=Visibility.PUBLIC)
+        recipient = self.model.limited_visibilities.through.objects.filter(
+            content_id=OuterRef("id"), profile_id=user.profile.id,
+        )
         return self.filter(
             Q(author=user.profile) |
             Q(visibility__in=[Visibility.SITE, Visibility.PUBLIC]) |
             (
                 Q(visibility=Visibility.LIMITED) &
-                Q(limited_visibilities=user.profile)
+                Exists(recipient)
             )
-        ).distinct()
+        )
@@ -1,10 +1,12 @@
 import operator
 import re
+from collections import defaultdict
 from functools import reduce
-from typing import Dict, Any, Set, List
+from typing import Dict, Any, Set, List, Iterable, Tuple, Optional
 import traceback
 
-from django.db.models import Q
+from django.db import models
+from django.db.models import Q, Count
 from django.utils.translation import ngettext as _
 from federation.utils.text import validate_handle
 from rest_framework import serializers
@@ -18,6 +20,11 @@ from socialhome.enums import EnumField, Visibility
 from socialhome.users.models import Profile
 from socialhome.users.serializers import LimitedProfileSerializer
 
+# Maximum amount of queries loading the data for serializing a page of content takes, regardless of the amount of
+# content on the page. The content is expected to be fetched with its authors and tags. Repairing old content with
+# outdated reply counts or throughs can take more queries, for the content being repaired.
+PAGE_MAX_QUERIES = 8
+
 
 class RecipientsField(serializers.Field):
     def get_value(self, dictionary: Dict[str, Any]) -> Set[str]:
@@ -36,18 +43,49 @@ class RecipientsField(serializers.Field):
         TODO: fix finger case sensitivity potentially causing both handle and finger to
         return a recipient
         """
+        page_recipients = self.context.get("recipients")
+        if page_recipients is not None:
+            return page_recipients.get(instance.id, set())
         if instance.visibility == Visibility.LIMITED:
-            fingers = instance.limited_visibilities.filter(finger__isnull=False).order_by("id").values_list("finger", flat=True)
-            # Legacy?
-            handles = instance.limited_visibilities.filter(fid__isnull=True).order_by("id").values_list("handle", flat=True)
-            fids = instance.limited_visibilities.filter(handle__isnull=True).order_by("id").values_list("fid", flat=True)
-            both = instance.limited_visibilities.filter(
-                handle__isnull=False, fid__isnull=False,
-            ).order_by("id").values_list("handle", flat=True)
-            return set(list(handles) + list(fids) + list(both) + list(fingers))
+            return self.get_limited_recipients(
+                instance.limited_visibilities.values_list("finger", "handle", "fid"),
+            )
         else:
             return set(instance.mentions.all().values_list("finger", flat=True))
 
+    @staticmethod
+    def get_limited_recipients(profiles: Iterable[Tuple[Optional[str], Optional[str], Optional[str]]]) -> Set[str]:
+        """
+        Get the recipients of limited content from the finger, handle and fid of the limited visibility profiles.
+        """
+        recipients = set()
+        for finger, handle, fid in profiles:
+            if finger is not None:
+                recipients.add(finger)
+            # Legacy?
+            recipients.add(handle if handle is not None or fid is None else fid)
+        return recipients
+
+    @classmethod
+    def get_page_recipients(cls, contents: List[Content]) -> Dict[int, Set[str]]:
+        """
+        Get the recipients of a page of content with two queries.
+        """
+        limited_ids = [content.id for content in contents if content.visibility == Visibility.LIMITED]
+        other_ids = [content.id for content in contents if content.visibility != Visibility.LIMITED]
+        profiles = defaultdict(list)
+        limited_visibilities = Content.limited_visibilities.through.objects.filter(content_id__in=limited_ids)
+        for content_id, *profile in limited_visibilities.values_list(
+            "content_id", "profile__finger", "profile__handle", "profile__fid",
+        ):
+            profiles[content_id].append(profile)
+        recipients = {id: cls.get_limited_recipients(profiles[id]) for id in limited_ids}
+        recipients.update({id: set() for id in other_ids})
+        mentions = Content.mentions.through.objects.filter(content_id__in=other_ids)
+        for content_id, finger in mentions.values_list("content_id", "profile__finger"):
+            recipients[content_id].add(finger)
+        return recipients
+
     def to_internal_value(self, data: Set[str]) -> Set[str]:
         return data
 
@@ -55,6 +93,16 @@ class RecipientsField(serializers.Field):
         return list(value)
 
 
+class ContentListSerializer(serializers.ListSerializer):
+    def to_representation(self, data) -> List[Dict[str, Any]]:
+        """
+        Load the data of the whole page in bulk before serializing the content one by one.
+        """
+        contents = list(data.all() if isinstance(data, models.manager.BaseManager) else data)
+        self.child.load_page(contents)
+        return super().to_representation(contents)
+
+
 class ContentSerializer(serializers.ModelSerializer):
     author = LimitedProfileSerializer(read_only=True)
     content_type = EnumField(ContentType, representation="string", read_only=True)
@@ -70,6 +118,7 @@ class ContentSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Content
+        list_serializer_class = ContentListSerializer
         fields = (
             "author",
             "content_type",
@@ -134,29 +183,62 @@ class ContentSerializer(serializers.ModelSerializer):
             "user_has_shared",
         )
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.cache_through_authors()
-
     def get_author_uuid(self, obj):
         return obj.author.uuid
 
     def get_notify_key(self, obj):
         return "streams_content__%s" % obj.channel_group_name
 
-    def cache_through_authors(self):
+    def load_page(self, contents: List[Content]):
         """
-        If we have 'throughs', cache author information here for all of them.
+        Cache the data needed for serializing a page of content, with at most ``PAGE_MAX_QUERIES`` queries.
         """
+        self.cache_through_authors(contents)
+        self.cache_reply_counts(contents)
         request = self.context.get("request")
-        if not self.context.get("throughs") or not request:
-            self.context["throughs_authors"] = {}
+        if not request or not hasattr(request.user, "profile"):
+            self.context["shared_ids"] = set()
+            self.context["recipients"] = {}
             return
-        throughs_ids = self.context["throughs"]
-        ids = {value for _key, value in throughs_ids.items()}
-        through_to_id = {value: key for key, value in throughs_ids.items()}
-        throughs = Content.objects.visible_for_user(request.user).select_related("author").filter(id__in=list(ids))
-        self.context["throughs_authors"] = {through_to_id.get(c.id, c.id): c.author for c in throughs}
+        profile = request.user.profile
+        self.context["shared_ids"] = set(Content.objects.filter(
+            share_of_id__in=[content.id for content in contents], author=profile,
+        ).values_list("share_of_id", flat=True))
+        # Recipients are only shown to the author
+        self.context["recipients"] = RecipientsField.get_page_recipients(
+            [content for content in contents if content.author_id == profile.id],
+        )
+
+    def cache_through_authors(self, contents: List[Content]):
+        """
+        Cache author information for all the 'throughs' of a page of content.
+
+        The throughs are taken from the context if given, otherwise from the content.
+        """
+        throughs_ids = self.context.get("throughs") or {content.id: content.through for content in contents}
+        through_to_id = {value: key for key, value in throughs_ids.items() if value != key}
+        throughs = Content.objects.select_related("author__user").filter(id__in=list(through_to_id))
+        request = self.context.get("request")
+        if request:
+            throughs = throughs.visible_for_user(request.user)
+        self.context["throughs_authors"] = {through_to_id[c.id]: c.author for c in throughs}
+
+    def cache_reply_counts(self, contents: List[Content]):
+        """
+        Cache the reply counts ``update_counts`` checks for a page of content.
+
+        The direct replies of the content and of its shares are counted separately, so that both queries can use
+        the parent index.
+        """
+        ids = [content.id for content in contents if content.content_type == ContentType.CONTENT]
+        replies = Content.objects.filter(parent_id__in=ids).values_list("parent_id").annotate(count=Count("id"))
+        share_replies = Content.objects.filter(
+            parent_id__in=Content.objects.filter(share_of_id__in=ids).values("id"),
+        ).values_list("parent__share_of_id").annotate(count=Count("id"))
+        reply_counts = dict.fromkeys(ids, 0)
+        for content_id, count in [*replies, *share_replies]:
+            reply_counts[content_id] += count
+        self.context["reply_counts"] = reply_counts
 
     def get_through(self, obj):
         """
@@ -173,7 +255,7 @@ class ContentSerializer(serializers.ModelSerializer):
 
     def get_through_author(self, obj):
         throughs_authors = self.context.get("throughs_authors")
-        if not throughs_authors:
+        if throughs_authors is None:
             try:
                 through_author = Content.objects.get(id=self.get_through(obj)).author
             except Content.DoesNotExist:
@@ -198,6 +280,9 @@ class ContentSerializer(serializers.ModelSerializer):
         request = self.context.get("request")
         if not request:
             return False
+        shared_ids = self.context.get("shared_ids")
+        if shared_ids is not None:
+            return obj.id in shared_ids
         return Content.has_shared(obj.id, request.user.profile.id) if hasattr(request.user, "profile") else False
 
     def validate_parent(self, value):
@@ -213,7 +298,7 @@ class ContentSerializer(serializers.ModelSerializer):
         return value
 
     def to_representation(self, instance: Content) -> Dict[str, Any]:
-        update_counts(instance)
+        update_counts(instance, self.context.get("reply_counts", {}).get(instance.id))
         result = dict(super().to_representation(instance))
         if not self.get_user_is_author(instance):
             result["recipients"] = ""
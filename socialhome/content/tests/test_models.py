@@ -132,6 +132,10 @@ class TestContentModel(SocialhomeTestCase):
         self.assertEqual(share_reply.root, self.public_content)
         share_reply_of_reply = ContentFactory(parent=share_reply)
         self.assertEqual(share_reply_of_reply.root, self.public_content)
+        # Saved replies are not walked up level by level
+        share_reply_of_reply = Content.objects.get(id=share_reply_of_reply.id)
+        with self.assertNumQueries(1):
+            self.assertEqual(share_reply_of_reply.root, self.public_content)
 
     def test_save_calls_fix_local_uploads(self):
         self.public_content.fix_local_uploads = Mock()
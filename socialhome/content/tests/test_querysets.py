@@ -342,7 +342,25 @@ class TestContentQuerySetChildren(SocialhomeTestCase):
         self.assertEqual(contents, {self.limited_reply, self.limited_reply_of_reply})
 
         contents = set(Content.objects.full_conversation(self.public_reply.id, self.anonymous_user))
-        self.assertEqual(contents, set())
+        self.assertEqual(contents, {self.public_reply_of_reply})
+
+    def test_children__direct_replies(self):
+        contents = set(Content.objects.children(self.public_content.id, self.anonymous_user))
+        self.assertEqual(contents, {self.public_reply, self.public_share_reply})
+        contents = set(Content.objects.children(self.public_reply.id, self.anonymous_user))
+        self.assertEqual(contents, {self.public_reply_of_reply})
+        contents = set(Content.objects.children(self.limited_content.id, self.limited_content_user))
+        self.assertEqual(contents, {self.limited_reply})
+
+    def test_conversation(self):
+        with self.assertNumQueries(1):
+            contents = list(Content.objects.conversation(self.public_content.id, self.anonymous_user))
+        self.assertEqual(
+            [(content, content.depth) for content in contents],
+            [(self.public_reply, 1), (self.public_reply_of_reply, 2), (self.public_share_reply, 1)],
+        )
+        contents = list(Content.objects.conversation(self.public_content.id, self.anonymous_user, max_depth=1))
+        self.assertEqual(contents, [self.public_reply, self.public_share_reply])
 
 class TestContentQuerySetShares(SocialhomeTestCase):
     """Ensure certain querysets include content via shares."""
@@ -373,6 +391,14 @@ class TestContentQuerySetShares(SocialhomeTestCase):
         contents = set(Content.objects.followed(self.limited_content_user))
         self.assertEqual(contents, {self.public_content, self.site_content, self.limited_content})
 
+    def test_followed_authored_and_shared(self):
+        self.assertEqual(set(Content.objects.followed_authored(self.limited_content_user)), set())
+        contents = set(Content.objects.followed_shared(self.limited_content_user))
+        self.assertEqual(contents, {self.public_content, self.site_content, self.limited_content})
+        contents = set(Content.objects.followed_authored(self.other_user)) | \
+            set(Content.objects.followed_shared(self.other_user))
+        self.assertEqual(contents, set(Content.objects.followed(self.other_user)))
+
     def test_profile(self):
         contents = set(Content.objects.profile(self.other_user.profile, self.anonymous_user))
         self.assertEqual(contents, {self.public_content})
@@ -383,6 +409,21 @@ class TestContentQuerySetShares(SocialhomeTestCase):
         contents = set(Content.objects.profile(self.other_user.profile, self.limited_content_user))
         self.assertEqual(contents, {self.public_content, self.site_content, self.limited_content})
 
+    def test_profile_authored_and_shared(self):
+        self.assertEqual(set(Content.objects.profile_authored(self.other_user.profile, self.other_user)), set())
+        contents = set(Content.objects.profile_shared(self.other_user.profile, self.other_user))
+        self.assertEqual(contents, {self.public_content, self.site_content})
+        contents = set(Content.objects.profile_authored(self.profile, self.limited_content_user)) | \
+            set(Content.objects.profile_shared(self.profile, self.limited_content_user))
+        self.assertEqual(contents, set(Content.objects.profile(self.profile, self.limited_content_user)))
+
+    def test_profile_authored_and_shared__profile_not_visible(self):
+        profile = ProfileFactory(visibility=Visibility.SELF)
+        PublicContentFactory(author=profile)
+        PublicContentFactory(share_of=self.public_content, author=profile)
+        self.assertEqual(set(Content.objects.profile_authored(profile, self.other_user)), set())
+        self.assertEqual(set(Content.objects.profile_shared(profile, self.other_user)), set())
+
     def test_profile_by_attr(self):
         contents = set(Content.objects.profile_by_attr("uuid", self.other_user.profile.uuid, self.anonymous_user))
         self.assertEqual(contents, {self.public_content})
@@ -486,3 +527,30 @@ class TestContentQuerySetThroughs(SocialhomeTestCase):
         self.assertEqual(contents[0].through, self.share.id)
         self.assertEqual(contents[1].through, self.share2.id)
         self.assertEqual(contents[2].through, self.sharer_content_share.id)
+
+
+class TestContentQuerySetNoDuplicates(SocialhomeTestCase):
+    """Ensure content matching several relations is returned once."""
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory()
+        cls.content = LimitedContentFactory(text="#foo #bar")
+        cls.content.limited_visibilities.add(cls.user.profile, ProfileFactory(), ProfileFactory())
+        cls.sharers = [ProfileFactory(), ProfileFactory()]
+        for sharer in cls.sharers:
+            LimitedContentFactory(share_of=cls.content, author=sharer)
+        cls.user.profile.following.add(cls.content.author, *cls.sharers)
+        cls.user.profile.followed_tags.add(*Tag.objects.filter(name__in=["foo", "bar"]))
+
+    def test_followed(self):
+        self.assertEqual(list(Content.objects.followed(self.user)), [self.content])
+
+    def test_limited(self):
+        self.assertEqual(list(Content.objects.limited(self.user)), [self.content])
+
+    def test_tags_followed_by_user(self):
+        self.assertEqual(list(Content.objects.tags_followed_by_user(self.user)), [self.content])
+
+    def test_visible_for_user(self):
+        self.assertEqual(list(Content.objects.visible_for_user(self.user).top_level()), [self.content])
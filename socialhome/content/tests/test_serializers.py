@@ -5,12 +5,12 @@ from django.contrib.auth.models import AnonymousUser
 from rest_framework import serializers
 
 from socialhome.content.models import Content
-from socialhome.content.serializers import ContentSerializer
+from socialhome.content.serializers import ContentSerializer, PAGE_MAX_QUERIES
 from socialhome.content.tests.factories import PublicContentFactory, TagFactory, LimitedContentFactory, \
     LimitedContentWithRecipientsFactory
 from socialhome.enums import Visibility
 from socialhome.tests.utils import SocialhomeTestCase
-from socialhome.users.models import Profile
+from socialhome.users.models import Profile, User
 from socialhome.users.tests.factories import PublicProfileFactory, PublicUserFactory, UserWithContactFactory
 
 
@@ -334,3 +334,65 @@ class ContentSerializerTestCase(SocialhomeTestCase):
 
         serializer.is_valid(raise_exception=True)
         self.assertEqual(serializer.validated_data["recipients"], set())
+
+
+class TestContentListSerializer(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.create_local_and_remote_user()
+        cls.recipient = PublicProfileFactory()
+        cls.create_page_content()
+
+    @classmethod
+    def create_page_content(cls):
+        content = PublicContentFactory(author=cls.remote_profile)
+        content.share(cls.profile)
+        shared = PublicContentFactory(author=cls.remote_profile)
+        share = PublicContentFactory(share_of=shared, author=PublicProfileFactory())
+        PublicContentFactory(parent=share)
+        LimitedContentWithRecipientsFactory(author=cls.profile, recipients=[cls.recipient])
+        mentioning = PublicContentFactory(author=cls.profile)
+        mentioning.mentions.add(cls.recipient)
+        PublicContentFactory(parent=PublicContentFactory(parent=mentioning))
+
+    def get_page(self):
+        return list(
+            Content.objects.top_level().select_related("author__user", "share_of").prefetch_related("tags")
+            .order_by("id"),
+        )
+
+    def test_serializes_content_like_single_content(self):
+        contents = self.get_page()
+        data = ContentSerializer(contents, many=True, context={"request": Mock(user=self.user)}).data
+        self.assertEqual(data, [
+            ContentSerializer(content, context={"request": Mock(user=self.user)}).data for content in contents
+        ])
+        self.assertTrue(any(item["through_author"] for item in data))
+        self.assertTrue(any(item["user_has_shared"] for item in data))
+        self.assertEqual([item["recipients"] for item in data if item["recipients"]], [[self.recipient.finger]] * 2)
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        for _i in range(2):
+            user = User.objects.get(id=self.user.id)
+            contents = self.get_page()
+            with self.assertNumQueries(PAGE_MAX_QUERIES):
+                ContentSerializer(contents, many=True, context={"request": Mock(user=user)}).data
+            for _j in range(5):
+                self.create_page_content()
+
+    def test_stale_reply_count_is_repaired_once(self):
+        content = PublicContentFactory(author=self.remote_profile)
+        Content.objects.filter(id=content.id).update(reply_count=2)
+        ContentSerializer(self.get_page(), many=True, context={"request": Mock(user=self.user)}).data
+        content.refresh_from_db()
+        self.assertEqual(content.reply_count, 0)
+        user = User.objects.get(id=self.user.id)
+        contents = self.get_page()
+        with self.assertNumQueries(PAGE_MAX_QUERIES):
+            ContentSerializer(contents, many=True, context={"request": Mock(user=user)}).data
+
+    def test_query_count__anonymous_user(self):
+        contents = self.get_page()
+        with self.assertNumQueries(3):
+            ContentSerializer(contents, many=True, context={"request": Mock(user=AnonymousUser())}).data
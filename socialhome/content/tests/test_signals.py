@@ -1,4 +1,3 @@
-from unittest import mock
 from unittest.mock import patch, Mock, call
 
 from federation.entities.activitypub.enums import ActivityType
@@ -99,27 +98,36 @@ class TestNotifyListeners(SocialhomeTestCase):
         super().setUpTestData()
         cls.create_local_and_remote_user()
 
+    def setUp(self):
+        super().setUp()
+        # Consider all groups to have listeners
+        patcher = patch("socialhome.streams.consumers.log_event", side_effect=lambda keys, payload: ("1-1", set(keys)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     @patch("socialhome.streams.consumers.async_to_sync", autospec=True)
     def test_add_to_streams_for_users_calls_streamconsumer_group_send__public_no_tags_no_followers(self, mock_async):
         mock_send = Mock()
         mock_async.return_value = mock_send
         content = ContentFactory()
-        with patch("socialhome.users.models.User.recently_active", new_callable=mock.PropertyMock, return_value=True):
+        with patch("socialhome.users.models.User.get_recently_active_ids", side_effect=set):
             add_to_streams_for_users(content.id, content.id, content.author.id)
-        data = {"type": "notification", "payload": {"event": "new", "id": content.id, "parentId": None}}
-        calls = [
-            call(f"streams_profile_all__{content.author.id}__{self.user.id}", data),
-            call(f"streams_public__{self.user.id}", data),
-        ]
-        mock_send.assert_has_calls(calls, any_order=True)
-        self.assertEqual(mock_send.call_count, 2)
+        data = {"type": "notification", "payload": {
+            "event": "new", "id": content.id, "parentId": None, "eventId": "1-1",
+        }}
+        mock_send.assert_called_once_with({
+            f"streams_profile_all__{content.author.id}__{self.user.id}",
+            f"streams_public__{self.user.id}",
+        }, data)
 
     @patch("socialhome.streams.consumers.async_to_sync", autospec=True)
     def test_add_to_streams_for_users_calls_streamconsumer_group_send__user_not_recently_active(self, mock_async):
         mock_send = Mock()
         mock_async.return_value = mock_send
         content = ContentFactory()
-        add_to_streams_for_users(content.id, content.id, content.author.id)
+        # Activity keys left in Redis by earlier test runs could match the user ID
+        with patch("socialhome.users.models.User.get_recently_active_ids", return_value=set()):
+            add_to_streams_for_users(content.id, content.id, content.author.id)
         mock_send.assert_not_called()
 
     @patch("socialhome.streams.consumers.async_to_sync", autospec=True)
@@ -130,20 +138,20 @@ class TestNotifyListeners(SocialhomeTestCase):
         self.profile.following.add(self.remote_profile)
         content = ContentFactory(author=self.remote_profile, visibility=Visibility.LIMITED, text="#foobar #barfoo")
         content.limited_visibilities.add(self.profile)
-        with patch("socialhome.users.models.User.recently_active", new_callable=mock.PropertyMock, return_value=True):
+        with patch("socialhome.users.models.User.get_recently_active_ids", side_effect=set):
             add_to_streams_for_users(content.id, content.id, content.author.id)
-        data = {"type": "notification", "payload": {"event": "new", "id": content.id, "parentId": None}}
+        data = {"type": "notification", "payload": {
+            "event": "new", "id": content.id, "parentId": None, "eventId": "1-1",
+        }}
         foobar_id = Tag.objects.get(name="foobar").id
         barfoo_id = Tag.objects.get(name="barfoo").id
-        calls = [
-            call(f"streams_tag__{foobar_id}__{self.user.id}", data),
-            call(f"streams_tag__{barfoo_id}__{self.user.id}", data),
-            call(f"streams_profile_all__{content.author.id}__{self.user.id}", data),
-            call(f"streams_followed__{self.user.id}", data),
-            call(f"streams_limited__{self.user.id}", data),
-        ]
-        mock_send.assert_has_calls(calls, any_order=True)
-        self.assertEqual(mock_send.call_count, 5)
+        mock_send.assert_called_once_with({
+            f"streams_tag__{foobar_id}__{self.user.id}",
+            f"streams_tag__{barfoo_id}__{self.user.id}",
+            f"streams_profile_all__{content.author.id}__{self.user.id}",
+            f"streams_followed__{self.user.id}",
+            f"streams_limited__{self.user.id}",
+        }, data)
 
     @patch("socialhome.streams.consumers.async_to_sync", autospec=True)
     def test_add_to_streams_for_users_calls_streamconsumer_group_send__limited_no_followers(self, mock_async):
@@ -162,29 +170,29 @@ class TestNotifyListeners(SocialhomeTestCase):
         third_user = PublicUserFactory()
         other_user.profile.following.add(self.remote_profile)
         content = ContentFactory(author=self.remote_profile, text="#foobar #barfoo")
-        with patch("socialhome.users.models.User.recently_active", new_callable=mock.PropertyMock, return_value=True):
+        with patch("socialhome.users.models.User.get_recently_active_ids", side_effect=set):
             add_to_streams_for_users(content.id, content.id, content.author.id)
-        data = {"type": "notification", "payload": {"event": "new", "id": content.id, 'parentId': None}}
+        data = {"type": "notification", "payload": {
+            "event": "new", "id": content.id, 'parentId': None, "eventId": "1-1",
+        }}
         foobar_id = Tag.objects.get(name="foobar").id
         barfoo_id = Tag.objects.get(name="barfoo").id
-        calls = [
-            call(f"streams_tag__{foobar_id}__{self.user.id}", data),
-            call(f"streams_tag__{foobar_id}__{other_user.id}", data),
-            call(f"streams_tag__{foobar_id}__{third_user.id}", data),
-            call(f"streams_tag__{barfoo_id}__{self.user.id}", data),
-            call(f"streams_tag__{barfoo_id}__{other_user.id}", data),
-            call(f"streams_tag__{barfoo_id}__{third_user.id}", data),
-            call(f"streams_profile_all__{content.author.id}__{self.user.id}", data),
-            call(f"streams_profile_all__{content.author.id}__{other_user.id}", data),
-            call(f"streams_profile_all__{content.author.id}__{third_user.id}", data),
-            call(f"streams_public__{self.user.id}", data),
-            call(f"streams_public__{other_user.id}", data),
-            call(f"streams_public__{third_user.id}", data),
-            call(f"streams_followed__{self.user.id}", data),
-            call(f"streams_followed__{other_user.id}", data),
-        ]
-        mock_send.assert_has_calls(calls, any_order=True)
-        self.assertEqual(mock_send.call_count, 14)
+        mock_send.assert_called_once_with({
+            f"streams_tag__{foobar_id}__{self.user.id}",
+            f"streams_tag__{foobar_id}__{other_user.id}",
+            f"streams_tag__{foobar_id}__{third_user.id}",
+            f"streams_tag__{barfoo_id}__{self.user.id}",
+            f"streams_tag__{barfoo_id}__{other_user.id}",
+            f"streams_tag__{barfoo_id}__{third_user.id}",
+            f"streams_profile_all__{content.author.id}__{self.user.id}",
+            f"streams_profile_all__{content.author.id}__{other_user.id}",
+            f"streams_profile_all__{content.author.id}__{third_user.id}",
+            f"streams_public__{self.user.id}",
+            f"streams_public__{other_user.id}",
+            f"streams_public__{third_user.id}",
+            f"streams_followed__{self.user.id}",
+            f"streams_followed__{other_user.id}",
+        }, data)
 
     @patch("socialhome.streams.consumers.async_to_sync", autospec=True)
     def test_add_to_streams_for_users_calls_streamconsumer_group_send__public_share_with_followers(self, mock_async):
@@ -195,18 +203,18 @@ class TestNotifyListeners(SocialhomeTestCase):
         other_profile = ProfileFactory()
         content = ContentFactory(author=self.remote_profile)
         share = ContentFactory(content_type=ContentType.SHARE, share_of=content, author=other_profile)
-        with patch("socialhome.users.models.User.recently_active", new_callable=mock.PropertyMock, return_value=True):
+        with patch("socialhome.users.models.User.get_recently_active_ids", side_effect=set):
             add_to_streams_for_users(content.id, share.id, share.author.id)
-        data = {"type": "notification", "payload": {"event": "new", "id": content.id, "parentId": None}}
-        calls = [
-            call(f"streams_profile_all__{share.author.id}__{self.user.id}", data),
-            call(f"streams_profile_all__{share.author.id}__{other_user.id}", data),
-            call(f"streams_followed__{self.user.id}", data),
-            call(f"streams_public__{self.user.id}", data),
-            call(f"streams_public__{other_user.id}", data),
-        ]
-        mock_send.assert_has_calls(calls, any_order=True)
-        self.assertEqual(mock_send.call_count, 5)
+        data = {"type": "notification", "payload": {
+            "event": "new", "id": content.id, "parentId": None, "eventId": "1-1",
+        }}
+        mock_send.assert_called_once_with({
+            f"streams_profile_all__{share.author.id}__{self.user.id}",
+            f"streams_profile_all__{share.author.id}__{other_user.id}",
+            f"streams_followed__{self.user.id}",
+            f"streams_public__{self.user.id}",
+            f"streams_public__{other_user.id}",
+        }, data)
 
     @patch("socialhome.streams.consumers.async_to_sync", autospec=True)
     def test_add_to_streams_for_users_calls_streamconsumer_group_send__replies(self, mock_async):
@@ -216,24 +224,22 @@ class TestNotifyListeners(SocialhomeTestCase):
         reply = ContentFactory(parent=content)
 
         # First test the "add_to_streams_for_users" functionality for replies
-        with patch("socialhome.users.models.User.recently_active", new_callable=mock.PropertyMock, return_value=True):
+        with patch("socialhome.users.models.User.get_recently_active_ids", side_effect=set):
             add_to_streams_for_users(reply.id, reply.id, content.author.id)
-        data = {"type": "notification", "payload": {"event": "new", "id": reply.id, "parentId": content.id}}
-        calls = [
-            call(f'streams_public__{self.user.id}', data),
-            call(f'streams_profile_all__{content.author.id}__{self.user.id}', data),
-        ]
-        mock_send.assert_has_calls(calls, any_order=True)
-        self.assertEqual(mock_send.call_count, 2)
+        data = {"type": "notification", "payload": {
+            "event": "new", "id": reply.id, "parentId": content.id, "eventId": "1-1",
+        }}
+        mock_send.assert_called_once_with({
+            f'streams_public__{self.user.id}',
+            f'streams_profile_all__{content.author.id}__{self.user.id}',
+        }, data)
 
         # Then test what "update_streams_with_content" called before should add
         mock_send.reset_mock()
         update_streams_with_content(reply)
-        calls = [
-            call(f'streams_content__{content.channel_group_name}', data),
-        ]
-        mock_send.assert_has_calls(calls, any_order=True)
-        self.assertEqual(mock_send.call_count, 1)
+        mock_send.assert_called_once_with({
+            f'streams_content__{content.channel_group_name}',
+        }, data)
 
 
 class TestFederateContent(SocialhomeTransactionTestCase):
@@ -1,6 +1,7 @@
 from socialhome.content.models import Content
 from socialhome.content.tests.factories import PublicContentFactory, TagFactory
 from socialhome.enums import Visibility
+from socialhome.streams.streams import get_profile_groups
 from socialhome.tests.utils import SocialhomeAPITestCase
 from socialhome.users.tests.factories import UserFactory, AdminUserFactory, ProfileFactory
 
@@ -212,6 +213,12 @@ class TestContentViewSet(SocialhomeAPITestCase):
         self.assertEqual(self.last_response.data[0].get("id"), self.reply.id)
         self.assertEqual(self.last_response.data[1].get("id"), self.share_reply.id)
 
+    def test_replies_records_displayed_profiles(self):
+        self.get("api:content-replies", pk=self.public_content.id)
+        group = f"streams_content__{self.public_content.channel_group_name}"
+        self.assertIn(group, get_profile_groups(self.public_content.author_id))
+        self.assertIn(group, get_profile_groups(self.reply.author_id))
+
     def test_share(self):
         self.post("api:content-share", pk=self.public_content.id)
         self.response_403()
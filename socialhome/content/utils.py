@@ -7,6 +7,7 @@ from bs4 import BeautifulSoup
 from bs4.element import NavigableString
 from commonmark import commonmark
 from django.conf import settings
+from django.db.models import Q
 from django.urls import reverse
 
 from federation.utils.text import find_elements, MENTION_PATTERN, TAG_PATTERN, URL_PATTERN
@@ -193,25 +194,30 @@ def linkify_mentions(soup: BeautifulSoup):
         mention.replace_with(link)
 
 
-def update_counts(content):
+def update_counts(content, reply_count=None):
     """
     Update cached data in support of threaded replies.
     This will be removed in a future release and
     replaced with a management command.
+
+    The cached reply count is up to date if it counts the direct replies of the content and its shares,
+    like ``Content.cache_data`` does.
+
+    :param content: Content to check.
+    :param reply_count: Count of the direct replies of the content and its shares, if already known.
     """
     from socialhome.content.models import Content
     from socialhome.content.enums import ContentType
 
     if content.content_type != ContentType.CONTENT: return
-    child_count = content.children.count()
-    if content.reply_count == child_count or content.all_children.count() == child_count: return
+    if reply_count is None:
+        reply_count = Content.objects.filter(Q(parent=content) | Q(parent__share_of=content)).count()
+    if content.reply_count == reply_count: return
 
-    do_root = False
     for child in content.all_children.iterator():
         if child.root_parent_id != child.parent_id:
-            do_root = True
             child.cache_data(commit=True)
-    if do_root:
-        content.cache_data(commit=True)
-        content.refresh_from_db()
-        logger.info(f'counts updated for content #{content.id}')
+    # Also without nested replies, for example after a reply was deleted
+    content.cache_data(commit=True)
+    content.refresh_from_db()
+    logger.info(f'counts updated for content #{content.id}')
@@ -15,6 +15,7 @@ from rest_framework.viewsets import GenericViewSet
 
 from socialhome.content.models import Content, Tag
 from socialhome.content.serializers import ContentSerializer, TagSerializer
+from socialhome.streams.streams import add_profile_groups
 from socialhome.users.serializers import LimitedProfileSerializer
 from socialhome.users.utils import update_profiles
 
@@ -139,18 +140,28 @@ class ContentViewSet(mixins.CreateModelMixin, mixins.RetrieveModelMixin, mixins.
     @action(detail=True, methods=["get"])
     def replies(self, request, *args, **kwargs):
         parent = self.get_object()
-        queryset = self.filter_queryset(self.get_queryset(root_parent=parent)).order_by("created")
+        queryset = self.filter_queryset(self.get_queryset(root_parent=parent))
         serializer = self.get_serializer(queryset, many=True)
         if not settings.DEBUG: update_profiles(serializer.child.instance)
-        return Response(serializer.data)
+        data = serializer.data
+        self.add_profile_groups(parent, queryset)
+        return Response(data)
 
     @action(detail=True, methods=["get"])
     def thread(self, request, *args, **kwargs):
         parent = self.get_object()
-        queryset = self.filter_queryset(self.get_queryset(parent=parent)).order_by("created")
+        queryset = self.filter_queryset(self.get_queryset(parent=parent))
         serializer = self.get_serializer(queryset, many=True)
         if not settings.DEBUG: update_profiles(serializer.child.instance)
-        return Response(serializer.data)
+        data = serializer.data
+        self.add_profile_groups(parent, queryset)
+        return Response(data)
+
+    def add_profile_groups(self, parent, replies):
+        """Record the reply authors, so that profile changes are notified to the listeners of the replies."""
+        root = parent.root_parent or parent
+        profile_ids = {parent.author_id} | {reply.author_id for reply in replies}
+        add_profile_groups("streams_content__%s" % root.channel_group_name, profile_ids)
 
     @action(detail=True, methods=["delete", "post"])
     def share(self, request, *args, **kwargs):
@@ -0,0 +1,571 @@
+"""Stream fan-out and read benchmarks.
+
+Generates a reproducible synthetic social graph and measures adding content to streams, reading the streams
+through the streams API and the database query plans of the streams. Everything is done in one database
+transaction that is rolled back at the end, and the Redis keys written are removed, so the benchmark can be run on a
+development database.
+"""
+import datetime
+import json
+import logging
+import math
+import random
+import time
+from contextlib import contextmanager
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import connection, reset_queries, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
+from dramatiq import Message, get_broker
+from dramatiq.brokers.stub import StubBroker
+from federation.protocols.enums import ProtocolType
+from redis.client import Pipeline, Redis
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from socialhome import __version__
+from socialhome.content.enums import ContentType
+from socialhome.content.models import Content, Tag
+from socialhome.enums import Visibility
+from socialhome.streams.streams import (
+    get_precache_streams, rebuild_precaches, rebuild_precaches_for_users, update_streams_with_content,
+    FollowedStream, LimitedStream, LocalStream, ProfileAllStream, ProfilePinnedStream, PublicStream, TagStream,
+    TagsStream,
+)
+from socialhome.streams.viewsets import (
+    FollowedStreamAPIView, LimitedStreamAPIView, LocalStreamAPIView, ProfileAllStreamAPIView,
+    ProfilePinnedStreamAPIView, PublicStreamAPIView, TagStreamAPIView, TagsStreamAPIView,
+)
+from socialhome.users.models import Profile, User
+from socialhome.utils import get_redis_connection
+
+logger = logging.getLogger("socialhome")
+
+DEFAULT_PARAMETERS = {
+    # Random seed, the same parameters and seed always generate the same graph
+    "seed": 1,
+    # Amount of local users
+    "users": 200,
+    # Amount of remote profiles
+    "remote_profiles": 1000,
+    # Pareto shape of the follow degree distribution, smaller values give a longer tail of heavy followers
+    "follow_alpha": 1.5,
+    # Minimum and maximum amount of profiles a local user follows
+    "min_follows": 5,
+    "max_follows": 300,
+    # Amount of tags and maximum amount of tags a local user follows
+    "tags": 50,
+    "max_tag_follows": 5,
+    # Ratio of local users that are marked as recently active, ie have the streams open
+    "active_ratio": 0.5,
+    # Amount of content in the database before measuring
+    "content": 5000,
+    # Ratio of content authored by local users
+    "local_ratio": 0.3,
+    # Ratios of limited, site and self content, the rest is public
+    "limited_ratio": 0.15,
+    "site_ratio": 0.2,
+    "self_ratio": 0.05,
+    # Maximum amount of recipients of limited content
+    "max_recipients": 20,
+    # Ratios of shares and replies of the measured content
+    "share_ratio": 0.1,
+    "reply_ratio": 0.1,
+    # Amount of content to measure adding to streams for
+    "fanout_content": 50,
+    # Amount of requests to measure per streams API endpoint
+    "requests": 30,
+}
+
+STREAM_VIEWS = {
+    "followed": FollowedStreamAPIView,
+    "limited": LimitedStreamAPIView,
+    "local": LocalStreamAPIView,
+    "profile-all": ProfileAllStreamAPIView,
+    "profile-pinned": ProfilePinnedStreamAPIView,
+    "public": PublicStreamAPIView,
+    "tag": TagStreamAPIView,
+    "tags": TagsStreamAPIView,
+}
+
+QUERY_STREAMS = {
+    "followed": FollowedStream,
+    "limited": LimitedStream,
+    "local": LocalStream,
+    "profile-all": ProfileAllStream,
+    "profile-pinned": ProfilePinnedStream,
+    "public": PublicStream,
+    "tag": TagStream,
+    "tags": TagsStream,
+}
+# Amount of content to create per insert, to keep the memory use down with large content tables
+CONTENT_BATCH_SIZE = 10000
+
+
+def percentile(values, percent):
+    """Get the nearest rank percentile of the values.
+
+    :param values: List of numbers
+    :param percent: Percentile to get, 0-100
+    :return: The percentile value, or None if there are no values
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(values)), 1)
+    return values[min(rank, len(values)) - 1]
+
+
+def summarize(timings):
+    """Summarize a list of timings in seconds as milliseconds."""
+    return {
+        "p50_ms": round(percentile(timings, 50) * 1000, 2),
+        "p95_ms": round(percentile(timings, 95) * 1000, 2),
+        "max_ms": round(max(timings) * 1000, 2),
+    }
+
+
+class SocialGraph:
+    """A synthetic social graph of local users, remote profiles, follows, tag follows and content.
+
+    Profile popularity follows a Zipf distribution, so that a few profiles have most of the followers, and the
+    amount of profiles each local user follows follows a Pareto distribution.
+    """
+    def __init__(self, **parameters):
+        self.parameters = dict(DEFAULT_PARAMETERS, **parameters)
+        self.random = random.Random(self.parameters["seed"])
+        self.users = []
+        self.profiles = []
+        self.tags = []
+        self.popular_profiles = []
+        self.popular_tags = []
+        self.content_ids = []
+        self.top_level_ids = []
+
+    def generate(self):
+        """Create the graph in the database."""
+        prefix = uuid4().hex[:8]
+        self.create_users(prefix)
+        self.create_remote_profiles(prefix)
+        self.create_tags(prefix)
+        self.create_follows()
+        self.create_content()
+        self.analyze()
+        return self
+
+    def analyze(self):
+        """Update the table statistics, so that queries are planned like for a database with this much data.
+
+        The statistics include the uncommitted rows of the benchmark transaction, so this is done again after
+        the transaction is rolled back.
+        """
+        with connection.cursor() as cursor:
+            for model in (User, Profile, Profile.following.through, Profile.followed_tags.through, Tag, Content,
+                          Content.tags.through, Content.limited_visibilities.through):
+                cursor.execute("ANALYZE %s" % connection.ops.quote_name(model._meta.db_table))
+
+    def create_users(self, prefix):
+        count = self.parameters["users"]
+        users = User.objects.bulk_create([
+            User(username=f"bench-{prefix}-{i}", email=f"bench-{prefix}-{i}@example.com", last_login=now())
+            for i in range(count)
+        ])
+        profiles = []
+        for user in users:
+            uuid = uuid4()
+            profiles.append(Profile(
+                user=user, uuid=uuid, guid=str(uuid), fid=user.url, name=user.username, email=user.email,
+                handle=f"{user.username}@{settings.SOCIALHOME_DOMAIN}",
+                finger=f"{user.username}@{settings.SOCIALHOME_DOMAIN}",
+                visibility=self.random.choice([Visibility.PUBLIC, Visibility.PUBLIC, Visibility.SITE]),
+                protocol="activitypub", protocols=[ProtocolType.ACTIVITYPUB, ProtocolType.DIASPORA],
+            ))
+        Profile.objects.bulk_create(profiles)
+        self.users = list(
+            User.objects.filter(id__in=[user.id for user in users]).select_related("profile").order_by("id"),
+        )
+        for user in self.random.sample(self.users, int(len(self.users) * self.parameters["active_ratio"])):
+            user.mark_recently_active()
+
+    def create_remote_profiles(self, prefix):
+        profiles = []
+        for i in range(self.parameters["remote_profiles"]):
+            fid = f"https://remote.example.com/bench-{prefix}/{i}/"
+            handle = f"bench-{prefix}-{i}@remote.example.com"
+            # Complete profiles, so that reading their content doesn't queue profile updates
+            profiles.append(Profile(
+                uuid=uuid4(), fid=fid, handle=handle, finger=handle, name=f"Remote {i}", visibility=Visibility.PUBLIC,
+                remote_url=fid, key_id=f"{fid}#main-key", avatar_url="https://remote.example.com/avatar.png",
+                protocol="activitypub", protocols=[ProtocolType.ACTIVITYPUB],
+            ))
+        self.profiles = Profile.objects.bulk_create(profiles)
+
+    def create_tags(self, prefix):
+        self.tags = Tag.objects.bulk_create([
+            Tag(name=f"bench{prefix}{i}") for i in range(self.parameters["tags"])
+        ])
+
+    @property
+    def all_profiles(self):
+        return [user.profile for user in self.users] + self.profiles
+
+    def get_popularity_weights(self, count):
+        return [1 / rank for rank in range(1, count + 1)]
+
+    def create_follows(self):
+        # Shuffle once so that the most popular profiles are a mix of local and remote profiles
+        self.popular_profiles = self.all_profiles
+        self.random.shuffle(self.popular_profiles)
+        weights = self.get_popularity_weights(len(self.popular_profiles))
+        self.popular_tags = list(self.tags)
+        self.random.shuffle(self.popular_tags)
+        tag_weights = self.get_popularity_weights(len(self.popular_tags))
+        follows = []
+        tag_follows = []
+        for user in self.users:
+            degree = int(self.random.paretovariate(self.parameters["follow_alpha"]) * self.parameters["min_follows"])
+            degree = min(degree, self.parameters["max_follows"], len(self.popular_profiles) - 1)
+            followed = set()
+            while len(followed) < degree:
+                profile = self.random.choices(self.popular_profiles, weights)[0]
+                if profile.id != user.profile.id:
+                    followed.add(profile.id)
+            follows.extend(
+                Profile.following.through(from_profile_id=user.profile.id, to_profile_id=profile_id)
+                for profile_id in followed
+            )
+            tag_count = self.random.randint(0, min(self.parameters["max_tag_follows"], len(self.popular_tags)))
+            tag_ids = {tag.id for tag in self.random.choices(self.popular_tags, tag_weights, k=tag_count)}
+            tag_follows.extend(
+                Profile.followed_tags.through(profile_id=user.profile.id, tag_id=tag_id) for tag_id in tag_ids
+            )
+        Profile.following.through.objects.bulk_create(follows)
+        Profile.followed_tags.through.objects.bulk_create(tag_follows)
+
+    def get_author(self):
+        if self.random.random() < self.parameters["local_ratio"]:
+            return self.random.choice(self.users).profile
+        return self.random.choices(self.profiles, self.get_popularity_weights(len(self.profiles)))[0]
+
+    def get_visibility(self):
+        value = self.random.random()
+        for visibility, ratio in (
+            (Visibility.LIMITED, self.parameters["limited_ratio"]),
+            (Visibility.SITE, self.parameters["site_ratio"]),
+            (Visibility.SELF, self.parameters["self_ratio"]),
+        ):
+            if value < ratio:
+                return visibility
+            value -= ratio
+        return Visibility.PUBLIC
+
+    def build_content(self, created, **kwargs):
+        author = kwargs.pop("author", None) or self.get_author()
+        uuid = uuid4()
+        return Content(
+            author=author, uuid=uuid, fid=f"{settings.SOCIALHOME_URL}/content/{uuid}/", local=author.is_local,
+            text="Benchmark content", rendered="<p>Benchmark content</p>", created=created,
+            visibility=kwargs.pop("visibility", None) or self.get_visibility(), **kwargs,
+        )
+
+    def add_relations(self, contents):
+        """Add the tags and limited visibility recipients of top level content."""
+        tag_weights = self.get_popularity_weights(len(self.popular_tags))
+        content_tags = []
+        recipients = []
+        for content in contents:
+            if content.content_type != ContentType.CONTENT:
+                continue
+            if self.popular_tags and self.random.random() < 0.3:
+                content_tags.extend(
+                    Content.tags.through(content_id=content.id, tag_id=tag_id)
+                    for tag_id in {tag.id for tag in self.random.choices(self.popular_tags, tag_weights, k=2)}
+                )
+            if content.visibility == Visibility.LIMITED:
+                count = min(self.random.randint(1, self.parameters["max_recipients"]), len(self.users))
+                recipients.extend(
+                    Content.limited_visibilities.through(content_id=content.id, profile_id=user.profile.id)
+                    for user in self.random.sample(self.users, count)
+                )
+        Content.tags.through.objects.bulk_create(content_tags)
+        Content.limited_visibilities.through.objects.bulk_create(recipients)
+
+    def create_content(self):
+        count = self.parameters["content"]
+        started = now() - datetime.timedelta(days=7)
+        step = datetime.timedelta(days=7) / max(count, 1)
+        for offset in range(0, count, CONTENT_BATCH_SIZE):
+            contents = Content.objects.bulk_create([
+                self.build_content(created=started + step * i)
+                for i in range(offset, min(offset + CONTENT_BATCH_SIZE, count))
+            ])
+            ids = [content.id for content in contents]
+            Content.objects.filter(id__in=ids).update(through=F("id"))
+            self.add_relations(contents)
+            self.content_ids.extend(ids)
+            self.top_level_ids.extend(
+                content.id for content in contents
+                if content.visibility in (Visibility.PUBLIC, Visibility.SITE)
+            )
+
+    def create_measured_content(self):
+        """Create one new content to add to the streams, a share, a reply or a top level content."""
+        value = self.random.random()
+        if self.top_level_ids and value < self.parameters["share_ratio"]:
+            share_of = Content.objects.get(id=self.random.choice(self.top_level_ids))
+            content = self.build_content(
+                created=now(), share_of=share_of, content_type=ContentType.SHARE, visibility=share_of.visibility,
+            )
+        elif self.top_level_ids and value < self.parameters["share_ratio"] + self.parameters["reply_ratio"]:
+            parent = Content.objects.get(id=self.random.choice(self.top_level_ids))
+            content = self.build_content(
+                created=now(), parent=parent, root_parent=parent, content_type=ContentType.REPLY,
+                visibility=parent.visibility,
+            )
+        else:
+            content = self.build_content(created=now())
+        Content.objects.bulk_create([content])
+        if content.content_type == ContentType.SHARE:
+            Content.objects.filter(id=content.share_of_id).update(through=content.id)
+        else:
+            Content.objects.filter(id=content.id).update(through=content.id)
+            content.through = content.id
+        self.add_relations([content])
+        self.content_ids.append(content.id)
+        return content
+
+
+def run_queued_jobs(broker):
+    """Run the jobs queued to the stub broker in this thread.
+
+    Jobs are run in the benchmark transaction, since the worker threads would not see the uncommitted benchmark data.
+    """
+    ran = True
+    while ran:
+        ran = False
+        for queue in list(broker.queues.values()):
+            while not queue.empty():
+                message = Message.decode(queue.get_nowait())
+                broker.get_actor(message.actor_name).fn(*message.args, **message.kwargs)
+                queue.task_done()
+                ran = True
+
+
+class RedisCommandCounter:
+    """Count the commands processed by the Redis server."""
+    def __init__(self):
+        self.redis = get_redis_connection()
+        first = self.get_processed()
+        # The INFO call itself is counted too
+        self.overhead = self.get_processed() - first
+
+    def get_processed(self):
+        return self.redis.info("stats")["total_commands_processed"]
+
+    @contextmanager
+    def count(self, counts):
+        start = self.get_processed()
+        yield
+        counts.append(self.get_processed() - start - self.overhead)
+
+
+class RedisKeyTracker:
+    """Track the keys used by the Redis commands sent from this process, so that only they are cleaned up."""
+    # Commands whose first argument is not a key
+    KEYLESS_COMMANDS = {"CLIENT", "EXEC", "INFO", "MULTI", "PING", "PUBLISH", "SCAN", "SCRIPT"}
+
+    def __init__(self):
+        self.keys = set()
+
+    def add(self, args):
+        command = str(args[0]).upper()
+        if command in ("EVAL", "EVALSHA"):
+            keys = args[3:3 + int(args[2])]
+        elif command in self.KEYLESS_COMMANDS:
+            keys = []
+        else:
+            keys = args[1:2]
+        self.keys.update(key.encode() if isinstance(key, str) else key for key in keys)
+
+    @contextmanager
+    def track(self):
+        tracker = self
+        execute_command = Redis.execute_command
+        pipeline_execute_command = Pipeline.pipeline_execute_command
+
+        def tracked_execute_command(client, *args, **options):
+            tracker.add(args)
+            return execute_command(client, *args, **options)
+
+        def tracked_pipeline_execute_command(pipeline, *args, **options):
+            tracker.add(args)
+            return pipeline_execute_command(pipeline, *args, **options)
+
+        Redis.execute_command = tracked_execute_command
+        Pipeline.pipeline_execute_command = tracked_pipeline_execute_command
+        try:
+            yield self
+        finally:
+            Redis.execute_command = execute_command
+            Pipeline.pipeline_execute_command = pipeline_execute_command
+
+
+def measure_fanout(graph, broker, counter):
+    """Measure adding new content to the streams, including the queued fan-out jobs."""
+    timings, redis_commands, queries = [], [], []
+    for _i in range(graph.parameters["fanout_content"]):
+        content = graph.create_measured_content()
+        # The query log has a limit, start from an empty one for each measurement
+        reset_queries()
+        with CaptureQueriesContext(connection) as context, counter.count(redis_commands):
+            started = time.perf_counter()
+            update_streams_with_content(content)
+            run_queued_jobs(broker)
+            timings.append(time.perf_counter() - started)
+        queries.append(len(context.captured_queries))
+    return dict(
+        summarize(timings),
+        content=len(timings),
+        redis_commands_per_content=round(sum(redis_commands) / len(redis_commands), 1),
+        queries_per_content=round(sum(queries) / len(queries), 1),
+    )
+
+
+def measure_endpoints(graph):
+    """Measure the first page of each streams API endpoint, for randomly chosen users."""
+    factory = APIRequestFactory()
+    profile = graph.popular_profiles[0]
+    tag = graph.popular_tags[0] if graph.popular_tags else None
+    kwargs = {
+        "profile-all": {"uuid": str(profile.uuid)},
+        "profile-pinned": {"uuid": str(profile.uuid)},
+        "tag": {"name": tag.name if tag else "benchmark"},
+    }
+    results = {}
+    for name, view_cls in STREAM_VIEWS.items():
+        view = view_cls.as_view()
+        timings, queries = [], []
+        for _i in range(graph.parameters["requests"]):
+            request = factory.get("/", HTTP_ACCEPT="application/json; version=2.0")
+            force_authenticate(request, user=graph.random.choice(graph.users))
+            reset_queries()
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                response = view(request, **kwargs.get(name, {}))
+                response.render()
+                timings.append(time.perf_counter() - started)
+            if response.status_code != 200:
+                logger.warning("benchmark.measure_endpoints - %s returned %s", name, response.status_code)
+            queries.append(len(context.captured_queries))
+        results[name] = dict(summarize(timings), queries=percentile(queries, 50))
+    return results
+
+
+def measure_queries(graph):
+    """Explain the database queries of the first page of each stream, for randomly chosen users.
+
+    These are the queries streams use when the precache doesn't have enough content. The execution times of
+    streams read with several branch querysets are summed.
+    """
+    profile = graph.popular_profiles[0]
+    tag = graph.popular_tags[0] if graph.popular_tags else None
+    kwargs = {
+        "profile-all": {"profile": profile},
+        "profile-pinned": {"profile": profile},
+        "tag": {"tag": tag},
+    }
+    results = {}
+    for name, stream_cls in QUERY_STREAMS.items():
+        if name == "tag" and not tag:
+            continue
+        timings, distinct = [], False
+        for _i in range(graph.parameters["requests"]):
+            stream = stream_cls(user=graph.random.choice(graph.users), **kwargs.get(name, {}))
+            elapsed = 0
+            for qs in stream.get_branch_querysets():
+                qs = qs.values("id", "through").order_by(stream.ordering)[:stream.paginate_by]
+                explained = json.loads(qs.explain(format="json", analyze=True))[0]
+                elapsed += explained["Execution Time"] / 1000
+                distinct = distinct or qs.query.distinct
+            timings.append(elapsed)
+        results[name] = dict(summarize(timings), distinct=distinct)
+    return results
+
+
+def cleanup_redis(existing_keys, used_keys, content_ids):
+    """Remove the Redis keys and precached content added by the benchmark.
+
+    :param existing_keys: Keys that existed before the benchmark.
+    :param used_keys: Keys used by the benchmark. Only the ones that did not exist before are removed, keys
+        written meanwhile by other processes are left alone.
+    :param content_ids: Content ID's to remove from the precaches that existed before the benchmark.
+    """
+    r = get_redis_connection()
+    new_keys = [key for key in used_keys if key not in existing_keys]
+    for i in range(0, len(new_keys), 1000):
+        r.delete(*new_keys[i:i + 1000])
+    # Shared precaches existed before the benchmark, remove only the benchmark content from them
+    if not content_ids:
+        return
+    pipe = r.pipeline(transaction=False)
+    for key in used_keys & existing_keys:
+        if key.startswith(b"sh:streams:"):
+            key_type = r.type(key)
+            if key_type == b"zset":
+                pipe.zrem(key, *content_ids)
+            elif key_type == b"hash":
+                pipe.hdel(key, *content_ids)
+    pipe.execute()
+
+
+def run_benchmark(**parameters):
+    """Generate a social graph and measure adding content to streams and reading the streams API.
+
+    The tasks broker must be the stub broker, so that the queued fan-out jobs can be run in the benchmark.
+
+    :return: Dict of parameters and results
+    """
+    broker = get_broker()
+    if not isinstance(broker, StubBroker):
+        raise ValueError("The benchmark needs the stub tasks broker")
+    r = get_redis_connection()
+    existing_keys = set(r.scan_iter(count=1000))
+    graph = SocialGraph(**parameters)
+    tracker = RedisKeyTracker()
+    try:
+        with tracker.track(), transaction.atomic():
+            graph.generate()
+            user = graph.users[0]
+            rebuild_precaches(get_precache_streams(user), shared=True)
+            rebuild_precaches_for_users([user.id for user in graph.users])
+            counter = RedisCommandCounter()
+            results = {
+                "version": __version__,
+                "parameters": graph.parameters,
+                "fanout": measure_fanout(graph, broker, counter),
+                "endpoints": measure_endpoints(graph),
+                "queries": measure_queries(graph),
+            }
+            transaction.set_rollback(True)
+        graph.analyze()
+    finally:
+        cleanup_redis(existing_keys, tracker.keys, graph.content_ids)
+    return results
+
+
+def compare_results(results, baseline, metric="p95_ms"):
+    """Compare results to baseline results.
+
+    :return: List of tuples of name, baseline value, current value and change in percent
+    """
+    rows = [("fanout", baseline.get("fanout", {}).get(metric), results["fanout"][metric])]
+    for name, values in results["endpoints"].items():
+        rows.append((name, baseline.get("endpoints", {}).get(name, {}).get(metric), values[metric]))
+    for name, values in results.get("queries", {}).items():
+        rows.append((f"{name} query", baseline.get("queries", {}).get(name, {}).get(metric), values[metric]))
+    return [
+        (name, old, new, round((new - old) / old * 100, 1) if old else None)
+        for name, old, new in rows
+    ]
@@ -1,17 +1,227 @@
+import asyncio
 import json
-from typing import Set, Union
+import re
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple, Union
 
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.layers import get_channel_layer
+from django.conf import settings
 
 from socialhome.content.models import Content
-from socialhome.users.models import Profile
+from socialhome.users.models import Profile, User
+from socialhome.utils import get_async_redis_connection, get_redis_connection
 
+# Maximum amount of concurrent group sends when sending to many groups
+GROUP_SEND_CONCURRENCY = 50
+# Sorted sets per stream group of the websocket channels listening to it, scored by their last heartbeat
+PRESENCE_KEY_PREFIX = "sh:notify:presence:"
+# Keys marking the stream groups that have had listening websocket channels recently
+LISTENED_KEY_PREFIX = "sh:notify:listened:"
+# Redis streams per stream group of the recent notifications, for websockets to catch up from after reconnecting
+EVENT_LOG_KEY_PREFIX = "sh:notify:events:"
+# Hash with the millisecond clock and sequence of the notification event ids
+EVENT_CLOCK_KEY = "sh:notify:event_clock"
+# Notification events that are logged for replaying
+REPLAYABLE_EVENTS = {"new", "update"}
+EVENT_ID_RE = re.compile(r"^\d+-\d+$")
 
-def notify_listeners(obj: Union[Content, Profile], keys: Set, event: str = "new") -> None:
-    """Send out to listening consumers."""
+# Get the stream groups that have listening websocket channels.
+# KEYS are the presence keys of the groups.
+# ARGV[1] is the oldest heartbeat timestamp that is still considered live.
+# Returns the presence keys that have live channels.
+GET_LIVE_GROUPS_SCRIPT = """
+local live = {}
+for i = 1, #KEYS do
+    if redis.call('ZCOUNT', KEYS[i], ARGV[1], '+inf') > 0 then
+        table.insert(live, KEYS[i])
+    end
+end
+return live
+"""
+
+# Log a notification to the event logs of the stream groups that have or recently had listening websocket channels.
+# The event gets the same id in all the logs, from a clock that never goes backwards.
+# KEYS[1] is the event clock hash, followed by the presence, listened and event log keys of each group.
+# ARGV[1] is the oldest heartbeat timestamp that is still considered live.
+# ARGV[2] is the maximum length of the event logs.
+# ARGV[3] is the expiry of the event logs in seconds.
+# ARGV[4] is the notification payload.
+# Returns the event id and the positions of the groups that have live channels.
+LOG_EVENT_SCRIPT = """
+local time = redis.call('TIME')
+local ms = math.max(
+    tonumber(time[1]) * 1000 + math.floor(tonumber(time[2]) / 1000),
+    tonumber(redis.call('HGET', KEYS[1], 'ms') or 0)
+)
+redis.call('HSET', KEYS[1], 'ms', string.format('%d', ms))
+local id = string.format('%d', ms) .. '-' .. redis.call('HINCRBY', KEYS[1], 'seq', 1)
+local live = {}
+for i = 2, #KEYS, 3 do
+    local is_live = redis.call('ZCOUNT', KEYS[i], ARGV[1], '+inf') > 0
+    if is_live then
+        table.insert(live, (i + 1) / 3)
+    end
+    if is_live or redis.call('EXISTS', KEYS[i + 1]) == 1 then
+        redis.call('XADD', KEYS[i + 2], 'MAXLEN', ARGV[2], id, 'payload', ARGV[4])
+        redis.call('EXPIRE', KEYS[i + 2], ARGV[3])
+    end
+end
+return {id, live}
+"""
+
+
+class ActivityThrottle:
+    """Limit marking users as recently active to once per SOCIALHOME_USER_ACTIVITY_MARK_SECONDS per process."""
+    def __init__(self):
+        self.marked: Dict[int, float] = {}
+        self.pruned = time.monotonic()
+
+    def should_mark(self, user_id: int) -> bool:
+        now = time.monotonic()
+        interval = settings.SOCIALHOME_USER_ACTIVITY_MARK_SECONDS
+        if user_id in self.marked and now - self.marked[user_id] < interval:
+            return False
+        if now - self.pruned >= interval:
+            # Forget users marked more than an interval ago, so only users active within an interval are kept
+            self.marked = {id: marked for id, marked in self.marked.items() if now - marked < interval}
+            self.pruned = now
+        self.marked[user_id] = now
+        return True
+
+
+activity_throttle = ActivityThrottle()
+
+
+async def mark_present(group: str, channel_name: str, user: Optional[User] = None) -> None:
+    """Mark a websocket channel as listening to the stream group, and remove channels without a recent heartbeat.
+
+    :param user: User to also mark as recently active, in the same Redis call
+    """
+    key = f"{PRESENCE_KEY_PREFIX}{group}"
+    timestamp = int(time.time())
+    pipe = get_async_redis_connection().pipeline(transaction=False)
+    pipe.zadd(key, {channel_name: timestamp})
+    pipe.zremrangebyscore(key, 0, timestamp - settings.SOCIALHOME_STREAMS_PRESENCE_EXPIRY)
+    pipe.expire(key, settings.SOCIALHOME_STREAMS_PRESENCE_EXPIRY)
+    pipe.set(f"{LISTENED_KEY_PREFIX}{group}", 1, ex=settings.SOCIALHOME_STREAMS_EVENT_LOG_SECONDS)
+    if user:
+        user.mark_recently_active(pipe)
+    await pipe.execute()
+
+
+async def mark_absent(group: str, channel_name: str) -> None:
+    """Remove a websocket channel from the listeners of the stream group.
+
+    The notifications of the group are still logged for a while, for the websocket to catch up on if it reconnects.
+    """
+    pipe = get_async_redis_connection().pipeline(transaction=False)
+    pipe.zrem(f"{PRESENCE_KEY_PREFIX}{group}", channel_name)
+    pipe.set(f"{LISTENED_KEY_PREFIX}{group}", 1, ex=settings.SOCIALHOME_STREAMS_EVENT_LOG_SECONDS)
+    await pipe.execute()
+
+
+def get_live_groups(groups: Iterable[str]) -> Set[str]:
+    """Get the stream groups that have websocket channels with a recent heartbeat listening to them."""
+    keys = [f"{PRESENCE_KEY_PREFIX}{group}" for group in groups]
+    if not keys:
+        return set()
+    r = get_redis_connection()
+    live = r.register_script(GET_LIVE_GROUPS_SCRIPT)(
+        keys=keys, args=[int(time.time()) - settings.SOCIALHOME_STREAMS_PRESENCE_EXPIRY],
+    )
+    return {key.decode()[len(PRESENCE_KEY_PREFIX):] for key in live}
+
+
+def log_event(groups: Iterable[str], payload: dict) -> Tuple[str, Set[str]]:
+    """Log a notification for the stream groups that have or recently had listening websocket channels.
+
+    :returns: The event id, and the groups that have websocket channels with a recent heartbeat listening to them
+    """
+    groups = list(groups)
+    keys = [EVENT_CLOCK_KEY]
+    for group in groups:
+        keys += [f"{PRESENCE_KEY_PREFIX}{group}", f"{LISTENED_KEY_PREFIX}{group}", f"{EVENT_LOG_KEY_PREFIX}{group}"]
+    r = get_redis_connection()
+    event_id, live = r.register_script(LOG_EVENT_SCRIPT)(keys=keys, args=[
+        int(time.time()) - settings.SOCIALHOME_STREAMS_PRESENCE_EXPIRY,
+        settings.SOCIALHOME_STREAMS_EVENT_LOG_SIZE,
+        settings.SOCIALHOME_STREAMS_EVENT_LOG_SECONDS,
+        json.dumps(payload),
+    ])
+    return event_id.decode(), {groups[position - 1] for position in live}
+
+
+def parse_event_id(event_id: str) -> Tuple[int, int]:
+    milliseconds, sequence = event_id.split("-")
+    return int(milliseconds), int(sequence)
+
+
+async def get_missed_events(group: str, event_id: str) -> Optional[List[dict]]:
+    """Get the logged notifications of the stream group after the given event.
+
+    :returns: The notification payloads, or None if events after the given event may have been dropped from the log
+    """
+    if not isinstance(event_id, str) or not EVENT_ID_RE.match(event_id):
+        return None
+    last = parse_event_id(event_id)
+    if last[0] < (time.time() - settings.SOCIALHOME_STREAMS_EVENT_LOG_SECONDS) * 1000:
+        return None
+    pipe = get_async_redis_connection().pipeline(transaction=False)
+    pipe.xlen(f"{EVENT_LOG_KEY_PREFIX}{group}")
+    pipe.xrange(f"{EVENT_LOG_KEY_PREFIX}{group}", count=1)
+    # Redis before 6.2 doesn't support exclusive ranges, so the given event itself is included if still logged
+    pipe.xrange(f"{EVENT_LOG_KEY_PREFIX}{group}", min=event_id)
+    length, oldest, entries = await pipe.execute()
+    if length >= settings.SOCIALHOME_STREAMS_EVENT_LOG_SIZE and parse_event_id(oldest[0][0].decode()) > last:
+        return None
+    events = []
+    for entry_id, fields in entries:
+        entry_id = entry_id.decode()
+        if parse_event_id(entry_id) > last:
+            events.append({**json.loads(fields[b"payload"]), "eventId": entry_id})
+    return events
+
+
+async def group_send_many(groups: Iterable[str], message: dict, concurrency: int = GROUP_SEND_CONCURRENCY) -> None:
+    """Send the same message to many groups from one event loop.
+
+    The group sends are done concurrently, so the channel layer round trips of the groups overlap.
+    """
     channel_layer = get_channel_layer()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(group):
+        async with semaphore:
+            await channel_layer.group_send(group, message)
+
+    await asyncio.gather(*(send(group) for group in groups))
+
+
+def coalesce_events(payloads: List[dict]) -> List[dict]:
+    """Remove notifications made unnecessary by other notifications in the same batch.
+
+    Repeated events about the same content or profile are kept once, at the position of the latest one. Updates of
+    content that is new in the same batch are dropped.
+    """
+    new_ids = {payload["id"] for payload in payloads if payload["event"] == "new"}
+    latest = {}
+    for position, payload in enumerate(payloads):
+        if payload["event"] == "update" and payload["id"] in new_ids:
+            continue
+        latest[(payload["event"], payload.get("id", payload.get("uuid")))] = position
+    return [payloads[position] for position in sorted(latest.values())]
+
+
+def notify_listeners(obj: Union[Content, Profile], keys: Set, event: str = "new") -> None:
+    """Send out to listening consumers.
+
+    Only keys with live websocket channels are sent to. They are sent to in one batch, instead of bridging to the
+    event loop separately for each key. Replayable events are also logged for recently disconnected websockets.
+    """
+    if not keys:
+        return
 
     payload = {"event": event}
     if event == 'profile':
@@ -19,33 +229,90 @@ def notify_listeners(obj: Union[Content, Profile], keys: Set, event: str = "new"
     else:
         payload.update({"id": obj.id, "parentId": getattr(obj.parent, 'id', None)})
 
+    if event in REPLAYABLE_EVENTS:
+        event_id, keys = log_event(keys, payload)
+        payload["eventId"] = event_id
+    else:
+        keys = get_live_groups(keys)
+    if not keys:
+        return
+
     data = {"type": "notification", "payload": payload}
-    for key in keys:
-        async_to_sync(channel_layer.group_send)(key, data)
+    async_to_sync(group_send_many)(keys, data)
 
 
-class StreamConsumer(WebsocketConsumer):
-    def connect(self):
-        async_to_sync(self.channel_layer.group_add)(self.get_stream_name(), self.channel_name)
-        user = self.scope["user"]
-        if user and user.is_authenticated:
-            user.mark_recently_active()
-        super().connect()
+class StreamConsumer(AsyncWebsocketConsumer):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Notifications waiting to be sent in the current coalescing window
+        self.pending = []
+        self.flush_task = None
+
+    async def connect(self):
+        await self.channel_layer.group_add(self.get_stream_name(), self.channel_name)
+        await self.heartbeat()
+        await super().connect()
 
-    def disconnect(self, code):
-        async_to_sync(self.channel_layer.group_discard)(self.get_stream_name(), self.channel_name)
-        super().disconnect(code)
+    async def disconnect(self, code):
+        if self.flush_task:
+            self.flush_task.cancel()
+        await self.channel_layer.group_discard(self.get_stream_name(), self.channel_name)
+        await mark_absent(self.get_stream_name(), self.channel_name)
+        await super().disconnect(code)
 
     def get_stream_name(self) -> str:
         return f"streams_{self.scope['url_route']['kwargs']['stream']}"
 
-    def notification(self, event):
-        self.send(text_data=json.dumps(event["payload"]))
+    async def heartbeat(self):
+        """Mark the websocket as listening to the stream, and the user as recently active unless recently done."""
+        user = self.scope["user"]
+        if not user or not user.is_authenticated or not activity_throttle.should_mark(user.id):
+            user = None
+        await mark_present(self.get_stream_name(), self.channel_name, user)
+
+    async def notification(self, event):
+        if not settings.SOCIALHOME_STREAMS_NOTIFICATION_WINDOW_MS:
+            await self.send(text_data=json.dumps(event["payload"]))
+            return
+        self.pending.append(event["payload"])
+        if not self.flush_task:
+            self.flush_task = asyncio.ensure_future(self.flush_later())
+
+    async def flush_later(self):
+        """Send the notifications received during the coalescing window."""
+        await asyncio.sleep(settings.SOCIALHOME_STREAMS_NOTIFICATION_WINDOW_MS / 1000)
+        payloads, self.pending, self.flush_task = self.pending, [], None
+        await self.send_events(payloads)
 
-    def receive(self, text_data=None, bytes_data=None):
+    async def send_events(self, payloads: List[dict]):
+        """Send notifications, as one batch message if coalescing them is enabled."""
+        if not settings.SOCIALHOME_STREAMS_NOTIFICATION_WINDOW_MS:
+            for payload in payloads:
+                await self.send(text_data=json.dumps(payload))
+            return
+        coalesced = coalesce_events(payloads)
+        if len(coalesced) == 1:
+            await self.send(text_data=json.dumps(coalesced[0]))
+            return
+        message = {"event": "batch", "events": coalesced}
+        event_ids = [payload["eventId"] for payload in payloads if "eventId" in payload]
+        if event_ids:
+            # Events dropped from the batch can be newer than the ones kept
+            message["eventId"] = max(event_ids, key=parse_event_id)
+        await self.send(text_data=json.dumps(message))
+
+    async def receive(self, text_data=None, bytes_data=None):
         data = json.loads(text_data)
         if data.get("event") == "ping":
-            self.send(text_data=json.dumps({"event":"pong"}, separators=(',', ':')))
-            user = self.scope["user"]
-            if user and user.is_authenticated:
-                user.mark_recently_active()
+            await self.send(text_data=json.dumps({"event":"pong"}, separators=(',', ':')))
+            await self.heartbeat()
+        elif data.get("event") == "resume":
+            await self.replay(data.get("eventId"))
+
+    async def replay(self, event_id):
+        """Send the notifications missed after the given event, or ask the client to resync if they can't be."""
+        events = await get_missed_events(self.get_stream_name(), event_id)
+        if events is None:
+            await self.send(text_data=json.dumps({"event": "resync"}))
+        elif events:
+            await self.send_events(events)
@@ -0,0 +1,43 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from socialhome.streams.socket_benchmark import DEFAULT_PARAMETERS, run_socket_benchmark
+
+
+class Command(BaseCommand):
+    help = "Load test the stream websockets by opening many idle websockets to an ASGI server process and " \
+           "sending heartbeats from them. Needs Redis and the database of the settings used."
+
+    def add_arguments(self, parser):
+        for name, default in DEFAULT_PARAMETERS.items():
+            parser.add_argument(
+                "--%s" % name.replace("_", "-"), dest=name, type=type(default), default=default,
+                help="Defaults to %s." % default,
+            )
+        parser.add_argument(
+            "--stream", dest="stream", default="public",
+            help="Stream to open the websockets to. Defaults to public.",
+        )
+        parser.add_argument(
+            "--output", dest="output", default=None,
+            help="File to save the results to.",
+        )
+
+    def handle(self, *args, **options):
+        parameters = {name: options[name] for name in DEFAULT_PARAMETERS}
+        results = run_socket_benchmark(stream=options["stream"], **parameters)
+
+        connect, ping, server = results["connect"], results["ping"], results["server"]
+        print(f"Opened {results['sockets']} websockets: p50 {connect['p50_ms']} ms, p95 {connect['p95_ms']} ms, "
+              f"{connect['per_second']} per second")
+        print(f"Server process: {server['kb_per_socket']} KB per websocket, {server['threads_before']} threads "
+              f"before and {server['threads_after']} threads after opening")
+        print(f"Ping round trip: p50 {ping['p50_ms']} ms, p95 {ping['p95_ms']} ms, max {ping['max_ms']} ms, "
+              f"{results['redis_commands_per_ping']} Redis commands and {server['cpu_ms_per_ping']} ms of server CPU "
+              f"time per ping")
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+                f.write("\n")
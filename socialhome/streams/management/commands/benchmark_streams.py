@@ -0,0 +1,83 @@
+import json
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from socialhome.streams.benchmark import DEFAULT_PARAMETERS, compare_results, run_benchmark
+
+DEFAULT_BASELINE = os.path.join(str(settings.ROOT_DIR), "benchmarks", "streams.json")
+
+
+class Command(BaseCommand):
+    help = "Benchmark adding content to streams and reading the streams API with a synthetic social graph. " \
+           "The data is created in a transaction that is rolled back. Needs the stub tasks broker, for example " \
+           "run with TEST=1 in a development environment."
+
+    def add_arguments(self, parser):
+        for name, default in DEFAULT_PARAMETERS.items():
+            parser.add_argument(
+                "--%s" % name.replace("_", "-"), dest=name, type=type(default), default=default,
+                help="Defaults to %s." % default,
+            )
+        parser.add_argument(
+            "--baseline", dest="baseline", default=DEFAULT_BASELINE,
+            help="Baseline results file to compare to. Defaults to benchmarks/streams.json.",
+        )
+        parser.add_argument(
+            "--save-baseline", dest="save_baseline", action="store_true",
+            help="Save the results as the new baseline.",
+        )
+        parser.add_argument(
+            "--output", dest="output", default=None,
+            help="File to save the results to.",
+        )
+        parser.add_argument(
+            "--max-regression", dest="max_regression", type=float, default=None,
+            help="Fail if any p95 latency is slower than the baseline by more than this percentage.",
+        )
+
+    def handle(self, *args, **options):
+        parameters = {name: options[name] for name in DEFAULT_PARAMETERS}
+        try:
+            results = run_benchmark(**parameters)
+        except ValueError as ex:
+            raise CommandError(str(ex))
+
+        fanout = results["fanout"]
+        print(f"Fan-out of {fanout['content']} content: p50 {fanout['p50_ms']} ms, p95 {fanout['p95_ms']} ms, "
+              f"{fanout['redis_commands_per_content']} Redis commands and {fanout['queries_per_content']} "
+              f"queries per content")
+        for name, values in results["endpoints"].items():
+            print(f"{name}: p50 {values['p50_ms']} ms, p95 {values['p95_ms']} ms, {values['queries']} queries")
+        for name, values in results["queries"].items():
+            print(f"{name} query: p50 {values['p50_ms']} ms, p95 {values['p95_ms']} ms database execution time"
+                  f"{', removes duplicates' if values['distinct'] else ''}")
+
+        if options["output"]:
+            self.save(options["output"], results)
+
+        regressions = []
+        if os.path.exists(options["baseline"]) and not options["save_baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)
+            if baseline["parameters"] != results["parameters"]:
+                print("Warning: baseline was run with different parameters")
+            print(f"Compared to baseline of version {baseline['version']} (p95):")
+            for name, old, new, change in compare_results(results, baseline):
+                print(f"{name}: {old} ms -> {new} ms ({'n/a' if change is None else '%+.1f%%' % change})")
+                if options["max_regression"] is not None and change is not None and change > options["max_regression"]:
+                    regressions.append(name)
+
+        if options["save_baseline"]:
+            self.save(options["baseline"], results)
+            print(f"Saved baseline to {options['baseline']}")
+
+        if regressions:
+            raise CommandError("Regressed more than %s%%: %s" % (options["max_regression"], ", ".join(regressions)))
+
+    def save(self, path, results):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from socialhome.streams.tasks import compact_precache_throughs, get_precache_memory_usage
+
+
+class Command(BaseCommand):
+    help = "Remove throughs that are the same as the content from the stream precaches. " \
+           "Reports the memory used by the stream precaches before and after."
+
+    def handle(self, *args, **options):
+        precaches_before, throughs_before = get_precache_memory_usage()
+        removed = compact_precache_throughs()
+        precaches_after, throughs_after = get_precache_memory_usage()
+        before = precaches_before + throughs_before
+        after = precaches_after + throughs_after
+        print(f"Removed {removed} throughs")
+        print(f"Precaches: {precaches_before} bytes before, {precaches_after} bytes after")
+        print(f"Throughs: {throughs_before} bytes before, {throughs_after} bytes after")
+        if before:
+            print(f"Total: {before} bytes before, {after} bytes after ({100 - after * 100 // before}% saved)")
@@ -0,0 +1,75 @@
+import datetime
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Q
+from django.utils.timezone import make_aware
+
+from socialhome.streams.enums import StreamType
+from socialhome.streams.streams import (
+    get_precache_users_qs, get_precache_streams, rebuild_precaches, rebuild_precaches_for_users,
+    CACHED_STREAM_CLASSES)
+
+
+class Command(BaseCommand):
+    help = "Rebuild the stream precaches of active users from the database. Users are handled in batches, " \
+           "in parallel processes."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', dest='users', action='append', default=[],
+            help='Username to rebuild precaches for. Can be given several times. Defaults to all active users.',
+        )
+        parser.add_argument(
+            '--stream-type', dest='stream_types', action='append', default=[],
+            choices=[cls.stream_type.value for cls in CACHED_STREAM_CLASSES],
+            help='Stream type to rebuild. Can be given several times. Defaults to all precached streams.',
+        )
+        parser.add_argument(
+            '--since', dest='since', default=None,
+            help='Only rebuild for users that have logged in or joined since this date (YYYY-MM-DD).',
+        )
+        parser.add_argument(
+            '--processes', dest='processes', type=int, default=os.cpu_count(),
+            help='Amount of processes to use. Defaults to the amount of CPU\'s.',
+        )
+        parser.add_argument(
+            '--chunk-size', dest='chunk_size', type=int, default=100,
+            help='Amount of users per batch, defaults to 100.',
+        )
+
+    def handle(self, *args, **options):
+        stream_types = [StreamType(value) for value in options["stream_types"]]
+        qs = get_precache_users_qs()
+        if options["users"]:
+            qs = qs.filter(username__in=options["users"])
+        if options["since"]:
+            since = make_aware(datetime.datetime.strptime(options["since"], "%Y-%m-%d"))
+            qs = qs.filter(Q(last_login__gte=since) | Q(date_joined__gte=since))
+        user_ids = list(qs.order_by("id").values_list("id", flat=True))
+        chunk_size = options["chunk_size"]
+        chunks = [user_ids[i:i + chunk_size] for i in range(0, len(user_ids), chunk_size)]
+        started = time.monotonic()
+
+        keys = 0
+        if user_ids and not options["users"]:
+            # Precaches shared by all users, these are the same for any user
+            user = qs.select_related("profile").first()
+            keys += rebuild_precaches(get_precache_streams(user, stream_types), shared=True)
+
+        if options["processes"] > 1 and len(chunks) > 1:
+            # Don't share the database connections with the worker processes
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options["processes"]) as executor:
+                for written in executor.map(rebuild_precaches_for_users, chunks, [stream_types] * len(chunks)):
+                    keys += written
+        else:
+            for chunk in chunks:
+                keys += rebuild_precaches_for_users(chunk, stream_types)
+
+        elapsed = max(time.monotonic() - started, 0.001)
+        print(f"Rebuilt {keys} precaches for {len(user_ids)} users in {elapsed:.1f} seconds")
+        print(f"Throughput: {len(user_ids) / elapsed:.1f} users/sec, {keys / elapsed:.1f} keys/sec")
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.26 on 2026-10-18 06:32
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('content', '0047_alter_content_sensitive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, verbose_name='Precache key')),
+                ('through', models.PositiveIntegerField(verbose_name='Through content id')),
+                ('score', models.BigIntegerField(verbose_name='Score')),
+                ('content', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='content.content', verbose_name='Content')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['key', '-score'], name='streams_timeline_key_score')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='timelineentry',
+            constraint=models.UniqueConstraint(fields=('key', 'content'), name='streams_timelineentry_key_content'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class TimelineEntry(models.Model):
+    """Durable copy of a content in a stream precache.
+
+    Stream precaches live in Redis. If ``SOCIALHOME_STREAMS_DURABLE_TIMELINES`` is enabled, content added to the
+    precaches is also stored here, to fill the precaches again if they have been lost from Redis.
+    """
+    # Precache key, see ``BaseStream.key``
+    key = models.CharField(_("Precache key"), max_length=255)
+    content = models.ForeignKey(
+        "content.Content", on_delete=models.CASCADE, verbose_name=_("Content"), related_name="+",
+    )
+    through = models.PositiveIntegerField(_("Through content id"))
+    score = models.BigIntegerField(_("Score"))
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["key", "content"], name="%(app_label)s_%(class)s_key_content"),
+        ]
+        indexes = [
+            models.Index(fields=["key", "-score"], name="streams_timeline_key_score"),
+        ]
+
+    def __str__(self):
+        return f"{self.key}: {self.content_id}"
@@ -0,0 +1,197 @@
+"""Stream websocket load test.
+
+Runs the ASGI application in an uvicorn server process and opens many idle stream websockets to it, some of them
+authenticated. Measures the memory and threads of the server process per socket, and the round trip time and
+Redis commands of the ``ping`` heartbeats. The users and sessions created are removed at the end.
+"""
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from importlib import import_module
+from uuid import uuid4
+
+import psutil
+import websockets
+from django.conf import settings
+from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY
+
+from socialhome import __version__
+from socialhome.streams.benchmark import RedisCommandCounter, summarize
+from socialhome.streams.consumers import PRESENCE_KEY_PREFIX
+from socialhome.users.models import User
+from socialhome.utils import get_redis_connection
+
+DEFAULT_PARAMETERS = {
+    # Amount of websockets to open
+    "sockets": 1000,
+    # Amount of users the authenticated websockets are opened for, zero for only anonymous websockets
+    "users": 50,
+    # Ratio of the websockets that are authenticated
+    "authenticated_ratio": 0.5,
+    # Amount of times to send a ping from all the websockets
+    "ping_rounds": 3,
+    # Maximum amount of websockets to open at the same time
+    "connect_concurrency": 100,
+}
+
+# Seconds to wait for the server process to start listening
+SERVER_START_TIMEOUT = 30
+# Seconds to wait for the server process to finish handling the last messages before measuring
+SETTLE_SECONDS = 1
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(port):
+    """Start an uvicorn server process for the ASGI application, with the current settings."""
+    env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get("DJANGO_SETTINGS_MODULE", "config.settings.local"))
+    process = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "config.asgi:application", "--host", "127.0.0.1", "--port", str(port),
+            "--ws", "websockets", "--lifespan", "off", "--log-level", "warning",
+        ],
+        cwd=str(settings.ROOT_DIR), env=env,
+    )
+    started = time.monotonic()
+    while time.monotonic() - started < SERVER_START_TIMEOUT:
+        if process.poll() is not None:
+            raise RuntimeError("Server process exited with code %s" % process.returncode)
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("Server process did not start listening in %s seconds" % SERVER_START_TIMEOUT)
+
+
+def create_sessions(prefix, count):
+    """Create users with logged in sessions. Returns the users and the session keys.
+
+    The users are created without profiles, so that nothing is federated about them.
+    """
+    engine = import_module(settings.SESSION_ENGINE)
+    users = User.objects.bulk_create([
+        User(username=f"{prefix}{i}", email=f"{prefix}{i}@example.com") for i in range(count)
+    ])
+    session_keys = []
+    for user in users:
+        session = engine.SessionStore()
+        session[SESSION_KEY] = str(user.id)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        session_keys.append(session.session_key)
+    return users, session_keys
+
+
+def cleanup(users, session_keys, stream):
+    engine = import_module(settings.SESSION_ENGINE)
+    for session_key in session_keys:
+        engine.SessionStore(session_key).delete()
+    keys = [user.activity_key for user in users] + [f"{PRESENCE_KEY_PREFIX}streams_{stream}"]
+    get_redis_connection().delete(*keys)
+    User.objects.filter(id__in=[user.id for user in users]).delete()
+
+
+async def open_sockets(url, headers, concurrency):
+    """Open a websocket for each of the headers. Returns the websockets and the connect timings."""
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = []
+
+    async def connect(extra_headers):
+        async with semaphore:
+            started = time.monotonic()
+            ws = await websockets.connect(url, additional_headers=extra_headers, max_size=None, ping_interval=None)
+            timings.append(time.monotonic() - started)
+            return ws
+
+    return await asyncio.gather(*(connect(extra_headers) for extra_headers in headers)), timings
+
+
+async def ping_all(sockets):
+    """Send a ping from all the websockets at the same time. Returns the pong round trip timings."""
+    async def ping(ws):
+        started = time.monotonic()
+        await ws.send('{"event":"ping"}')
+        while True:
+            if '"pong"' in await ws.recv():
+                return time.monotonic() - started
+
+    return await asyncio.gather(*(ping(ws) for ws in sockets))
+
+
+async def close_sockets(sockets):
+    await asyncio.gather(*(ws.close() for ws in sockets), return_exceptions=True)
+
+
+def run_socket_benchmark(stream="public", **parameters):
+    """Run the load test and return the results."""
+    parameters = {**DEFAULT_PARAMETERS, **parameters}
+    prefix = "socketbench-%s-" % uuid4().hex[:8]
+    port = get_free_port()
+    url = f"ws://127.0.0.1:{port}/ch/streams/{stream}/"
+    users, session_keys = create_sessions(prefix, parameters["users"])
+    authenticated = int(parameters["sockets"] * parameters["authenticated_ratio"]) if session_keys else 0
+    headers = [
+        {"Cookie": f"{settings.SESSION_COOKIE_NAME}={session_keys[i % len(session_keys)]}"} if i < authenticated
+        else {}
+        for i in range(parameters["sockets"])
+    ]
+    server = start_server(port)
+    loop = asyncio.new_event_loop()
+    sockets, warmup = [], []
+    try:
+        process = psutil.Process(server.pid)
+        # Open one websocket first, so that the application has been loaded when measuring the baseline memory
+        warmup, _timings = loop.run_until_complete(open_sockets(url, [{}], 1))
+        loop.run_until_complete(ping_all(warmup))
+        rss_before = process.memory_info().rss
+        threads_before = process.num_threads()
+
+        started = time.monotonic()
+        sockets, connect_timings = loop.run_until_complete(
+            open_sockets(url, headers, parameters["connect_concurrency"]),
+        )
+        connect_seconds = time.monotonic() - started
+        rss_after = process.memory_info().rss
+        threads_after = process.num_threads()
+
+        counter = RedisCommandCounter()
+        ping_timings, redis_commands = [], []
+        cpu_before = sum(process.cpu_times()[:2])
+        with counter.count(redis_commands):
+            for _round in range(parameters["ping_rounds"]):
+                ping_timings.extend(loop.run_until_complete(ping_all(sockets)))
+            # The server handles the heartbeat after replying with the pong
+            time.sleep(SETTLE_SECONDS)
+        cpu_seconds = sum(process.cpu_times()[:2]) - cpu_before
+    finally:
+        loop.run_until_complete(close_sockets(sockets + warmup))
+        loop.close()
+        server.terminate()
+        server.wait()
+        cleanup(users, session_keys, stream)
+
+    pings = len(sockets) * parameters["ping_rounds"]
+    return {
+        "version": __version__,
+        "parameters": parameters,
+        "sockets": len(sockets),
+        "connect": {**summarize(connect_timings), "per_second": round(len(connect_timings) / connect_seconds, 1)},
+        "ping": summarize(ping_timings),
+        "redis_commands_per_ping": round(sum(redis_commands) / max(pings, 1), 2),
+        "server": {
+            "kb_per_socket": round((rss_after - rss_before) / 1024 / max(len(sockets), 1), 1),
+            "threads_before": threads_before,
+            "threads_after": threads_after,
+            "cpu_ms_per_ping": round(cpu_seconds * 1000 / max(pings, 1), 3),
+        },
+    }
@@ -1,19 +1,24 @@
 import datetime
 import logging
 import time
+from operator import itemgetter
 from typing import List, Tuple, Dict
+from uuid import uuid4
 
 from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
-from django.db.models import Case, When, Q
+from django.db.models import Case, When, Q, F, Window
+from django.db.models.functions import RowNumber
 from django.utils.functional import cached_property
 from django.utils.timezone import now
 
 from socialhome.content.enums import ContentType
 from socialhome.content.models import Content
+from socialhome.enums import Visibility
 from socialhome.streams import tasks
 from socialhome.streams.consumers import notify_listeners
 from socialhome.streams.enums import StreamType
+from socialhome.streams.models import TimelineEntry
 from socialhome.users.models import User, Profile
 from socialhome.users.utils import update_profiles
 from socialhome.utils import get_redis_connection
@@ -21,72 +26,451 @@ from socialhome.utils import get_redis_connection
 logger = logging.getLogger("socialhome")
 
 
+# Add a content to a list of stream precaches in one call.
+# Throughs are only stored when they differ from the content, readers default to the content id.
+# Precaches are trimmed to their size limit, removing the throughs of evicted content. Nothing is added to
+# precaches with a zero size limit.
+# KEYS: stream keys, ARGV: content id, through id, score, expiry, size limit per key
+ADD_TO_REDIS_SCRIPT = """
+local added = 0
+for i, key in ipairs(KEYS) do
+    local throughs_key = key .. ":throughs"
+    local size = tonumber(ARGV[4 + i])
+    if redis.call("ZSCORE", key, ARGV[1]) then
+        if ARGV[1] ~= ARGV[2] then
+            redis.call("HSET", throughs_key, ARGV[1], ARGV[2])
+            redis.call("EXPIRE", throughs_key, ARGV[4])
+        end
+    elseif size > 0 then
+        redis.call("ZADD", key, ARGV[3], ARGV[1])
+        redis.call("EXPIRE", key, ARGV[4])
+        if ARGV[1] ~= ARGV[2] then
+            redis.call("HSET", throughs_key, ARGV[1], ARGV[2])
+            redis.call("EXPIRE", throughs_key, ARGV[4])
+        end
+        added = added + 1
+        for _, evicted in ipairs(redis.call("ZRANGE", key, 0, -size - 1)) do
+            redis.call("HDEL", throughs_key, evicted)
+        end
+        redis.call("ZREMRANGEBYRANK", key, 0, -size - 1)
+    end
+end
+return added
+"""
+# Start of the scripts reading precaches. Merges the stream keys into the temporary key given first, if there is
+# more than one, so that they can be read as one sorted set.
+# KEYS: merge key, stream keys
+MERGE_CACHED_KEYS_SCRIPT = """
+local stream_keys = {unpack(KEYS, 2)}
+local key = stream_keys[1]
+if #stream_keys > 1 then
+    key = KEYS[1]
+    local args = {"ZUNIONSTORE", key, #stream_keys}
+    for _, stream_key in ipairs(stream_keys) do
+        table.insert(args, stream_key)
+    end
+    table.insert(args, "AGGREGATE")
+    table.insert(args, "MAX")
+    redis.call(unpack(args))
+end
+"""
+# Get a page of a precache, merging several precaches first if given.
+# Returns the content ids, their throughs, whether there is more unfetched content before ``first id`` and
+# the stream keys that don't exist.
+# KEYS: merge key, stream keys, ARGV: last id, first id, page size
+GET_CACHED_PAGE_SCRIPT = MERGE_CACHED_KEYS_SCRIPT + """
+local function result(ids, unfetched)
+    if #stream_keys > 1 then
+        redis.call("DEL", key)
+    end
+    local missing = {}
+    for _, stream_key in ipairs(stream_keys) do
+        if redis.call("EXISTS", stream_key) == 0 then
+            table.insert(missing, stream_key)
+        end
+    end
+    local throughs = {}
+    if #ids == 0 then
+        return {ids, throughs, unfetched, missing}
+    end
+    for _, stream_key in ipairs(stream_keys) do
+        local key_throughs = redis.call("HMGET", stream_key .. ":throughs", unpack(ids))
+        for i = 1, #ids do
+            throughs[i] = throughs[i] or key_throughs[i]
+        end
+    end
+    for i, id in ipairs(ids) do
+        throughs[i] = throughs[i] or id
+    end
+    return {ids, throughs, unfetched, missing}
+end
+
+local page_size = tonumber(ARGV[3])
+local first_index = 0
+local last_index = page_size - 1
+local unfetched = 0
+
+if ARGV[1] ~= "" then
+    local rank = redis.call("ZREVRANK", key, ARGV[1])
+    if not rank or rank == 0 then
+        return result({}, unfetched)
+    end
+    first_index = rank + 1
+    last_index = first_index + page_size - 1
+end
+
+if ARGV[2] ~= "" then
+    local rank = redis.call("ZREVRANK", key, ARGV[2])
+    if rank then
+        if rank > 0 then
+            last_index = rank - 1
+            if last_index - first_index > page_size then
+                unfetched = 1
+            end
+            last_index = math.min(last_index, first_index + page_size - 1)
+        else
+            -- Nothing is newer than the first id
+            return result({}, unfetched)
+        end
+    else
+        last_index = first_index + page_size - 1
+        unfetched = 1
+    end
+end
+
+return result(redis.call("ZREVRANGE", key, first_index, last_index), unfetched)
+"""
+# Count the content in the precaches between two content ids, newest first, without fetching them.
+# Positions are ranks in the precache, merging several precaches first if given, like ``GET_CACHED_PAGE_SCRIPT``.
+# Returns -1 if an id is not in the precaches.
+# KEYS: merge key, stream keys, ARGV: last id, first id
+COUNT_CACHED_SCRIPT = MERGE_CACHED_KEYS_SCRIPT + """
+local first = redis.call("ZREVRANK", key, ARGV[2])
+local last = -1
+if ARGV[1] ~= "" then
+    last = redis.call("ZREVRANK", key, ARGV[1])
+end
+if #stream_keys > 1 then
+    redis.call("DEL", key)
+end
+if not first or not last then
+    return -1
+end
+return math.max(first - last - 1, 0)
+"""
+# Temporary key to merge precaches into, only used within a single script call
+CACHED_PAGE_MERGE_KEY = "sh:tmp:streams:merged"
+# Markers of precaches recently filled from the durable timelines, and their expiry
+HYDRATED_KEY_PREFIX = "sh:timelines:hydrated:"
+HYDRATED_KEY_EXPIRY = 60*60
+# Amount of keys to write per script call, to avoid blocking Redis for too long
+ADD_TO_REDIS_BATCH_SIZE = 1000
+# Expiry of the fan-out chunk tracking keys
+FANOUT_KEY_EXPIRY = 60*60*24
+# Sorted set of profile ID's whose content is merged into followed streams on read, scored by when the profile
+# was last found to be fanned out on read. Members older than the precache expiry are pruned.
+FANOUT_ON_READ_PROFILES_KEY = "sh:fanout:on_read_profiles:active"
+# Cached amount of local followers per profile, used to decide whether to fan out on read, and its expiry
+FANOUT_ON_READ_FOLLOWERS_KEY_PREFIX = "sh:fanout:on_read_followers:"
+FANOUT_ON_READ_FOLLOWERS_EXPIRY = 60*60
+# Sorted sets per profile of the notify keys of streams that recently displayed the profile, scored by time
+PROFILE_GROUPS_KEY_PREFIX = "sh:notify:profile_groups:"
+# How long a stream is considered to display a profile, same as the default channel layer group expiry
+PROFILE_GROUPS_EXPIRY = 60*60*24
+
+
 def add_to_redis(content, through, keys):
     """Add content to a list of Redis ordered sets.
 
+    The keys are written server side in batches, with one script call per batch.
+
+    Content is only added to keys that don't have it yet. This stops shares popping up more than once,
+    for example. If the content is already in a key and the through is not the content, the through is updated.
+    Throughs are only stored when they are not the content itself.
+
+    Each key is trimmed to the precache size of its user activity, so the precaches stay bounded between
+    grooming runs.
+
     :param content: Content object to add
     :param through: Content through object. For example on shares, this is the linked share content object
     :param keys: List of keys to add to
+    :return: Amount of keys the content was added to
     """
     if not keys:
-        return
+        return 0
     r = get_redis_connection()
+    script = r.register_script(ADD_TO_REDIS_SCRIPT)
+    score = int(time.time())
+    args = [content.id, through.id, score, settings.REDIS_DEFAULT_EXPIRY]
+    user_activities = {}
+    tasks.load_user_activities(user_activities, keys)
+    added = 0
+    durable_keys = []
+    for i in range(0, len(keys), ADD_TO_REDIS_BATCH_SIZE):
+        batch = keys[i:i + ADD_TO_REDIS_BATCH_SIZE]
+        sizes = [tasks.get_precache_trim_size(user_activities, key) for key in batch]
+        added += script(keys=batch, args=args + sizes)
+        durable_keys += [key for key, size in zip(batch, sizes) if size]
+    logger.info("add_to_redis - added content %s to %s of %s keys", content.id, added, len(keys))
+    if settings.SOCIALHOME_STREAMS_DURABLE_TIMELINES:
+        add_to_timelines(content, through, durable_keys, score)
+    return added
+
+
+def add_to_timelines(content, through, keys, score):
+    """Store content added to precaches in the durable timelines.
+
+    Like the precaches, the timelines written to are trimmed to the precache size.
+
+    :param content: Content object to add
+    :param through: Content through object
+    :param keys: List of precache keys to add to
+    :param score: Score the content was added to the precaches with
+    """
+    entries = [TimelineEntry(key=key, content_id=content.id, through=through.id, score=score) for key in keys]
+    if through.id != content.id:
+        # Same as the precaches, update the through if the content is already there
+        TimelineEntry.objects.bulk_create(
+            entries, batch_size=ADD_TO_REDIS_BATCH_SIZE, update_conflicts=True, unique_fields=["key", "content"],
+            update_fields=["through"],
+        )
+    else:
+        TimelineEntry.objects.bulk_create(entries, batch_size=ADD_TO_REDIS_BATCH_SIZE, ignore_conflicts=True)
+    for i in range(0, len(keys), ADD_TO_REDIS_BATCH_SIZE):
+        tasks.prune_timelines(keys[i:i + ADD_TO_REDIS_BATCH_SIZE])
+
+
+def hydrate_from_timelines(r, keys):
+    """Fill precaches that have been lost from Redis from the durable timelines.
+
+    Each precache is filled at most once per ``HYDRATED_KEY_EXPIRY``, so that precaches that are empty
+    also in the database don't cause a query on each read.
+
+    :param r: Redis connection
+    :param keys: List of precache keys that don't exist in Redis
+    :return: True if any precache was filled
+    """
+    pipe = r.pipeline(transaction=False)
     for key in keys:
-        rank = r.zrank(key, content.id)
-        if rank:
-            # If through is not content, update
-            if content.id != through.id:
-                throughs_key = BaseStream.get_throughs_key(key)
-                r.hset(throughs_key, content.id, through.id)
-        else:
-            # Only add if not in the set already
-            # This stops shares popping up more than once, for example
-            r.zadd(key, {content.id: int(time.time())})
-            r.expire(key, settings.REDIS_DEFAULT_EXPIRY)
-            throughs_key = BaseStream.get_throughs_key(key)
-            r.hset(throughs_key, content.id, through.id)
-            r.expire(throughs_key, settings.REDIS_DEFAULT_EXPIRY)
+        pipe.set(f"{HYDRATED_KEY_PREFIX}{key}", 1, nx=True, ex=HYDRATED_KEY_EXPIRY)
+    keys = [key for key, marked in zip(keys, pipe.execute()) if marked]
+    if not keys:
+        return False
+    entries = TimelineEntry.objects.filter(key__in=keys).annotate(
+        rank=Window(RowNumber(), partition_by=F("key"), order_by=F("score").desc()),
+    ).filter(rank__lte=settings.SOCIALHOME_STREAMS_PRECACHE_SIZE).values_list("key", "content_id", "through", "score")
+    pipe = r.pipeline(transaction=False)
+    filled = set()
+    for key, content_id, through, score in entries:
+        pipe.zadd(key, {content_id: score})
+        if through != content_id:
+            pipe.hset(BaseStream.get_throughs_key(key), content_id, through)
+            pipe.expire(BaseStream.get_throughs_key(key), settings.REDIS_DEFAULT_EXPIRY)
+        filled.add(key)
+    for key in filled:
+        pipe.expire(key, settings.REDIS_DEFAULT_EXPIRY)
+    pipe.execute()
+    logger.info("hydrate_from_timelines - filled %s of %s precaches", len(filled), len(keys))
+    return bool(filled)
 
 
 def add_to_streams_for_users(content_id, through_id, acting_profile_id):
-    """Add content to all user streams of one type and do notification of streams.
+    """Add content to all user streams and do notification of streams.
 
     Excludes author of content.
 
-    This function is designed to be queued to RQ.
+    Users are split into chunks of ``SOCIALHOME_STREAMS_FANOUT_CHUNK_SIZE`` by user ID range. If there is more
+    than one chunk, each chunk is queued as a separate job, so that several workers can share the fan-out.
+
+    This function is designed to be queued to the task runner.
+    """
+    objects = get_fanout_objects(content_id, through_id, acting_profile_id)
+    if not objects:
+        return
+    content, through, acting_profile = objects
+    qs = get_precache_users_qs(acting_profile)
+    user_ids = list(qs.order_by("id").values_list("id", flat=True))
+    chunk_size = settings.SOCIALHOME_STREAMS_FANOUT_CHUNK_SIZE
+    if len(user_ids) <= chunk_size:
+        notify_keys = add_to_streams_for_users_qs(content, through, acting_profile, qs)
+        notify_listeners(content, notify_keys)
+        return
+    chunks = [
+        (user_ids[i], user_ids[min(i + chunk_size, len(user_ids)) - 1]) for i in range(0, len(user_ids), chunk_size)
+    ]
+    fanout_key = f"sh:fanout:{uuid4()}"
+    r = get_redis_connection()
+    r.set(fanout_key, len(chunks), ex=FANOUT_KEY_EXPIRY)
+    for first_user_id, last_user_id in chunks:
+        tasks.add_to_streams_for_users_chunk.send(
+            content_id, through_id, acting_profile_id, first_user_id, last_user_id, fanout_key,
+        )
+    logger.info(
+        "Stream.add_to_streams_for_users - queued fan-out %s of content %s for %s users in %s chunks",
+        fanout_key, content_id, len(user_ids), len(chunks),
+    )
+
+
+def add_to_streams_for_users_chunk(content_id, through_id, acting_profile_id, first_user_id, last_user_id,
+                                   fanout_key):
+    """Add content to the user streams of one chunk of a fan-out and do notification of streams.
+
+    The stream keys are written on every run, but notification of the chunk is done only once, even if the
+    job is retried. When the last chunk of the fan-out is done, the fan-out is marked as completed.
+
+    This function is designed to be queued to the task runner.
+    """
+    objects = get_fanout_objects(content_id, through_id, acting_profile_id)
+    if not objects:
+        return
+    content, through, acting_profile = objects
+    qs = get_precache_users_qs(acting_profile).filter(id__gte=first_user_id, id__lte=last_user_id)
+    notify_keys = add_to_streams_for_users_qs(content, through, acting_profile, qs)
+    r = get_redis_connection()
+    if not r.set(f"{fanout_key}:{first_user_id}", 1, nx=True, ex=FANOUT_KEY_EXPIRY):
+        logger.info(
+            "Stream.add_to_streams_for_users_chunk - chunk %s of fan-out %s already done, skipping notification",
+            first_user_id, fanout_key,
+        )
+        return
+    notify_listeners(content, notify_keys)
+    if r.decr(fanout_key) == 0:
+        r.delete(fanout_key)
+        logger.info("Stream.add_to_streams_for_users_chunk - fan-out %s completed", fanout_key)
+
+
+def add_to_streams_for_users_qs(content, through, acting_profile, qs):
+    """Add content to the streams of the users in the queryset.
+
+    :return: Set of notify keys to notify for the users
+    """
+    users = list(qs)
+    cache_keys, notify_keys = get_fanout_keys(
+        content, acting_profile, users, through.content_type == ContentType.SHARE,
+    )
+    add_to_redis(content, through, cache_keys)
+    return notify_keys
+
+
+def get_fanout_objects(content_id, through_id, acting_profile_id):
+    """Get the content, through and acting profile objects of a fan-out.
+
+    :return: Tuple of Content, Content and Profile, or None if any of them doesn't exist anymore
     """
     try:
         content = Content.objects.get(id=content_id)
     except Content.DoesNotExist:
-        logger.warning("Stream.add_to_streams_for_users - content %s does not exist!", content_id)
+        logger.warning("Stream.get_fanout_objects - content %s does not exist!", content_id)
         return
     try:
         through = Content.objects.get(id=through_id)
     except Content.DoesNotExist:
-        logger.warning("Stream.add_to_streams_for_users - through content %s does not exist!", through_id)
+        logger.warning("Stream.get_fanout_objects - through content %s does not exist!", through_id)
         return
     try:
         acting_profile = Profile.objects.select_related("user").get(id=acting_profile_id)
     except Profile.DoesNotExist:
-        logger.warning("Stream.add_to_streams_for_users - acting profile %s does not exist!", acting_profile_id)
+        logger.warning("Stream.get_fanout_objects - acting profile %s does not exist!", acting_profile_id)
         return
+    return content, through, acting_profile
 
-    qs = get_precache_users_qs(acting_profile)
+
+def get_fanout_keys(content, acting_profile, users, is_share):
+    """Get the cache and notify keys the content should be added to, for a group of users.
+
+    Set based equivalent of calling ``check_and_add_to_keys`` for each stream class and user. Each stream
+    class resolves its target streams for all the users with a few queries, so the amount of queries
+    does not depend on the amount of users.
+
+    :param content: The Content object that we're checking for.
+    :param acting_profile: The Profile object that caused this check.
+    :param users: List of User objects to check for.
+    :param is_share: Boolean whether this is a shared content.
+    :return: Tuple of list of cache keys and set of notify keys
+    """
     cache_keys = []
+    added_cache_keys = set()
     notify_keys = set()
+    eligibility = ContentEligibility(content)
+    if content.content_type == ContentType.REPLY:
+        root_eligibility = ContentEligibility(content.root_parent)
+    active_ids = User.get_recently_active_ids(user.id for user in users)
+    active_users = [user for user in users if user.id in active_ids]
     for stream_cls in ALL_STREAMS:
-        counter = 0
-        # Cache for each active user`
-        for user in qs.iterator():
-            counter += 1
-            check_and_add_to_keys(stream_cls, user, content, cache_keys, acting_profile, notify_keys,
-                                  through.content_type == ContentType.SHARE)
+        # Don't check users we're not intending to cache for and also not intending to notify
+        stream_users = users if stream_cls in CACHED_STREAM_CLASSES else active_users
+        if not stream_users:
+            continue
+        for stream in stream_cls.get_fanout_streams(eligibility, stream_users, acting_profile):
+            if stream.should_cache_stream(stream_cls, stream.user):
+                key = stream.get_cache_key(content)
+                if key not in added_cache_keys:
+                    # Shared precaches are added to only once
+                    added_cache_keys.add(key)
+                    cache_keys.append(key)
+            # TODO: fix this when sharing replies will be permitted
+            if not (is_share and acting_profile.user_id == stream.user.id) and stream.user.id in active_ids:
+                notify_keys.add(stream.notify_key)
+        # Dynamic update of the reply_count
+        if content.content_type == ContentType.REPLY:
+            for stream in stream_cls.get_fanout_streams(
+                eligibility, stream_users, acting_profile, checked=root_eligibility,
+            ):
+                notify_keys.add(stream.notify_key)
         logger.info(
-            "Stream.add_to_streams_for_users - checked stream %s for %s users, adding to %s cache keys",
-            stream_cls.__name__, counter, len(cache_keys),
+            "Stream.get_fanout_keys - checked stream %s for %s users, adding to %s cache keys",
+            stream_cls.__name__, len(stream_users), len(cache_keys),
         )
-    add_to_redis(content, through, cache_keys)
-    notify_listeners(content, notify_keys)
+    return cache_keys, notify_keys
+
+
+class ContentEligibility:
+    """User independent facts about a content, used to find the streams it belongs to.
+
+    Evaluated once per content in a fan-out and shared by all the stream classes and users, so that only the
+    checks that depend on the users hit the database.
+    """
+    def __init__(self, content):
+        self.content = content
+
+    @cached_property
+    def author_user_id(self):
+        return self.content.author.user_id
+
+    @cached_property
+    def is_top_level(self):
+        return self.content.content_type == ContentType.CONTENT
+
+    @cached_property
+    def limited_user_ids(self):
+        """ID's of the users the content has been limited to."""
+        if self.content.visibility != Visibility.LIMITED:
+            return set()
+        return set(
+            self.content.limited_visibilities.filter(user__isnull=False).values_list("user_id", flat=True),
+        )
+
+    @cached_property
+    def sharer_ids(self):
+        """ID's of the profiles that have shared the content."""
+        return set(self.content.shares.values_list("author_id", flat=True))
+
+    @cached_property
+    def tags(self):
+        return list(self.content.tags.all())
+
+    def get_visible_user_ids(self, user_ids):
+        """Get the ID's of the given users that the content is visible to.
+
+        Mirrors logic in ``ContentQuerySet.visible_for_user`` for a group of authenticated users.
+
+        :param user_ids: Iterable of User ID's to check.
+        :return: set
+        """
+        user_ids = set(user_ids)
+        if self.content.visibility in (Visibility.PUBLIC, Visibility.SITE):
+            return user_ids
+        return ({self.author_user_id} | self.limited_user_ids) & user_ids
 
 
 def check_and_add_to_keys(stream_cls, user, content, cache_keys, acting_profile, notify_keys, is_share):
@@ -112,7 +496,9 @@ def check_and_add_to_keys(stream_cls, user, content, cache_keys, acting_profile,
     for stream in streams:
         if stream.should_stream_content(content):
             if stream.should_cache_stream(stream_cls, user):
-                cache_keys.append(stream.key)
+                key = stream.get_cache_key(content)
+                if key not in cache_keys:
+                    cache_keys.append(key)
             # TODO: fix this when sharing replies will be permitted
             if not (is_share and acting_profile == getattr(user, "profile", None)) and user.recently_active:
                 notify_keys.add(stream.notify_key)
@@ -122,8 +508,7 @@ def check_and_add_to_keys(stream_cls, user, content, cache_keys, acting_profile,
                 notify_keys.add(stream.notify_key)
 
 
-
-def get_precache_users_qs(acting_profile):
+def get_precache_users_qs(acting_profile=None):
     """
     Get User queryset for precaching.
 
@@ -133,17 +518,128 @@ def get_precache_users_qs(acting_profile):
     :return: QuerySet
     """
     check_time = now() - datetime.timedelta(days=settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS)
-    qs = User.objects.filter(is_active=True).filter(Q(last_login__gte=check_time) | Q(date_joined__gte=check_time))
-    if acting_profile.is_local:
+    qs = User.objects.filter(is_active=True).filter(
+        Q(last_login__gte=check_time) | Q(date_joined__gte=check_time),
+    ).select_related("profile")
+    if acting_profile and acting_profile.is_local:
         qs = qs.exclude(id=acting_profile.user_id)
     return qs
 
 
+def get_precache_streams(user, stream_types=None):
+    """Get the precached streams of a user.
+
+    Tag streams are included for the tags the user follows.
+
+    :param user: User to get the streams for.
+    :param stream_types: Optional list of StreamType to limit to.
+    :return: list
+    """
+    streams = [
+        FollowedStream(user=user),
+        LimitedStream(user=user),
+        LocalStream(user=user),
+        ProfileAllStream(user=user, profile=user.profile),
+        PublicStream(user=user),
+        TagsStream(user=user),
+    ]
+    streams += [TagStream(user=user, tag=tag) for tag in user.profile.followed_tags.all()]
+    if stream_types:
+        streams = [stream for stream in streams if stream.stream_type in stream_types]
+    return streams
+
+
+def rebuild_precaches(streams, shared=False):
+    """Replace the precaches of the streams with the newest content from the database.
+
+    :param streams: List of stream instances.
+    :param shared: Rebuild the precaches shared by all users instead of the per-user precaches.
+    :return: Amount of precache keys written
+    """
+    size = settings.SOCIALHOME_STREAMS_PRECACHE_SIZE
+    r = get_redis_connection()
+    pipe = r.pipeline(transaction=False)
+    written = 0
+    for stream in streams:
+        rebuilt_keys = stream.rebuilt_keys
+        keys = [key for key in rebuilt_keys if BaseStream.is_shared_key(key) == shared]
+        if not keys:
+            continue
+        precaches = {key: {} for key in keys}
+        throughs = {key: {} for key in keys}
+        # Streams reading several precaches get content for all of them from the same queryset
+        contents = stream.get_queryset().order_by(stream.ordering).only(
+            "id", "through", "created", "visibility",
+        )[:size * len(rebuilt_keys)]
+        for content in contents:
+            key = stream.get_cache_key(content)
+            if key in precaches and len(precaches[key]) < size:
+                # Whole seconds, like the scores of the live precache writes
+                precaches[key][content.id] = int(content.created.timestamp())
+                if content.through and content.through != content.id:
+                    throughs[key][content.id] = content.through
+        for key in keys:
+            throughs_key = BaseStream.get_throughs_key(key)
+            pipe.delete(key, throughs_key)
+            if precaches[key]:
+                pipe.zadd(key, precaches[key])
+                pipe.expire(key, settings.REDIS_DEFAULT_EXPIRY)
+            if throughs[key]:
+                pipe.hset(throughs_key, mapping=throughs[key])
+                pipe.expire(throughs_key, settings.REDIS_DEFAULT_EXPIRY)
+        written += len(keys)
+    pipe.execute()
+    return written
+
+
+def rebuild_precaches_for_users(user_ids, stream_types=None):
+    """Rebuild the per-user precaches of a batch of users.
+
+    :param user_ids: List of User ID's.
+    :param stream_types: Optional list of StreamType to limit to.
+    :return: Amount of precache keys written
+    """
+    users = User.objects.filter(id__in=user_ids).select_related("profile")
+    return rebuild_precaches([stream for user in users for stream in get_precache_streams(user, stream_types)])
+
+
+def add_profile_groups(notify_key, profile_ids):
+    """Record that the stream with the notify key displays the profiles.
+
+    :param notify_key: Notify key of the stream, ie the channel group of its listeners.
+    :param profile_ids: Iterable of Profile ID's.
+    """
+    profile_ids = set(profile_ids)
+    if not profile_ids:
+        return
+    r = get_redis_connection()
+    timestamp = int(time.time())
+    pipe = r.pipeline(transaction=False)
+    for profile_id in profile_ids:
+        key = f"{PROFILE_GROUPS_KEY_PREFIX}{profile_id}"
+        pipe.zadd(key, {notify_key: timestamp})
+        pipe.zremrangebyscore(key, 0, timestamp - PROFILE_GROUPS_EXPIRY)
+        pipe.expire(key, PROFILE_GROUPS_EXPIRY)
+    pipe.execute()
+
+
+def get_profile_groups(profile_id):
+    """Get the notify keys of the streams that recently displayed the profile.
+
+    :param profile_id: Profile ID
+    :return: List of notify keys
+    """
+    r = get_redis_connection()
+    return [
+        key.decode() for key in r.zrangebyscore(
+            f"{PROFILE_GROUPS_KEY_PREFIX}{profile_id}", int(time.time()) - PROFILE_GROUPS_EXPIRY, "+inf",
+        )
+    ]
+
+
 def update_profile_for_streams(profile, event='profile'):
-    redis = get_redis_connection()
-    keys = redis.keys('asgi:group:*')
-    notify_keys = [key.decode().split(':')[-1] for key in keys]
-    notify_listeners(profile, notify_keys, event)
+    """Notify the listeners of the streams that recently displayed the profile about a change in it."""
+    notify_listeners(profile, set(get_profile_groups(profile.id)), event)
 
 
 
@@ -169,14 +665,14 @@ def update_streams_with_content(content, event='new'):
             check_and_add_to_keys(stream_cls, acting_profile.user, content, keys, acting_profile, notify_keys,
                                   through.content_type == ContentType.SHARE)
         add_to_redis(content, through, keys)
-        notify_listeners(content, notify_keys, event)
-    # Queue rest to task runner
-    tasks.add_to_streams_for_users.send(content.id, through.id, acting_profile.id)
-    # Notify about reply separately
+    # Notify about reply in the same batch as the author streams
     if content.content_type == ContentType.REPLY:
         # Content reply
         # TODO notify per user due to visibility
-        notify_listeners(content, {"streams_content__%s" % content.root_parent.channel_group_name}, event)
+        notify_keys.add("streams_content__%s" % content.root_parent.channel_group_name)
+    notify_listeners(content, notify_keys, event)
+    # Queue rest to task runner
+    tasks.add_to_streams_for_users.send(content.id, through.id, acting_profile.id)
 
 
 class BaseStream:
@@ -212,47 +708,37 @@ class BaseStream:
         return ids, throughs
 
     def get_cached_content_ids(self):
-        self.init_redis_connection()
-        if not self.last_id and not self.first_id:
-            return self.get_cached_range(0, self.paginate_by - 1)
-
-        first_index = 0
-        last_index = 0
-
-        if self.last_id:
-            first_index = self.redis.zrevrank(self.key, self.last_id)
-            if first_index:
-                first_index = first_index + 1
-                last_index = first_index + self.paginate_by - 1
-            else: return [], {}
+        """Get a page of content ids and their throughs from the precache with one Redis call.
 
+        If durable timelines are enabled, precaches lost from Redis are filled from them first.
+        """
+        self.init_redis_connection()
+        script = self.redis.register_script(GET_CACHED_PAGE_SCRIPT)
+        keys = [CACHED_PAGE_MERGE_KEY, *self.cached_keys]
+        args = [self.last_id or "", self.first_id or "", self.paginate_by]
+        raw_ids, raw_throughs, unfetched_content, missing_keys = script(keys=keys, args=args)
+        if missing_keys and settings.SOCIALHOME_STREAMS_DURABLE_TIMELINES:
+            missing_keys = [key.decode("utf-8") for key in missing_keys]
+            if hydrate_from_timelines(self.redis, missing_keys):
+                raw_ids, raw_throughs, unfetched_content, _missing_keys = script(keys=keys, args=args)
         if self.first_id:
-            self.unfetched_content = False
-            last_index = self.redis.zrevrank(self.key, self.first_id)
-            # making the assumption the SPA UI never sends a negative content window
-            if isinstance(last_index, int):
-                if last_index > 0:
-                    last_index = last_index - 1
-                    if last_index - first_index > self.paginate_by:
-                        self.unfetched_content = True
-                    last_index = min(last_index, first_index + self.paginate_by - 1)
-                elif not self.last_id: return [], {}
-            else:
-                last_index = first_index + self.paginate_by - 1
-                self.unfetched_content = True
+            self.unfetched_content = bool(unfetched_content)
+        ids = [int(id) for id in raw_ids]
+        return ids, {id: int(through) for id, through in zip(ids, raw_throughs)}
 
-        return self.get_cached_range(first_index, last_index)
+    @cached_property
+    def cached_keys(self):
+        """Get the precache keys this stream is read from.
 
-    def get_cached_range(self, first, last):
-        self.init_redis_connection()
-        raw_ids = self.redis.zrevrange(self.key, first, last)
-        if not raw_ids:
-            return [], {}
-        ids = [int(x) for x in raw_ids]
-        # Get throughs and make it a dict
-        throughs = self.redis.hmget(self.get_throughs_key(self.key), keys=ids)
-        throughs = {id: int(through) for id, through in zip(ids, throughs)}
-        return ids, throughs
+        Streams that combine several precaches, for example a shared one and a per-user one, return more than
+        one key.
+        """
+        return [self.key]
+
+    @property
+    def rebuilt_keys(self):
+        """Get the precache keys of this stream that ``rebuild_precaches`` replaces from the database."""
+        return self.cached_keys
 
     def init_redis_connection(self):
         if not self.redis:
@@ -284,28 +770,81 @@ class BaseStream:
                 return ids, throughs
 
         remaining = self.paginate_by - len(ids)
-        qs = self.get_queryset()
+        window = self.get_window_filter()
+        if self.first_id:
+            self.unfetched_content = (self.get_queryset().filter(window).count() + len(ids)) > self.paginate_by
+        # Get and fill remaining items
+        for item in self.get_window_items(window, remaining):
+            ids.append(item["id"])
+            throughs[item["id"]] = item["through"]
+        return ids, throughs
+
+    def get_window_items(self, window, limit):
+        """Get the ids and throughs of the first content in the window, in stream order.
+
+        Each of the branch querysets is read up to the limit, and the results merged.
+
+        :param window: Filter from ``get_window_filter``.
+        :param limit: Maximum amount of items to return.
+        :return: List of dicts with ``id`` and ``through``.
+        """
+        branches = self.get_branch_querysets()
+        field = self.ordering.lstrip("-")
+        items = []
+        for qs in branches:
+            items.extend(qs.filter(window).values("id", "through", field).order_by(self.ordering)[:limit])
+        if len(branches) == 1:
+            return items
+        unique = {item["id"]: item for item in items}.values()
+        return sorted(unique, key=itemgetter(field), reverse=self.ordering.startswith("-"))[:limit]
+
+    def get_unfetched_count(self, limit=500):
+        """Count content between ``last_id`` and ``first_id`` without fetching the content ids.
+
+        Cached streams count by the positions of the ids in the precache. Other streams, or windows the
+        precache doesn't cover, do a database count bounded by the limit.
+
+        :param limit: Maximum count to return.
+        :return: int
+        """
+        if self.__class__ in CACHED_STREAM_CLASSES and self.first_id:
+            self.init_redis_connection()
+            script = self.redis.register_script(COUNT_CACHED_SCRIPT)
+            count = script(keys=[CACHED_PAGE_MERGE_KEY, *self.cached_keys], args=[self.last_id or "", self.first_id])
+            if count >= 0:
+                return min(count, limit)
+        return self.get_window_queryset()[:limit].count()
+
+    def get_window_filter(self):
+        """Get the filter for the window given by ``last_id`` and ``first_id``."""
+        window = Q()
         if self.last_id:
             if self.ordering == "-created":
-                qs = qs.filter(through__lt=self.last_id)
+                window &= Q(through__lt=self.last_id)
             elif self.ordering == "order":
                 last = Content.objects.filter(id=self.last_id).values_list("order", flat=True)[0]
-                qs = qs.filter(order__gt=last)
+                window &= Q(order__gt=last)
             else:
-                qs = qs.filter(through__gt=self.last_id)
+                window &= Q(through__gt=self.last_id)
         if self.first_id:
             through_id = Content.objects.filter(id=self.first_id).values_list('through',flat=True)[0]
             if self.ordering == "-created":
-                qs = qs.filter(through__gt=through_id)
+                window &= Q(through__gt=through_id)
             elif self.ordering == "created":
-                qs = qs.filter(through__lt=through_id)
-            self.unfetched_content = (qs.count() + len(ids)) > self.paginate_by
-        # Get and fill remaining items
-        ids_throughs = qs.values("id", "through").order_by(self.ordering)[:remaining]
-        for item in ids_throughs:
-            ids.append(item["id"])
-            throughs[item["id"]] = item["through"]
-        return ids, throughs
+                window &= Q(through__lt=through_id)
+        return window
+
+    def get_window_queryset(self):
+        """Get the queryset filtered to the window given by ``last_id`` and ``first_id``."""
+        return self.get_queryset().filter(self.get_window_filter())
+
+    def get_branch_querysets(self):
+        """Get querysets that together return the content of ``get_queryset``.
+
+        Streams whose queryset ORs conditions that can't use an index together can return one queryset per
+        condition instead, to have the database fallback in ``get_content_ids`` read each of them with an index.
+        """
+        return [self.get_queryset()]
 
     def get_queryset(self, *args, **kwars):
         raise NotImplemented
@@ -320,6 +859,43 @@ class BaseStream:
         """
         return [cls(user=user)]
 
+    @classmethod
+    def get_fanout_streams(cls, eligibility, users, acting_profile, checked=None):
+        """Get a list of target instances of this class, for a group of users, that should stream the content.
+
+        Set based equivalent of calling ``get_target_streams`` and filtering with ``should_stream_content``
+        for each user. Streams override this to resolve the users with a few queries. By default each
+        user is checked separately.
+
+        :param eligibility: ContentEligibility of the content to get the target streams for.
+        :param users: List of User objects to get target streams for.
+        :param acting_profile: The Profile object that caused this check.
+        :param checked: ContentEligibility of the content to check against the target streams, if other than
+            the content. Replies use this to find the streams that their root content has been added to.
+        """
+        checked = checked or eligibility
+        return [
+            stream for user in users for stream in cls.get_target_streams(eligibility.content, user, acting_profile)
+            if stream.should_stream_content(checked.content)
+        ]
+
+    @classmethod
+    def get_streams_for_user_ids(cls, users, user_ids, **kwargs):
+        """Get instances of this class for those users that are in ``user_ids``, keeping the order of users."""
+        return [cls(user=user, **kwargs) for user in users if user.id in user_ids]
+
+    def get_cache_key(self, content):
+        """Get the precache key that the content should be added to for this stream."""
+        return self.key
+
+    @classmethod
+    def get_shared_key(cls):
+        """Get the key of the precache shared by all users of this stream type.
+
+        Format: ``<keybase>:<streamtype>:shared``
+        """
+        return ":".join(cls.key_base + [cls.stream_type.value, "shared"])
+
     @staticmethod
     def get_throughs_key(key):
         return "%s:throughs" % key
@@ -348,16 +924,24 @@ class BaseStream:
 
         This is always the last item in the key parts.
 
-        :return: int or None if anonymous user key
+        :return: int or None if anonymous user or shared key
         """
         value = key
         if value.endswith(':throughs'):
             value = value[:-9]
         user_id = value.split(':')[-1]
-        if user_id == 'anonymous':
+        if user_id in ('anonymous', 'shared'):
             return None
         return int(user_id)
 
+    @staticmethod
+    def is_shared_key(key):
+        """Return True if the key is a precache shared by all users."""
+        value = key
+        if value.endswith(':throughs'):
+            value = value[:-9]
+        return value.endswith(':shared')
+
     @property
     def key_extra(self):
         return None
@@ -393,11 +977,123 @@ class BaseStream:
 
 
 class FollowedStream(BaseStream):
+    """Stream of content from followed profiles.
+
+    Public and site content from profiles with a lot of local followers is not added to the precache of each
+    follower. Instead it is added to a precache of the profile, which is merged with the follower precache
+    when reading. See ``SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS``.
+    """
+    # Profile whose content is fanned out on read, for streams that are targets of a fan-out
+    fanout_on_read_profile = None
     stream_type = StreamType.FOLLOWED
 
+    @cached_property
+    def cached_keys(self):
+        keys = [self.key]
+        if not settings.SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS:
+            return keys
+        self.init_redis_connection()
+        min_score = int(time.time()) - settings.REDIS_DEFAULT_EXPIRY
+        profile_ids = [int(id) for id in self.redis.zrangebyscore(FANOUT_ON_READ_PROFILES_KEY, min_score, "+inf")]
+        if profile_ids:
+            followed_ids = self.user.profile.following.filter(id__in=profile_ids).values_list("id", flat=True)
+            keys += [self.get_profile_key(id) for id in followed_ids]
+        return keys
+
+    @property
+    def rebuilt_keys(self):
+        # Profile precaches are written by the fan-out of the profile for all its followers, so they are left alone
+        return [self.key]
+
+    def get_cache_key(self, content):
+        if self.fanout_on_read_profile and content.visibility in (Visibility.PUBLIC, Visibility.SITE):
+            return self.get_profile_key(self.fanout_on_read_profile.id)
+        return self.key
+
+    @classmethod
+    def get_fanout_streams(cls, eligibility, users, acting_profile, checked=None):
+        checked = checked or eligibility
+        if not checked.is_top_level:
+            return []
+        user_ids = checked.get_visible_user_ids(user.id for user in users)
+        if user_ids:
+            # Followers of the author or of any of the profiles that shared the content
+            author_ids = {checked.content.author_id} | checked.sharer_ids
+            user_ids = set(
+                Profile.objects.filter(user_id__in=user_ids, following__id__in=author_ids).values_list(
+                    "user_id", flat=True,
+                ),
+            )
+        streams = cls.get_streams_for_user_ids(users, user_ids)
+        if streams:
+            cls.set_fanout_on_read_profile(streams, acting_profile)
+        return streams
+
+    @staticmethod
+    def get_profile_key(profile_id):
+        """Get the key of the precache of a fanned out on read profile, shared by all followers.
+
+        Format: ``<keybase>:followed:<profile_id>:shared``
+        """
+        return ":".join(FollowedStream.key_base + [StreamType.FOLLOWED.value, str(profile_id), "shared"])
+
+    def get_branch_querysets(self):
+        return [Content.objects.followed_authored(self.user), Content.objects.followed_shared(self.user)]
+
     def get_queryset(self, single_id=None):
         return Content.objects.followed(self.user, single_id=single_id)
 
+    @classmethod
+    def get_target_streams(cls, content, user, acting_profile):
+        streams = super().get_target_streams(content, user, acting_profile)
+        cls.set_fanout_on_read_profile(streams, acting_profile)
+        return streams
+
+    @staticmethod
+    def is_fanout_on_read(profile):
+        """Check whether the profile has enough local followers for its content to be fanned out on read.
+
+        The amount of local followers is cached per profile for ``FANOUT_ON_READ_FOLLOWERS_EXPIRY``. When it is
+        counted, a profile over the threshold is also refreshed in the ``FANOUT_ON_READ_PROFILES_KEY`` set read by
+        the followers, pruning the profiles that have not been seen for the precache expiry.
+        """
+        threshold = settings.SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS
+        if not threshold:
+            return False
+        r = get_redis_connection()
+        key = f"{FANOUT_ON_READ_FOLLOWERS_KEY_PREFIX}{profile.id}"
+        count = r.get(key)
+        if count is not None:
+            return int(count) >= threshold
+        count = profile.followers.filter(user__isnull=False).count()
+        r.set(key, count, ex=FANOUT_ON_READ_FOLLOWERS_EXPIRY)
+        if count >= threshold:
+            now = int(time.time())
+            pipe = r.pipeline()
+            pipe.zadd(FANOUT_ON_READ_PROFILES_KEY, {profile.id: now})
+            pipe.zremrangebyscore(FANOUT_ON_READ_PROFILES_KEY, "-inf", now - settings.REDIS_DEFAULT_EXPIRY - 1)
+            pipe.expire(FANOUT_ON_READ_PROFILES_KEY, settings.REDIS_DEFAULT_EXPIRY)
+            pipe.execute()
+        return count >= threshold
+
+    @classmethod
+    def set_fanout_on_read_profile(cls, streams, profile):
+        """Mark the target streams to precache to the profile key, if the profile is fanned out on read.
+
+        Only the streams of users following the profile read the profile key. Others, for example followers of
+        another sharer of the content, keep precaching to their own key.
+        """
+        if not streams or not cls.is_fanout_on_read(profile):
+            return
+        follower_user_ids = set(
+            Profile.objects.filter(
+                user_id__in=[stream.user.id for stream in streams], following=profile,
+            ).values_list("user_id", flat=True),
+        )
+        for stream in streams:
+            if stream.user.id in follower_user_ids:
+                stream.fanout_on_read_profile = profile
+
     @property
     def notify_key_extra(self):
         return self.user.id
@@ -406,6 +1102,14 @@ class FollowedStream(BaseStream):
 class LimitedStream(BaseStream):
     stream_type = StreamType.LIMITED
 
+    @classmethod
+    def get_fanout_streams(cls, eligibility, users, acting_profile, checked=None):
+        checked = checked or eligibility
+        if not checked.is_top_level or checked.content.visibility != Visibility.LIMITED:
+            return []
+        user_ids = checked.get_visible_user_ids(user.id for user in users)
+        return cls.get_streams_for_user_ids(users, user_ids)
+
     def get_queryset(self, single_id=None):
         return Content.objects.limited(self.user, single_id=single_id)
 
@@ -415,9 +1119,34 @@ class LimitedStream(BaseStream):
 
 
 class LocalStream(BaseStream):
+    """Local content stream.
+
+    Public and site content is precached to a key shared by all users. Limited and self content is precached
+    per user, as an overlay that is merged with the shared precache when reading.
+    """
     notify_for_shares = False
     stream_type = StreamType.LOCAL
 
+    @cached_property
+    def cached_keys(self):
+        if not self.user.is_authenticated:
+            # Anonymous users don't see site content, so can't use the shared precache
+            return [self.key]
+        return [self.key, self.get_shared_key()]
+
+    def get_cache_key(self, content):
+        if content.visibility in (Visibility.PUBLIC, Visibility.SITE):
+            return self.get_shared_key()
+        return self.key
+
+    @classmethod
+    def get_fanout_streams(cls, eligibility, users, acting_profile, checked=None):
+        checked = checked or eligibility
+        if not checked.is_top_level or not checked.content.local:
+            return []
+        user_ids = checked.get_visible_user_ids(user.id for user in users)
+        return cls.get_streams_for_user_ids(users, user_ids)
+
     def get_queryset(self, single_id=None):
         return Content.objects.local(self.user, single_id=single_id)
 
@@ -435,6 +1164,25 @@ class ProfileStreamBase(BaseStream):
     def get_target_streams(cls, content, user, acting_profile):
         return [cls(user=user, profile=acting_profile)]
 
+    @classmethod
+    def get_fanout_streams(cls, eligibility, users, acting_profile, checked=None):
+        checked = checked or eligibility
+        if not checked.is_top_level or not cls.is_profile_content(checked, acting_profile):
+            return []
+        user_ids = checked.get_visible_user_ids(user.id for user in users)
+        if acting_profile.visibility == Visibility.SELF:
+            # Mirrors ``Profile.visible_to_user`` for authenticated users
+            user_ids &= {acting_profile.user_id}
+        return cls.get_streams_for_user_ids(users, user_ids, profile=acting_profile)
+
+    @staticmethod
+    def is_profile_content(eligibility, profile):
+        """Check whether the top level content belongs to the profile stream, visibility not considered.
+
+        :param eligibility: ContentEligibility of the content to check.
+        """
+        raise NotImplementedError
+
     @property
     def key_extra(self):
         return str(self.profile.id)
@@ -447,9 +1195,19 @@ class ProfileStreamBase(BaseStream):
 class ProfileAllStream(ProfileStreamBase):
     stream_type = StreamType.PROFILE_ALL
 
+    def get_branch_querysets(self):
+        return [
+            Content.objects.profile_authored(self.profile, self.user),
+            Content.objects.profile_shared(self.profile, self.user),
+        ]
+
     def get_queryset(self, single_id=None):
         return Content.objects.profile(self.profile, self.user, single_id=single_id)
 
+    @staticmethod
+    def is_profile_content(eligibility, profile):
+        return eligibility.content.author_id == profile.id or profile.id in eligibility.sharer_ids
+
     def should_cache_stream(self, cls, user):
         # only cache the requesting user's profile stream
         should_cache = super().should_cache_stream(cls, user)
@@ -465,14 +1223,30 @@ class ProfilePinnedStream(ProfileStreamBase):
     def get_queryset(self, single_id=None):
         return Content.objects.profile_pinned(self.profile, self.user, single_id=single_id)
 
+    @staticmethod
+    def is_profile_content(eligibility, profile):
+        return eligibility.content.author_id == profile.id and eligibility.content.pinned
+
 
 class PublicStream(BaseStream):
     notify_for_shares = False
     stream_type = StreamType.PUBLIC
 
+    @classmethod
+    def get_fanout_streams(cls, eligibility, users, acting_profile, checked=None):
+        checked = checked or eligibility
+        if not checked.is_top_level or checked.content.visibility != Visibility.PUBLIC:
+            return []
+        return [cls(user=user) for user in users]
+
     def get_queryset(self, single_id=None):
         return Content.objects.public(single_id=single_id)
 
+    @cached_property
+    def key(self):
+        """Public content is the same for all users, so all users share one precache."""
+        return self.get_shared_key()
+
     @property
     def notify_key_extra(self):
         return self.user.id
@@ -496,6 +1270,20 @@ class TagStream(BaseStream):
             raise AttributeError("TagStream is missing tag.")
         return Content.objects.tag(self.tag, self.user, single_id=single_id)
 
+    @classmethod
+    def get_fanout_streams(cls, eligibility, users, acting_profile, checked=None):
+        checked = checked or eligibility
+        if not checked.is_top_level:
+            return []
+        tags = eligibility.tags
+        if checked is not eligibility:
+            checked_tags = set(checked.tags)
+            tags = [tag for tag in tags if tag in checked_tags]
+        if not tags:
+            return []
+        user_ids = checked.get_visible_user_ids(user.id for user in users)
+        return [cls(user=user, tag=tag) for user in users if user.id in user_ids for tag in tags]
+
     @classmethod
     def get_target_streams(cls, content, user, acting_profile):
         return [cls(user=user, tag=tag) for tag in content.tags.all()]
@@ -513,6 +1301,20 @@ class TagsStream(BaseStream):
     notify_for_shares = False
     stream_type = StreamType.TAGS
 
+    @classmethod
+    def get_fanout_streams(cls, eligibility, users, acting_profile, checked=None):
+        checked = checked or eligibility
+        if not checked.is_top_level or not checked.tags:
+            return []
+        user_ids = checked.get_visible_user_ids(user.id for user in users)
+        if user_ids:
+            user_ids = set(
+                Profile.objects.filter(
+                    user_id__in=user_ids, followed_tags__in=checked.tags,
+                ).values_list("user_id", flat=True),
+            )
+        return cls.get_streams_for_user_ids(users, user_ids)
+
     def get_queryset(self, single_id=None):
         return Content.objects.tags_followed_by_user(self.user, single_id=single_id)
 
@@ -1,15 +1,85 @@
 import logging
+import time
 from datetime import timedelta
 from typing import List
 
 import dramatiq
 from django.conf import settings
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
 from django.utils.timezone import now
 
 from socialhome.utils import get_redis_connection
 
 logger = logging.getLogger("socialhome")
 
+# Saved SCAN cursor of an unfinished precache grooming run
+GROOM_CURSOR_KEY = "sh:groom:cursor"
+# Amount of keys to ask for per SCAN call when grooming
+GROOM_SCAN_COUNT = 500
+# Remove throughs that are the same as the content id, those are not stored since they are the default.
+# Returns the amount of throughs removed.
+# KEYS: throughs keys
+COMPACT_THROUGHS_SCRIPT = """
+local removed = 0
+for _, key in ipairs(KEYS) do
+    local items = redis.call("HGETALL", key)
+    for i = 1, #items, 2 do
+        if items[i] == items[i + 1] then
+            redis.call("HDEL", key, items[i])
+            removed = removed + 1
+        end
+    end
+end
+return removed
+"""
+# Trim a list of precaches and remove the throughs of content no longer in them.
+# Returns the amount of precaches emptied and the amount of throughs removed.
+# KEYS: stream keys, ARGV: trim size per key
+GROOM_PRECACHES_SCRIPT = """
+local deleted_keys = 0
+local deleted_throughs = 0
+for i, key in ipairs(KEYS) do
+    local throughs_key = key .. ":throughs"
+    redis.call("ZREMRANGEBYRANK", key, 0, -tonumber(ARGV[i]) - 1)
+    if redis.call("ZCARD", key) == 0 then
+        redis.call("DEL", throughs_key)
+        deleted_keys = deleted_keys + 1
+    else
+        for _, content_id in ipairs(redis.call("HKEYS", throughs_key)) do
+            if not redis.call("ZSCORE", key, content_id) then
+                redis.call("HDEL", throughs_key, content_id)
+                deleted_throughs = deleted_throughs + 1
+            end
+        end
+    end
+end
+return {deleted_keys, deleted_throughs}
+"""
+
+
+def compact_precache_throughs():
+    """
+    Remove throughs that are the same as the content id from the stream precache throughs.
+
+    Precaches written before throughs were stored only for shares contain these.
+
+    :return: Amount of throughs removed
+    """
+    r = get_redis_connection()
+    script = r.register_script(COMPACT_THROUGHS_SCRIPT)
+    removed = 0
+    keys = []
+    for key in r.scan_iter("sh:streams:*:throughs", count=GROOM_SCAN_COUNT):
+        keys.append(key)
+        if len(keys) >= GROOM_SCAN_COUNT:
+            removed += script(keys=keys)
+            keys = []
+    if keys:
+        removed += script(keys=keys)
+    logger.info("compact_precache_throughs - Removed %s throughs", removed)
+    return removed
+
 
 @dramatiq.actor(priority=settings.DRAMATIQ_PRIORITY_LOWEST, time_limit=2*60*60*1000)
 def delete_redis_keys(patterns: List[str], only_without_expiry: bool = True):
@@ -39,15 +109,41 @@ def delete_redis_keys(patterns: List[str], only_without_expiry: bool = True):
             r.delete(*to_delete)
 
 
+def get_precache_memory_usage():
+    """
+    Get the memory used by the stream precaches and their throughs.
+
+    :return: Tuple of memory used by the precaches and by the throughs, in bytes
+    """
+    r = get_redis_connection()
+    precaches = throughs = 0
+    keys = list(r.scan_iter("sh:streams:*", count=GROOM_SCAN_COUNT))
+    for i in range(0, len(keys), GROOM_SCAN_COUNT):
+        batch = keys[i:i + GROOM_SCAN_COUNT]
+        pipe = r.pipeline(transaction=False)
+        for key in batch:
+            pipe.memory_usage(key, samples=0)
+        for key, usage in zip(batch, pipe.execute()):
+            if key.endswith(b":throughs"):
+                throughs += usage or 0
+            else:
+                precaches += usage or 0
+    return precaches, throughs
+
+
 def get_precache_trim_size(user_activities, key):
     """
     Get user activity to decide what kind of trimming we need.
 
+    User activities must be loaded with ``load_user_activities`` first.
+
     :return: int
     """
     # Local imports since we load tasks before apps are loaded fully
     from socialhome.streams.streams import BaseStream
-    from socialhome.users.models import User
+    if BaseStream.is_shared_key(key):
+        # Shared by all users, trim as active
+        return settings.SOCIALHOME_STREAMS_PRECACHE_SIZE
     user_id = BaseStream.get_key_user_id(key)
     logger.debug("get_precache_trim_size - User ID: %s", user_id)
     if not user_id:
@@ -55,65 +151,91 @@ def get_precache_trim_size(user_activities, key):
         logger.debug("get_precache_trim_size - No User ID, trimming to %s", settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE)
         return settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE
     user_active = user_activities.get(user_id)
-    if user_active is not None:
-        # Trim according to activity
-        size = settings.SOCIALHOME_STREAMS_PRECACHE_SIZE if user_active else settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE
-        logger.debug("get_precache_trim_size - first user activities check, User ID: %s, user_active %s, trimming to %s", user_id, user_active, size)
-        return size
-    # Get user
-    try:
-        user = User.objects.get(id=user_id)
-    except User.DoesNotExist:
+    if user_active is None:
         # Trim all
         logger.debug("get_precache_trim_size - User ID: %s can't be found, trimming to zero", user_id)
         return 0
-    check_time = user.last_login if user.last_login else user.date_joined
-    user_active = check_time >= now() - timedelta(days=settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS)
-    user_activities[user_id] = user_active
     # Trim according to activity
     size = settings.SOCIALHOME_STREAMS_PRECACHE_SIZE if user_active else settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE
-    logger.debug("get_precache_trim_size - second user activities check, User ID: %s, user_active %s, trimming to %s", user_id, user_active, size)
+    logger.debug("get_precache_trim_size - User ID: %s, user_active %s, trimming to %s", user_id, user_active, size)
     return size
 
 
+def load_user_activities(user_activities, keys):
+    """
+    Load the activity of the users of the given precache keys not loaded yet, with one query.
+
+    Users that can't be found are stored as ``None``.
+    """
+    # Local imports since we load tasks before apps are loaded fully
+    from socialhome.streams.streams import BaseStream
+    from socialhome.users.models import User
+    user_ids = {BaseStream.get_key_user_id(key) for key in keys if not BaseStream.is_shared_key(key)}
+    user_ids = {user_id for user_id in user_ids if user_id and user_id not in user_activities}
+    if not user_ids:
+        return
+    user_activities.update({user_id: None for user_id in user_ids})
+    active_since = now() - timedelta(days=settings.SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS)
+    users = User.objects.filter(id__in=user_ids).values_list("id", "last_login", "date_joined")
+    for user_id, last_login, date_joined in users:
+        check_time = last_login if last_login else date_joined
+        user_activities[user_id] = check_time >= active_since
+
+
 @dramatiq.actor(priority=settings.DRAMATIQ_PRIORITY_LOWEST, time_limit=2*60*60*1000)
 def groom_redis_precaches():
-    """Groom the Redis data for streams precaching."""
+    """Groom the Redis data for streams precaching.
+
+    Keys are scanned and groomed in batches. The scan cursor is saved after each batch, so that a run that stops
+    after ``SOCIALHOME_STREAMS_PRECACHE_GROOM_TIME_LIMIT`` or is interrupted is continued by the next run.
+    """
     r = get_redis_connection()
+    script = r.register_script(GROOM_PRECACHES_SCRIPT)
     user_activities = {}
-    keys = r.scan_iter("sh:streams:[a-z0-9_\\-:]*")
-    logger.info("groom_redis_precaches - Looking for stream keys to groom")
+    cursor = int(r.get(GROOM_CURSOR_KEY) or 0)
+    started = time.monotonic()
+    logger.info("groom_redis_precaches - Looking for stream keys to groom, starting from cursor %s", cursor)
     deleted_keys = deleted_throughs = trimmed = 0
-    for key in keys:
-        decoded_key = key.decode("utf-8")
-        if decoded_key.endswith(':throughs'):
-            # Skip throughs, we handle those separately below
-            continue
-        trim_size = get_precache_trim_size(user_activities, decoded_key)
-        # Make the ordered set X items length at most
-        r.zremrangebyrank(key, 0, -trim_size-1)
-        trimmed += 1
-        logger.debug("groom_redis_precaches - Trimmed key %s to %s", key, trim_size)
-        # Remove now obsolete throughs ID's from the throughs hash
-        throughs_key = f"{decoded_key}:throughs"
-        if not r.zcount(key, '-inf', '+inf'):
-            # No need to loop, we've removed everything
-            logger.debug("groom_redis_precaches - No throughs found for %s, deleting key", throughs_key)
-            r.delete(throughs_key)
-            deleted_keys += 1
-            continue
-        delkeys = []
-        for content_id, _through_id in r.hgetall(throughs_key).items():
-            if r.zrank(key, int(content_id)) is None:
-                logger.debug("groom_redis_precaches - Adding %s to be deleted throughs key %s", content_id, throughs_key )
-                delkeys.append(int(content_id))
-        if delkeys:
-            logger.debug("groom_redis_precaches - Deleting thoughs key %s total %s items", throughs_key, len(delkeys))
-            r.hdel(throughs_key, *delkeys)
-            deleted_throughs += len(delkeys)
+    while True:
+        cursor, keys = r.scan(cursor, match="sh:streams:[a-z0-9_\\-:]*", count=GROOM_SCAN_COUNT)
+        # Skip throughs, we handle those together with their precache
+        keys = [key.decode("utf-8") for key in keys if not key.endswith(b":throughs")]
+        if keys:
+            load_user_activities(user_activities, keys)
+            trim_sizes = [get_precache_trim_size(user_activities, key) for key in keys]
+            batch_deleted_keys, batch_deleted_throughs = script(keys=keys, args=trim_sizes)
+            trimmed += len(keys)
+            deleted_keys += batch_deleted_keys
+            deleted_throughs += batch_deleted_throughs
+        if not cursor:
+            r.delete(GROOM_CURSOR_KEY)
+            break
+        r.set(GROOM_CURSOR_KEY, cursor, ex=settings.REDIS_DEFAULT_EXPIRY)
+        if time.monotonic() - started > settings.SOCIALHOME_STREAMS_PRECACHE_GROOM_TIME_LIMIT:
+            logger.info("groom_redis_precaches - Time limit reached, stopping at cursor %s", cursor)
+            break
     logger.info("groom_redis_precaches - Trimmed %s keys, deleted %s keys and %s related throughs", trimmed, deleted_keys, deleted_throughs)
 
 
+def prune_timelines(keys):
+    """
+    Delete durable timeline entries of the given precaches that are no longer within the precache size.
+
+    Called for the precaches written to, so that each timeline stays within the precache size.
+
+    :param keys: List of precache keys
+    :return: Amount of entries deleted
+    """
+    # Local imports since we load tasks before apps are loaded fully
+    from socialhome.streams.models import TimelineEntry
+    outside = TimelineEntry.objects.filter(key__in=keys).annotate(
+        rank=Window(RowNumber(), partition_by=F("key"), order_by=F("score").desc()),
+    ).filter(rank__gt=settings.SOCIALHOME_STREAMS_PRECACHE_SIZE)
+    deleted, _ = TimelineEntry.objects.filter(id__in=outside.values("id")).delete()
+    logger.debug("prune_timelines - Deleted %s timeline entries of %s keys", deleted, len(keys))
+    return deleted
+
+
 @dramatiq.actor(priority=settings.DRAMATIQ_PRIORITY_MEDIUM)
 def add_to_streams_for_users(content_id, through_id, acting_profile_id):
     """
@@ -122,3 +244,11 @@ def add_to_streams_for_users(content_id, through_id, acting_profile_id):
     """
     from socialhome.streams import streams
     streams.add_to_streams_for_users(content_id, through_id, acting_profile_id)
+
+
+@dramatiq.actor(priority=settings.DRAMATIQ_PRIORITY_MEDIUM)
+def add_to_streams_for_users_chunk(content_id, through_id, acting_profile_id, first_user_id, last_user_id, fanout_key):
+    from socialhome.streams import streams
+    streams.add_to_streams_for_users_chunk(
+        content_id, through_id, acting_profile_id, first_user_id, last_user_id, fanout_key,
+    )
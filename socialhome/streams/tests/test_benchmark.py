@@ -0,0 +1,104 @@
+from socialhome.content.models import Content
+from socialhome.streams.benchmark import (
+    RedisKeyTracker, SocialGraph, cleanup_redis, compare_results, percentile, run_benchmark, QUERY_STREAMS,
+    STREAM_VIEWS)
+from socialhome.tests.utils import SocialhomeTestCase
+from socialhome.users.models import Profile, User
+from socialhome.utils import get_redis_connection
+
+SMALL_GRAPH = {
+    "users": 10, "remote_profiles": 20, "tags": 5, "content": 50, "fanout_content": 3, "requests": 2,
+    "max_follows": 10, "max_recipients": 3,
+}
+
+
+class TestPercentile(SocialhomeTestCase):
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([3], 95), 3)
+        self.assertIsNone(percentile([], 50))
+
+
+class TestSocialGraph(SocialhomeTestCase):
+    def test_generate(self):
+        graph = SocialGraph(**SMALL_GRAPH).generate()
+        self.assertEqual(len(graph.users), 10)
+        self.assertEqual(len(graph.profiles), 20)
+        self.assertEqual(Content.objects.filter(id__in=graph.content_ids).count(), 50)
+        for user in graph.users:
+            self.assertGreaterEqual(user.profile.following.count(), 5)
+
+    def test_is_reproducible(self):
+        def get_follow_ranks(graph):
+            ranks = {profile.id: rank for rank, profile in enumerate(graph.popular_profiles)}
+            return sorted(
+                (graph.users.index(user), sorted(ranks[id] for id in user.profile.following_ids))
+                for user in graph.users
+            )
+
+        first = SocialGraph(**SMALL_GRAPH).generate()
+        second = SocialGraph(**SMALL_GRAPH).generate()
+        self.assertEqual(get_follow_ranks(first), get_follow_ranks(second))
+
+
+class TestRedisCleanup(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.keys = [f"sh:test:benchmark:{i}" for i in range(4)]
+        self.r.delete(*self.keys)
+        self.addCleanup(self.r.delete, *self.keys)
+
+    def test_redis_key_tracker(self):
+        tracker = RedisKeyTracker()
+        with tracker.track():
+            self.r.set(self.keys[0], 1)
+            pipe = self.r.pipeline()
+            pipe.zadd(self.keys[1], {1: 1})
+            pipe.execute()
+            self.r.eval("return redis.call('SET', KEYS[1], ARGV[1])", 1, self.keys[2], 1)
+        self.r.set(self.keys[3], 1)
+        self.assertEqual(tracker.keys, {key.encode() for key in self.keys[:3]})
+
+    def test_cleanup_redis(self):
+        for key in self.keys:
+            self.r.zadd(key, {1: 1, 2: 2})
+        existing, used = {self.keys[0].encode()}, {self.keys[0].encode(), self.keys[1].encode()}
+        cleanup_redis(existing, used, [2])
+        self.assertTrue(self.r.exists(self.keys[0]))
+        self.assertFalse(self.r.exists(self.keys[1]))
+        # Keys not used by the benchmark are left alone
+        self.assertEqual(self.r.zrange(self.keys[2], 0, -1), [b"1", b"2"])
+
+
+class TestRunBenchmark(SocialhomeTestCase):
+    def test_run_benchmark(self):
+        users = User.objects.count()
+        r = get_redis_connection()
+        keys = set(r.scan_iter())
+        results = run_benchmark(**SMALL_GRAPH)
+        self.assertEqual(results["fanout"]["content"], 3)
+        self.assertGreater(results["fanout"]["redis_commands_per_content"], 0)
+        self.assertEqual(set(results["endpoints"]), set(STREAM_VIEWS))
+        self.assertEqual(set(results["queries"]), set(QUERY_STREAMS))
+        self.assertFalse(any(values["distinct"] for values in results["queries"].values()))
+        # Rolled back and cleaned up
+        self.assertEqual(User.objects.count(), users)
+        self.assertFalse(Profile.objects.filter(handle__startswith="bench-").exists())
+        self.assertTrue(set(r.scan_iter()).issubset(keys))
+
+    def test_compare_results(self):
+        results = {
+            "fanout": {"p95_ms": 110}, "endpoints": {"public": {"p95_ms": 50}, "tags": {"p95_ms": 10}},
+            "queries": {"public": {"p95_ms": 4}},
+        }
+        baseline = {"fanout": {"p95_ms": 100}, "endpoints": {"public": {"p95_ms": 100}}}
+        self.assertEqual(compare_results(results, baseline), [
+            ("fanout", 100, 110, 10.0),
+            ("public", 100, 50, -50.0),
+            ("tags", None, 10, None),
+            ("public query", None, 4, None),
+        ])
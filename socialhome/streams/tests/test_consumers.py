@@ -0,0 +1,371 @@
+import asyncio
+import time
+from unittest.mock import patch, Mock, ANY
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.test import override_settings
+from django.urls import path
+
+from socialhome.streams.consumers import (
+    coalesce_events, group_send_many, get_live_groups, get_missed_events, log_event, mark_absent, mark_present,
+    notify_listeners,
+    ActivityThrottle, StreamConsumer, EVENT_LOG_KEY_PREFIX, LISTENED_KEY_PREFIX, PRESENCE_KEY_PREFIX)
+from socialhome.tests.utils import SocialhomeTestCase
+from socialhome.users.tests.factories import UserFactory
+from socialhome.utils import get_redis_connection
+
+
+def delete_stream_keys(groups):
+    get_redis_connection().delete(*(
+        f"{prefix}{group}" for prefix in (PRESENCE_KEY_PREFIX, LISTENED_KEY_PREFIX, EVENT_LOG_KEY_PREFIX)
+        for group in groups
+    ))
+
+
+class MockChannelLayer:
+    def __init__(self):
+        self.sent = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def group_send(self, group, message):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        await asyncio.sleep(0)
+        self.sent.append((group, message))
+        self.in_flight -= 1
+
+
+class TestGroupSendMany(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.layer = MockChannelLayer()
+        patcher = patch("socialhome.streams.consumers.get_channel_layer", return_value=self.layer)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sends_to_all_groups(self):
+        groups = {f"streams_public__{i}" for i in range(10)}
+        async_to_sync(group_send_many)(groups, {"type": "notification"})
+        self.assertEqual(sorted(group for group, _message in self.layer.sent), sorted(groups))
+        self.assertTrue(all(message == {"type": "notification"} for _group, message in self.layer.sent))
+
+    def test_sends_concurrently_up_to_limit(self):
+        async_to_sync(group_send_many)([f"streams_public__{i}" for i in range(10)], {}, concurrency=3)
+        self.assertEqual(len(self.layer.sent), 10)
+        self.assertEqual(self.layer.max_in_flight, 3)
+
+
+class TestPresence(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.groups = [f"streams_presence_test__{i}" for i in range(3)]
+        delete_stream_keys(self.groups)
+        self.addCleanup(delete_stream_keys, self.groups)
+
+    def test_get_live_groups(self):
+        async_to_sync(mark_present)(self.groups[0], "channel.1")
+        async_to_sync(mark_present)(self.groups[1], "channel.2")
+        self.assertEqual(get_live_groups(self.groups), {self.groups[0], self.groups[1]})
+        self.assertEqual(get_live_groups([]), set())
+
+    def test_mark_absent(self):
+        async_to_sync(mark_present)(self.groups[0], "channel.1")
+        async_to_sync(mark_present)(self.groups[0], "channel.2")
+        async_to_sync(mark_absent)(self.groups[0], "channel.1")
+        self.assertEqual(get_live_groups(self.groups), {self.groups[0]})
+        async_to_sync(mark_absent)(self.groups[0], "channel.2")
+        self.assertEqual(get_live_groups(self.groups), set())
+
+    @override_settings(SOCIALHOME_STREAMS_PRESENCE_EXPIRY=60)
+    def test_channels_without_heartbeat_are_not_live(self):
+        self.r.zadd(f"{PRESENCE_KEY_PREFIX}{self.groups[0]}", {"channel.1": int(time.time()) - 61})
+        async_to_sync(mark_present)(self.groups[1], "channel.2")
+        self.assertEqual(get_live_groups(self.groups), {self.groups[1]})
+        # Stale channels are removed when marking presence
+        async_to_sync(mark_present)(self.groups[0], "channel.3")
+        self.assertEqual(self.r.zrange(f"{PRESENCE_KEY_PREFIX}{self.groups[0]}", 0, -1), [b"channel.3"])
+        self.assertLessEqual(self.r.ttl(f"{PRESENCE_KEY_PREFIX}{self.groups[0]}"), 60)
+
+    @patch("socialhome.streams.consumers.async_to_sync", autospec=True)
+    def test_notify_listeners_skips_groups_without_listeners(self, mock_async_to_sync):
+        content = Mock(id=1)
+        content.parent = None
+        notify_listeners(content, set(self.groups), "new")
+        self.assertFalse(mock_async_to_sync.called)
+        async_to_sync(mark_present)(self.groups[2], "channel.1")
+        notify_listeners(content, set(self.groups), "new")
+        mock_send = mock_async_to_sync.return_value
+        mock_send.assert_called_once_with({self.groups[2]}, {
+            "type": "notification",
+            "payload": {"event": "new", "id": 1, "parentId": None, "eventId": ANY},
+        })
+
+
+class TestEventLog(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.groups = [f"streams_event_log_test__{i}" for i in range(3)]
+        delete_stream_keys(self.groups)
+        self.addCleanup(delete_stream_keys, self.groups)
+
+    def get_log(self, group):
+        return [
+            (entry_id.decode(), fields[b"payload"].decode())
+            for entry_id, fields in self.r.xrange(f"{EVENT_LOG_KEY_PREFIX}{group}")
+        ]
+
+    def test_log_event(self):
+        async_to_sync(mark_present)(self.groups[0], "channel.1")
+        async_to_sync(mark_present)(self.groups[1], "channel.2")
+        async_to_sync(mark_absent)(self.groups[1], "channel.2")
+        event_id, live = log_event(self.groups, {"event": "new", "id": 1})
+        self.assertEqual(live, {self.groups[0]})
+        # Logged for the live and the recently listened groups, with the same id
+        self.assertEqual(self.get_log(self.groups[0]), [(event_id, '{"event": "new", "id": 1}')])
+        self.assertEqual(self.get_log(self.groups[1]), [(event_id, '{"event": "new", "id": 1}')])
+        self.assertEqual(self.get_log(self.groups[2]), [])
+        self.assertLessEqual(self.r.ttl(f"{EVENT_LOG_KEY_PREFIX}{self.groups[0]}"), 600)
+
+    def test_log_event__ids_increase(self):
+        async_to_sync(mark_present)(self.groups[0], "channel.1")
+        ids = [log_event(self.groups, {"event": "new", "id": i})[0] for i in range(3)]
+        self.assertEqual([entry_id for entry_id, _payload in self.get_log(self.groups[0])], ids)
+        self.assertEqual(ids, sorted(ids, key=lambda event_id: tuple(map(int, event_id.split("-")))))
+
+    @override_settings(SOCIALHOME_STREAMS_EVENT_LOG_SIZE=2)
+    def test_log_event__trims_log(self):
+        async_to_sync(mark_present)(self.groups[0], "channel.1")
+        ids = [log_event(self.groups, {"event": "new", "id": i})[0] for i in range(3)]
+        self.assertEqual([entry_id for entry_id, _payload in self.get_log(self.groups[0])], ids[1:])
+
+    def test_get_missed_events(self):
+        async_to_sync(mark_present)(self.groups[0], "channel.1")
+        ids = [log_event(self.groups, {"event": "new", "id": i})[0] for i in range(3)]
+        self.assertEqual(async_to_sync(get_missed_events)(self.groups[0], ids[0]), [
+            {"event": "new", "id": 1, "eventId": ids[1]},
+            {"event": "new", "id": 2, "eventId": ids[2]},
+        ])
+        self.assertEqual(async_to_sync(get_missed_events)(self.groups[0], ids[2]), [])
+        # Nothing logged for the group after the event
+        self.assertEqual(async_to_sync(get_missed_events)(self.groups[1], ids[2]), [])
+
+    def test_get_missed_events__cannot_be_replayed(self):
+        self.assertIsNone(async_to_sync(get_missed_events)(self.groups[0], "foobar"))
+        self.assertIsNone(async_to_sync(get_missed_events)(self.groups[0], None))
+        # Older than the event logs are kept
+        self.assertIsNone(async_to_sync(get_missed_events)(self.groups[0], "%d-1" % ((time.time() - 601) * 1000)))
+
+    @override_settings(SOCIALHOME_STREAMS_EVENT_LOG_SIZE=2)
+    def test_get_missed_events__trimmed(self):
+        async_to_sync(mark_present)(self.groups[0], "channel.1")
+        ids = [log_event(self.groups, {"event": "new", "id": i})[0] for i in range(4)]
+        # The log is full, so only events still in it can be resumed from
+        self.assertIsNone(async_to_sync(get_missed_events)(self.groups[0], ids[1]))
+        self.assertEqual(async_to_sync(get_missed_events)(self.groups[0], ids[2]), [
+            {"event": "new", "id": 3, "eventId": ids[3]},
+        ])
+
+    @patch("socialhome.streams.consumers.async_to_sync", autospec=True)
+    def test_notify_listeners__profile_events_are_not_logged(self, mock_async_to_sync):
+        async_to_sync(mark_present)(self.groups[0], "channel.1")
+        profile = Mock(uuid="1234")
+        notify_listeners(profile, set(self.groups), "profile")
+        self.assertEqual(self.get_log(self.groups[0]), [])
+        mock_async_to_sync.return_value.assert_called_once_with({self.groups[0]}, {
+            "type": "notification", "payload": {"event": "profile", "uuid": "1234"},
+        })
+
+
+class TestCoalesceEvents(SocialhomeTestCase):
+    def test_coalesce_events(self):
+        self.assertEqual(coalesce_events([
+            {"event": "new", "id": 1, "eventId": "1-1"},
+            {"event": "update", "id": 2, "eventId": "1-2"},
+            {"event": "profile", "uuid": "1234"},
+            {"event": "update", "id": 1, "eventId": "1-3"},
+            {"event": "new", "id": 3, "eventId": "1-4"},
+            {"event": "update", "id": 2, "eventId": "1-5"},
+            {"event": "profile", "uuid": "1234"},
+        ]), [
+            {"event": "new", "id": 1, "eventId": "1-1"},
+            {"event": "new", "id": 3, "eventId": "1-4"},
+            {"event": "update", "id": 2, "eventId": "1-5"},
+            {"event": "profile", "uuid": "1234"},
+        ])
+
+
+class TestActivityThrottle(SocialhomeTestCase):
+    @override_settings(SOCIALHOME_USER_ACTIVITY_MARK_SECONDS=60)
+    @patch("socialhome.streams.consumers.time.monotonic")
+    def test_should_mark(self, mock_monotonic):
+        mock_monotonic.return_value = 1000
+        throttle = ActivityThrottle()
+        self.assertTrue(throttle.should_mark(1))
+        self.assertTrue(throttle.should_mark(2))
+        mock_monotonic.return_value = 1059
+        self.assertFalse(throttle.should_mark(1))
+        self.assertFalse(throttle.should_mark(2))
+        mock_monotonic.return_value = 1060
+        self.assertTrue(throttle.should_mark(1))
+        # Users not marked within the interval are forgotten
+        self.assertEqual(set(throttle.marked), {1})
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class TestStreamConsumer(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory()
+
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.r.delete(self.user.activity_key)
+        delete_stream_keys(["streams_consumer_test"])
+        self.addCleanup(self.r.delete, self.user.activity_key)
+        self.addCleanup(delete_stream_keys, ["streams_consumer_test"])
+        patcher = patch("socialhome.streams.consumers.activity_throttle", ActivityThrottle())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_communicator(self, user):
+        application = URLRouter([path("ch/streams/<str:stream>/", StreamConsumer.as_asgi())])
+        communicator = WebsocketCommunicator(application, "/ch/streams/consumer_test/")
+        communicator.scope["user"] = user
+        return communicator
+
+    def test_presence_and_activity(self):
+        async def run():
+            communicator = self.get_communicator(self.user)
+            connected, _subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(get_live_groups(["streams_consumer_test"]), {"streams_consumer_test"})
+            self.assertTrue(self.r.exists(self.user.activity_key))
+            await communicator.disconnect()
+            self.assertEqual(get_live_groups(["streams_consumer_test"]), set())
+
+        async_to_sync(run)()
+
+    def test_ping(self):
+        async def run():
+            communicator = self.get_communicator(self.user)
+            await communicator.connect()
+            self.r.delete(self.user.activity_key)
+            await communicator.send_to(text_data='{"event":"ping"}')
+            self.assertEqual(await communicator.receive_from(), '{"event":"pong"}')
+            # Activity was already marked on connect
+            self.assertFalse(self.r.exists(self.user.activity_key))
+            self.assertEqual(get_live_groups(["streams_consumer_test"]), {"streams_consumer_test"})
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_anonymous_user(self):
+        async def run():
+            communicator = self.get_communicator(AnonymousUser())
+            connected, _subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(get_live_groups(["streams_consumer_test"]), {"streams_consumer_test"})
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_notification(self):
+        async def run():
+            communicator = self.get_communicator(AnonymousUser())
+            await communicator.connect()
+            await get_channel_layer().group_send("streams_consumer_test", {
+                "type": "notification", "payload": {"event": "new", "id": 1, "parentId": None},
+            })
+            self.assertEqual(await communicator.receive_json_from(), {"event": "new", "id": 1, "parentId": None})
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    def test_resume(self):
+        async def run():
+            communicator = self.get_communicator(AnonymousUser())
+            await communicator.connect()
+            await communicator.disconnect()
+            # Sent while disconnected
+            first_id, _live = log_event(["streams_consumer_test"], {"event": "new", "id": 1, "parentId": None})
+            second_id, _live = log_event(["streams_consumer_test"], {"event": "new", "id": 2, "parentId": None})
+            communicator = self.get_communicator(AnonymousUser())
+            await communicator.connect()
+            await communicator.send_json_to({"event": "resume", "eventId": first_id})
+            self.assertEqual(
+                await communicator.receive_json_from(),
+                {"event": "new", "id": 2, "parentId": None, "eventId": second_id},
+            )
+            self.assertTrue(await communicator.receive_nothing())
+            await communicator.send_json_to({"event": "resume", "eventId": "foobar"})
+            self.assertEqual(await communicator.receive_json_from(), {"event": "resync"})
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    @override_settings(SOCIALHOME_STREAMS_NOTIFICATION_WINDOW_MS=50)
+    def test_notifications_are_coalesced(self):
+        async def run():
+            communicator = self.get_communicator(AnonymousUser())
+            await communicator.connect()
+            channel_layer = get_channel_layer()
+            for payload in (
+                {"event": "new", "id": 1, "parentId": None, "eventId": "1-1"},
+                {"event": "update", "id": 2, "eventId": "1-2"},
+                {"event": "new", "id": 3, "parentId": None, "eventId": "1-3"},
+                {"event": "update", "id": 2, "eventId": "1-4"},
+            ):
+                await channel_layer.group_send("streams_consumer_test", {"type": "notification", "payload": payload})
+            self.assertEqual(await communicator.receive_json_from(), {
+                "event": "batch",
+                "events": [
+                    {"event": "new", "id": 1, "parentId": None, "eventId": "1-1"},
+                    {"event": "new", "id": 3, "parentId": None, "eventId": "1-3"},
+                    {"event": "update", "id": 2, "eventId": "1-4"},
+                ],
+                "eventId": "1-4",
+            })
+            self.assertTrue(await communicator.receive_nothing(timeout=0.2))
+            # A single notification in the window is sent as is
+            await channel_layer.group_send("streams_consumer_test", {
+                "type": "notification", "payload": {"event": "new", "id": 4, "parentId": None, "eventId": "1-5"},
+            })
+            self.assertEqual(
+                await communicator.receive_json_from(), {"event": "new", "id": 4, "parentId": None, "eventId": "1-5"},
+            )
+            await communicator.disconnect()
+
+        async_to_sync(run)()
+
+    @override_settings(SOCIALHOME_STREAMS_NOTIFICATION_WINDOW_MS=50)
+    def test_resume__coalesced(self):
+        async def run():
+            first_id, _live = log_event(["streams_consumer_test"], {"event": "new", "id": 1, "parentId": None})
+            communicator = self.get_communicator(AnonymousUser())
+            await communicator.connect()
+            await communicator.disconnect()
+            second_id, _live = log_event(["streams_consumer_test"], {"event": "new", "id": 2, "parentId": None})
+            third_id, _live = log_event(["streams_consumer_test"], {"event": "new", "id": 3, "parentId": None})
+            communicator = self.get_communicator(AnonymousUser())
+            await communicator.connect()
+            await communicator.send_json_to({"event": "resume", "eventId": first_id})
+            self.assertEqual(await communicator.receive_json_from(), {
+                "event": "batch",
+                "events": [
+                    {"event": "new", "id": 2, "parentId": None, "eventId": second_id},
+                    {"event": "new", "id": 3, "parentId": None, "eventId": third_id},
+                ],
+                "eventId": third_id,
+            })
+            await communicator.disconnect()
+
+        async_to_sync(run)()
@@ -1,47 +1,181 @@
 import random
+import time
+from datetime import timedelta
 from unittest import mock, skip
 from unittest.mock import patch, Mock, call
 
+from django.conf import settings
 from django.contrib.auth.models import AnonymousUser
+from django.db import connection
 from django.db.models import Max
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now
 from freezegun import freeze_time
 
 from socialhome.content.models import Content, Tag
 from socialhome.content.tests.factories import (
-    ContentFactory, PublicContentFactory, SiteContentFactory, SelfContentFactory, LimitedContentFactory)
+    ContentFactory, PublicContentFactory, SiteContentFactory, SelfContentFactory, LimitedContentFactory,
+    LimitedContentWithRecipientsFactory)
 from socialhome.streams.enums import StreamType
+from socialhome.streams.models import TimelineEntry
 from socialhome.streams.streams import (
     BaseStream, FollowedStream, PublicStream, TagStream, add_to_redis, add_to_streams_for_users,
     update_streams_with_content, check_and_add_to_keys, ProfileAllStream, ProfilePinnedStream, LocalStream, TagsStream,
-    ALL_STREAMS)
+    ALL_STREAMS, get_fanout_keys, get_precache_users_qs, add_to_streams_for_users_chunk,
+    FANOUT_ON_READ_FOLLOWERS_KEY_PREFIX, FANOUT_ON_READ_PROFILES_KEY, HYDRATED_KEY_PREFIX, get_precache_streams,
+    rebuild_precaches,
+    PROFILE_GROUPS_EXPIRY, PROFILE_GROUPS_KEY_PREFIX, add_profile_groups, get_profile_groups,
+    update_profile_for_streams)
 from socialhome.tests.utils import SocialhomeTestCase
-from socialhome.users.tests.factories import UserFactory, PublicUserFactory
+from socialhome.users.models import User
+from socialhome.users.tests.factories import UserFactory, PublicUserFactory, PublicProfileFactory, SelfUserFactory
+from socialhome.utils import get_redis_connection
 
 
-@patch("socialhome.streams.streams.get_redis_connection")
 @patch("socialhome.streams.streams.time.time", return_value=123.123)
 class TestAddToRedis(SocialhomeTestCase):
-    def test_adds_each_key(self, mock_time, mock_get):
-        mock_hset = Mock()
-        mock_zadd = Mock()
-        mock_get.return_value = Mock(hset=mock_hset, zadd=mock_zadd, zrank=Mock(return_value=None))
-        add_to_redis(Mock(id=2), Mock(id=1), ["spam", "eggs"])
-        calls = [
-            call("spam", {2: 123}),
-            call("eggs", {2: 123}),
-        ]
-        self.assertEqual(mock_zadd.call_args_list, calls)
-        calls = [
-            call("spam:throughs", 2, 1),
-            call("eggs:throughs", 2, 1),
-        ]
-        self.assertEqual(mock_hset.call_args_list, calls)
-
-    def test_returns_on_no_keys(self, mock_time, mock_get):
-        mock_zadd = Mock()
-        mock_get.return_value = Mock(zadd=mock_zadd, zrank=Mock(return_value=None))
-        add_to_redis(Mock(), Mock(), [])
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory()
+
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.spam_key = "sh:streams:spam:%s" % self.user.id
+        self.eggs_key = "sh:streams:eggs:%s" % self.user.id
+        self.r.delete(self.spam_key, f"{self.spam_key}:throughs", self.eggs_key, f"{self.eggs_key}:throughs")
+
+    def test_adds_each_key(self, mock_time):
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=1), [self.spam_key, self.eggs_key]), 2)
+        for key in (self.spam_key, self.eggs_key):
+            self.assertEqual(self.r.zrange(key, 0, -1, withscores=True), [(b"2", 123)])
+            self.assertEqual(self.r.hgetall(f"{key}:throughs"), {b"2": b"1"})
+            self.assertTrue(0 < self.r.ttl(key) <= settings.REDIS_DEFAULT_EXPIRY)
+            self.assertTrue(0 < self.r.ttl(f"{key}:throughs") <= settings.REDIS_DEFAULT_EXPIRY)
+
+    def test_does_not_store_through_if_content(self, mock_time):
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=2), [self.spam_key]), 1)
+        self.assertEqual(self.r.zrange(self.spam_key, 0, -1), [b"2"])
+        self.assertFalse(self.r.exists(f"{self.spam_key}:throughs"))
+
+    def test_does_not_add_if_already_in_key(self, mock_time):
+        self.r.zadd(self.spam_key, {2: 100})
+        self.r.hset(f"{self.spam_key}:throughs", 2, 2)
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=2), [self.spam_key, self.eggs_key]), 1)
+        self.assertEqual(self.r.zrange(self.spam_key, 0, -1, withscores=True), [(b"2", 100)])
+        self.assertEqual(self.r.hgetall(f"{self.spam_key}:throughs"), {b"2": b"2"})
+        self.assertEqual(self.r.zrange(self.eggs_key, 0, -1, withscores=True), [(b"2", 123)])
+
+    def test_updates_through_if_already_in_key(self, mock_time):
+        self.r.zadd(self.spam_key, {2: 100})
+        self.r.hset(f"{self.spam_key}:throughs", 2, 2)
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=3), [self.spam_key]), 0)
+        self.assertEqual(self.r.zrange(self.spam_key, 0, -1, withscores=True), [(b"2", 100)])
+        self.assertEqual(self.r.hgetall(f"{self.spam_key}:throughs"), {b"2": b"3"})
+
+    def test_new_throughs_of_content_already_in_key_expire(self, mock_time):
+        self.r.zadd(self.spam_key, {2: 100})
+        self.r.expire(self.spam_key, settings.REDIS_DEFAULT_EXPIRY)
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=3), [self.spam_key]), 0)
+        self.assertEqual(self.r.hgetall(f"{self.spam_key}:throughs"), {b"2": b"3"})
+        self.assertTrue(0 < self.r.ttl(f"{self.spam_key}:throughs") <= settings.REDIS_DEFAULT_EXPIRY)
+
+    @patch("socialhome.streams.streams.ADD_TO_REDIS_BATCH_SIZE", new=1)
+    def test_adds_in_batches(self, mock_time):
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=1), [self.spam_key, self.eggs_key]), 2)
+        self.assertEqual(self.r.zrange(self.spam_key, 0, -1), [b"2"])
+        self.assertEqual(self.r.zrange(self.eggs_key, 0, -1), [b"2"])
+
+    @patch("socialhome.streams.streams.get_redis_connection")
+    def test_returns_on_no_keys(self, mock_get, mock_time):
+        self.assertEqual(add_to_redis(Mock(), Mock(), []), 0)
+        self.assertFalse(mock_get.called)
+
+    @override_settings(SOCIALHOME_STREAMS_PRECACHE_SIZE=3)
+    def test_trims_to_precache_size(self, mock_time):
+        self.r.zadd(self.spam_key, {1: 1, 2: 2, 3: 3})
+        self.r.hset(f"{self.spam_key}:throughs", mapping={1: 1, 2: 20, 3: 3})
+        self.assertEqual(add_to_redis(Mock(id=4), Mock(id=40), [self.spam_key]), 1)
+        self.assertEqual(self.r.zrange(self.spam_key, 0, -1), [b"2", b"3", b"4"])
+        self.assertEqual(self.r.hgetall(f"{self.spam_key}:throughs"), {b"2": b"20", b"3": b"3", b"4": b"40"})
+
+    @override_settings(SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE=0, SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS=10)
+    def test_does_not_add_to_inactive_user_or_missing_user_precache(self, mock_time):
+        User.objects.filter(id=self.user.id).update(last_login=now() - timedelta(days=11))
+        self.r.delete("sh:streams:spam:999999")
+        self.assertEqual(add_to_redis(Mock(id=2), Mock(id=2), [self.spam_key, "sh:streams:spam:999999"]), 0)
+        self.assertFalse(self.r.exists(self.spam_key))
+        self.assertFalse(self.r.exists("sh:streams:spam:999999"))
+
+
+@override_settings(SOCIALHOME_STREAMS_DURABLE_TIMELINES=True)
+class TestDurableTimelines(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.user = UserFactory()
+        cls.content = PublicContentFactory()
+        cls.share = PublicContentFactory(share_of=cls.content)
+        cls.other_content = PublicContentFactory()
+
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.stream = FollowedStream(user=self.user)
+        self.r.delete(
+            self.stream.key, BaseStream.get_throughs_key(self.stream.key), f"{HYDRATED_KEY_PREFIX}{self.stream.key}",
+        )
+
+    def test_add_to_redis_stores_entries(self):
+        add_to_redis(self.content, self.content, [self.stream.key])
+        add_to_redis(self.other_content, self.other_content, [self.stream.key, "sh:streams:followed:999999"])
+        self.assertEqual(
+            set(TimelineEntry.objects.values_list("key", "content_id", "through")),
+            {
+                (self.stream.key, self.content.id, self.content.id),
+                (self.stream.key, self.other_content.id, self.other_content.id),
+            },
+        )
+        # Share updates the through
+        add_to_redis(self.content, self.share, [self.stream.key])
+        self.assertEqual(TimelineEntry.objects.get(content=self.content).through, self.share.id)
+
+    @override_settings(SOCIALHOME_STREAMS_PRECACHE_SIZE=1)
+    def test_add_to_redis_trims_entries_to_precache_size(self):
+        with patch("socialhome.streams.streams.time.time", return_value=100):
+            add_to_redis(self.content, self.content, [self.stream.key])
+        with patch("socialhome.streams.streams.time.time", return_value=200):
+            add_to_redis(self.other_content, self.other_content, [self.stream.key])
+        self.assertEqual(
+            list(TimelineEntry.objects.values_list("key", "content_id")), [(self.stream.key, self.other_content.id)],
+        )
+
+    @override_settings(SOCIALHOME_STREAMS_DURABLE_TIMELINES=False)
+    def test_add_to_redis_does_not_store_entries_if_disabled(self):
+        add_to_redis(self.content, self.content, [self.stream.key])
+        self.assertFalse(TimelineEntry.objects.exists())
+
+    def test_get_cached_content_ids__fills_lost_precache(self):
+        with patch("socialhome.streams.streams.time.time", return_value=100):
+            add_to_redis(self.content, self.share, [self.stream.key])
+        with patch("socialhome.streams.streams.time.time", return_value=200):
+            add_to_redis(self.other_content, self.other_content, [self.stream.key])
+        self.r.delete(self.stream.key, BaseStream.get_throughs_key(self.stream.key))
+        self.assertEqual(
+            self.stream.get_cached_content_ids(),
+            (
+                [self.other_content.id, self.content.id],
+                {self.other_content.id: self.other_content.id, self.content.id: self.share.id},
+            ),
+        )
+        self.assertTrue(0 < self.r.ttl(self.stream.key) <= settings.REDIS_DEFAULT_EXPIRY)
+
+    def test_get_cached_content_ids__fills_once(self):
+        self.assertEqual(self.stream.get_cached_content_ids(), ([], {}))
+        with self.assertNumQueries(0):
+            self.assertEqual(self.stream.get_cached_content_ids(), ([], {}))
 
 
 class TestAddToStreamForUsers(SocialhomeTestCase):
@@ -63,24 +197,69 @@ class TestAddToStreamForUsers(SocialhomeTestCase):
         stream3 = PublicStream(user=self.user)
         mock_add.assert_called_once_with(self.content, self.content, [stream1.key, stream3.key])
 
-    @patch("socialhome.streams.streams.check_and_add_to_keys", autospec=True)
-    def test_calls_check_and_add_to_keys_for_each_user(self, mock_check):
+    @patch("socialhome.streams.streams.get_fanout_keys", autospec=True, return_value=([], set()))
+    def test_calls_get_fanout_keys_for_users(self, mock_get):
         add_to_streams_for_users(self.content.id, self.content.id, self.content.author.id)
-        calls = [call(cls, self.user, self.content, [], self.content.author, set(), False) for cls in ALL_STREAMS]
-        assert mock_check.call_count == len(ALL_STREAMS)
-        mock_check.assert_has_calls(calls, any_order=True)
+        mock_get.assert_called_once_with(self.content, self.content.author, [self.user], False)
 
-    @patch("socialhome.streams.streams.check_and_add_to_keys", autospec=True)
+    @patch("socialhome.streams.streams.get_fanout_keys", autospec=True, return_value=([], set()))
     @override_settings(SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS=2)
     @freeze_time('2018-02-01')
-    def test_calls_check_and_add_to_keys_for_each_user__skipping_inactives(self, mock_check):
+    def test_calls_get_fanout_keys_for_users__skipping_inactives(self, mock_get):
         with freeze_time('2018-01-25'):
             PublicUserFactory()
         add_to_streams_for_users(self.content.id, self.content.id, self.content.author.id)
-        # Would be called twice for each stream if inactives were not filtered out
-        calls = [call(cls, self.user, self.content, [], self.content.author, set(), False) for cls in ALL_STREAMS]
-        assert mock_check.call_count == len(ALL_STREAMS)
-        mock_check.assert_has_calls(calls)
+        mock_get.assert_called_once_with(self.content, self.content.author, [self.user], False)
+
+    @override_settings(SOCIALHOME_STREAMS_FANOUT_CHUNK_SIZE=1)
+    @patch("socialhome.streams.streams.get_fanout_keys", autospec=True)
+    @patch("socialhome.streams.streams.tasks")
+    def test_queues_chunks_if_more_users_than_chunk_size(self, mock_tasks, mock_get):
+        user2 = PublicUserFactory()
+        add_to_streams_for_users(self.content.id, self.content.id, self.content.author.id)
+        self.assertFalse(mock_get.called)
+        calls = mock_tasks.add_to_streams_for_users_chunk.send.call_args_list
+        self.assertEqual(len(calls), 2)
+        fanout_key = calls[0][0][5]
+        self.assertEqual(
+            calls,
+            [
+                call(self.content.id, self.content.id, self.content.author.id, self.user.id, self.user.id, fanout_key),
+                call(self.content.id, self.content.id, self.content.author.id, user2.id, user2.id, fanout_key),
+            ],
+        )
+        self.assertEqual(get_redis_connection().get(fanout_key), b"2")
+
+    @patch("socialhome.streams.streams.notify_listeners", autospec=True)
+    @patch("socialhome.streams.streams.add_to_redis", autospec=True)
+    @patch("socialhome.streams.streams.get_fanout_keys", autospec=True, return_value=(["spam"], {"eggs"}))
+    def test_chunk_notifies_only_once_and_tracks_completion(self, mock_get, mock_add, mock_notify):
+        r = get_redis_connection()
+        user2 = PublicUserFactory()
+        mock_notify.reset_mock()
+        fanout_key = "sh:fanout:test"
+        r.delete(fanout_key, f"{fanout_key}:{self.user.id}", f"{fanout_key}:{user2.id}")
+        r.set(fanout_key, 2)
+        add_to_streams_for_users_chunk(
+            self.content.id, self.content.id, self.content.author.id, self.user.id, self.user.id, fanout_key,
+        )
+        mock_get.assert_called_once_with(self.content, self.content.author, [self.user], False)
+        mock_add.assert_called_once_with(self.content, self.content, ["spam"])
+        mock_notify.assert_called_once_with(self.content, {"eggs"})
+        self.assertEqual(r.get(fanout_key), b"1")
+        # Retry of the same chunk writes keys again but doesn't notify
+        mock_notify.reset_mock()
+        add_to_streams_for_users_chunk(
+            self.content.id, self.content.id, self.content.author.id, self.user.id, self.user.id, fanout_key,
+        )
+        self.assertEqual(mock_add.call_count, 2)
+        self.assertFalse(mock_notify.called)
+        # Last chunk completes the fan-out
+        add_to_streams_for_users_chunk(
+            self.content.id, self.content.id, self.content.author.id, user2.id, user2.id, fanout_key,
+        )
+        mock_notify.assert_called_once_with(self.content, {"eggs"})
+        self.assertFalse(r.exists(fanout_key))
 
     @patch("socialhome.streams.streams.Content.objects.filter")
     def test_returns_on_no_content(self, mock_filter):
@@ -90,6 +269,229 @@ class TestAddToStreamForUsers(SocialhomeTestCase):
         self.assertFalse(mock_filter.called)
 
 
+class TestGetFanoutKeys(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.create_local_and_remote_user()
+        cls.sharer = PublicProfileFactory()
+        cls.local_author = PublicUserFactory()
+        cls.self_user = SelfUserFactory()
+        cls.tag_follower = PublicUserFactory()
+        cls.sharer_follower = PublicUserFactory()
+        cls.recipient = PublicUserFactory()
+        cls.profile.following.add(cls.remote_profile, cls.local_author.profile)
+        cls.sharer_follower.profile.following.add(cls.sharer)
+        cls.self_user.profile.following.add(cls.local_author.profile)
+        cls.public_content = PublicContentFactory(author=cls.remote_profile, text="#spam")
+        cls.site_content = SiteContentFactory(author=cls.remote_profile)
+        cls.limited_content = LimitedContentWithRecipientsFactory(
+            author=cls.remote_profile, recipients=[cls.recipient.profile, cls.profile],
+        )
+        cls.self_content = SelfContentFactory(author=cls.remote_profile)
+        cls.local_content = PublicContentFactory(author=cls.local_author.profile, text="#spam #eggs", pinned=True)
+        cls.local_limited_content = LimitedContentWithRecipientsFactory(
+            author=cls.local_author.profile, recipients=[cls.recipient.profile],
+        )
+        cls.share = PublicContentFactory(share_of=cls.public_content, author=cls.sharer)
+        cls.self_profile_content = PublicContentFactory(author=cls.self_user.profile)
+        cls.reply = PublicContentFactory(parent=cls.local_content, author=cls.remote_profile, text="#eggs")
+        cls.tag_follower.profile.followed_tags.add(Tag.objects.get(name="spam"))
+
+    def setUp(self):
+        super().setUp()
+        for user in (self.user, self.tag_follower, self.recipient, self.self_user):
+            user.mark_recently_active()
+
+    @staticmethod
+    def get_legacy_keys(content, acting_profile, is_share):
+        cache_keys = []
+        notify_keys = set()
+        for stream_cls in ALL_STREAMS:
+            for user in get_precache_users_qs(acting_profile):
+                check_and_add_to_keys(stream_cls, user, content, cache_keys, acting_profile, notify_keys, is_share)
+        return cache_keys, notify_keys
+
+    def assert_same_keys_as_legacy(self, content, acting_profile, is_share=False):
+        users = list(get_precache_users_qs(acting_profile))
+        self.assertEqual(
+            get_fanout_keys(content, acting_profile, users, is_share),
+            self.get_legacy_keys(content, acting_profile, is_share),
+        )
+
+    def test_keys_match_per_user_checks(self):
+        for content in (
+            self.public_content, self.site_content, self.limited_content, self.self_content, self.local_content,
+            self.local_limited_content, self.self_profile_content,
+        ):
+            with self.subTest(content=content):
+                self.assert_same_keys_as_legacy(content, content.author)
+
+    def test_keys_match_per_user_checks__share(self):
+        self.assert_same_keys_as_legacy(self.public_content, self.sharer, is_share=True)
+
+    def test_keys_match_per_user_checks__reply(self):
+        self.assert_same_keys_as_legacy(self.reply, self.local_content.author)
+
+    def test_content_facts_are_queried_once(self):
+        users = list(get_precache_users_qs(self.local_author.profile))
+        for content, table in (
+            (self.local_content, "content_content_tags"),
+            (self.local_limited_content, "content_content_limited_visibilities"),
+        ):
+            with self.subTest(content=content), CaptureQueriesContext(connection) as context:
+                get_fanout_keys(content, self.local_author.profile, users, False)
+                queries = [query for query in context.captured_queries if f'FROM "{table}"' in query["sql"]
+                           or f'JOIN "{table}"' in query["sql"]]
+                self.assertEqual(len(queries), 1)
+
+    @override_settings(SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS=1)
+    def test_fanout_on_read__only_followers_of_acting_profile_use_profile_key(self):
+        r = get_redis_connection()
+        profile_key = FollowedStream.get_profile_key(self.sharer.id)
+        followers_key = f"{FANOUT_ON_READ_FOLLOWERS_KEY_PREFIX}{self.sharer.id}"
+        r.delete(FANOUT_ON_READ_PROFILES_KEY, followers_key)
+        self.addCleanup(r.delete, FANOUT_ON_READ_PROFILES_KEY, followers_key)
+        cache_keys, _notify_keys = get_fanout_keys(
+            self.public_content, self.sharer, [self.user, self.sharer_follower], is_share=True,
+        )
+        # The follower of the author does not follow the sharer, so does not read the sharer key
+        self.assertIn(FollowedStream(user=self.user).key, cache_keys)
+        self.assertIn(profile_key, cache_keys)
+        self.assertNotIn(FollowedStream(user=self.sharer_follower).key, cache_keys)
+
+    def test_query_count_does_not_depend_on_user_count(self):
+        users = list(get_precache_users_qs(self.remote_profile))
+        some_users = [user for user in users if user.id in (self.user.id, self.recipient.id)]
+        # Warm up the author
+        self.assertFalse(self.limited_content.author.is_local)
+        with CaptureQueriesContext(connection) as context:
+            get_fanout_keys(self.limited_content, self.remote_profile, some_users, False)
+        with self.assertNumQueries(len(context.captured_queries)):
+            get_fanout_keys(self.limited_content, self.remote_profile, users, False)
+
+
+class TestRebuildPrecaches(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.create_local_and_remote_user()
+        cls.local_user = UserFactory()
+        cls.remote_profile.followers.add(cls.profile)
+        cls.content = PublicContentFactory(author=cls.remote_profile)
+        cls.other_content = PublicContentFactory(author=cls.remote_profile)
+        cls.share = PublicContentFactory(share_of=cls.content, author=cls.local_user.profile)
+        cls.content.refresh_from_db()
+        cls.local_public = PublicContentFactory(author=cls.local_user.profile)
+        cls.local_self = SelfContentFactory(author=cls.profile)
+
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.followed = FollowedStream(user=self.user)
+        self.local = LocalStream(user=self.user)
+        keys = [self.followed.key, self.local.key, self.local.get_shared_key()]
+        self.r.delete(*keys, *[BaseStream.get_throughs_key(key) for key in keys])
+
+    def test_get_precache_streams(self):
+        tag = Tag.objects.create(name="rebuild")
+        self.profile.followed_tags.add(tag)
+        streams = get_precache_streams(self.user)
+        self.assertEqual(
+            {stream.key for stream in streams},
+            {
+                self.followed.key, f"sh:streams:limited:{self.user.id}", self.local.key,
+                f"sh:streams:profile_all:{self.profile.id}:{self.user.id}", "sh:streams:public:shared",
+                f"sh:streams:tags:{self.user.id}", f"sh:streams:tag:{tag.id}:{self.user.id}",
+            },
+        )
+        self.assertEqual(
+            [stream.key for stream in get_precache_streams(self.user, [StreamType.FOLLOWED])], [self.followed.key],
+        )
+
+    def test_rebuild_precaches(self):
+        self.r.zadd(self.followed.key, {123456: 1})
+        self.assertEqual(rebuild_precaches([self.followed, self.local]), 2)
+        self.assertEqual(
+            self.followed.get_cached_content_ids(),
+            (
+                [self.other_content.id, self.content.id],
+                {self.other_content.id: self.other_content.id, self.content.id: self.share.id},
+            ),
+        )
+        self.assertEqual(self.r.zrange(self.local.key, 0, -1), [str(self.local_self.id).encode()])
+        self.assertFalse(self.r.exists(self.local.get_shared_key()))
+
+    def test_rebuild_precaches__shared(self):
+        self.assertEqual(rebuild_precaches([self.followed, self.local], shared=True), 1)
+        self.assertEqual(self.r.zrange(self.local.get_shared_key(), 0, -1), [str(self.local_public.id).encode()])
+        self.assertFalse(self.r.exists(self.local.key))
+
+    @override_settings(SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS=1)
+    def test_rebuild_precaches__leaves_profile_keys_alone(self):
+        profile_key = FollowedStream.get_profile_key(self.remote_profile.id)
+        self.r.delete(profile_key)
+        self.r.zadd(FANOUT_ON_READ_PROFILES_KEY, {self.remote_profile.id: int(time.time())})
+        self.r.zadd(profile_key, {self.content.id: 1})
+        self.addCleanup(self.r.delete, FANOUT_ON_READ_PROFILES_KEY, profile_key)
+        self.assertIn(profile_key, self.followed.cached_keys)
+        for shared in (False, True):
+            with self.subTest(shared=shared):
+                rebuild_precaches([self.followed], shared=shared)
+                self.assertEqual(self.r.zrange(profile_key, 0, -1), [str(self.content.id).encode()])
+
+    def test_rebuild_precaches__scores_are_whole_seconds(self):
+        rebuild_precaches([self.followed])
+        self.assertEqual(
+            self.r.zscore(self.followed.key, self.content.id), int(self.content.created.timestamp()),
+        )
+        self.assertTrue(all(
+            score.is_integer() for _member, score in self.r.zrange(self.followed.key, 0, -1, withscores=True)
+        ))
+
+    @override_settings(SOCIALHOME_STREAMS_PRECACHE_SIZE=1)
+    def test_rebuild_precaches__size(self):
+        rebuild_precaches([self.followed])
+        self.assertEqual(self.r.zrange(self.followed.key, 0, -1), [str(self.other_content.id).encode()])
+
+
+class TestProfileGroups(SocialhomeTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.profile = PublicProfileFactory()
+        cls.other_profile = PublicProfileFactory()
+
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.r.delete(*(f"{PROFILE_GROUPS_KEY_PREFIX}{profile.id}" for profile in (self.profile, self.other_profile)))
+
+    def test_add_profile_groups(self):
+        add_profile_groups("streams_public__1", [self.profile.id, self.other_profile.id])
+        add_profile_groups("streams_followed__1", [self.profile.id])
+        self.assertEqual(
+            set(get_profile_groups(self.profile.id)), {"streams_public__1", "streams_followed__1"},
+        )
+        self.assertEqual(get_profile_groups(self.other_profile.id), ["streams_public__1"])
+        self.assertTrue(0 < self.r.ttl(f"{PROFILE_GROUPS_KEY_PREFIX}{self.profile.id}") <= PROFILE_GROUPS_EXPIRY)
+
+    def test_expired_groups_are_not_returned(self):
+        with patch("socialhome.streams.streams.time.time", return_value=time.time() - PROFILE_GROUPS_EXPIRY - 10):
+            add_profile_groups("streams_public__1", [self.profile.id])
+        add_profile_groups("streams_followed__1", [self.profile.id])
+        self.assertEqual(get_profile_groups(self.profile.id), ["streams_followed__1"])
+        # Expired groups are removed when adding
+        self.assertEqual(self.r.zcard(f"{PROFILE_GROUPS_KEY_PREFIX}{self.profile.id}"), 1)
+
+    @patch("socialhome.streams.streams.notify_listeners")
+    def test_update_profile_for_streams_notifies_profile_groups(self, mock_notify):
+        add_profile_groups("streams_public__1", [self.profile.id])
+        add_profile_groups("streams_followed__1", [self.other_profile.id])
+        update_profile_for_streams(self.profile)
+        mock_notify.assert_called_once_with(self.profile, {"streams_public__1"}, "profile")
+
+
 class TestCheckAndAddToKeys(SocialhomeTestCase):
     @classmethod
     def setUpTestData(cls):
@@ -156,7 +558,7 @@ class TestUpdateStreamsWithContent(SocialhomeTestCase):
         self.assertFalse(mock_add.called)
         self.user.mark_recently_active()
         update_streams_with_content(self.content)
-        mock_add.assert_called_once_with(self.content, self.content, ["sh:streams:public:%s" % self.user.id])
+        mock_add.assert_called_once_with(self.content, self.content, ["sh:streams:public:shared"])
 
 
 @patch("socialhome.streams.streams.BaseStream.get_queryset", return_value=Content.objects.all())
@@ -175,52 +577,61 @@ class TestBaseStream(SocialhomeTestCase):
     def test___str__(self, mock_queryset):
         self.assertEqual(str(self.stream), "BaseStream (%s)" % str(self.user))
 
-    @patch("socialhome.streams.streams.get_redis_connection")
-    def test_get_cached_content_ids__calls(self, mock_get, mock_queryset):
-        mock_redis = Mock(zrevrange=Mock(return_value=[]))
-        mock_get.return_value = mock_redis
+    def set_cached_ids(self, ids, throughs=None):
         self.stream.stream_type = StreamType.PUBLIC
-        self.stream.get_cached_content_ids()
-        # Skips zrevrank if not last_id
-        self.assertFalse(mock_redis.zrevrank.called)
-        # Calls zrevrange with correct parameters
-        mock_redis.zrevrange.assert_called_once_with(self.stream.key, 0, self.stream.paginate_by-1)
-        mock_redis.reset_mock()
-        # Calls zrevrank with last_id
-        self.stream.last_id = self.content2.id
-        mock_redis.zrevrank.return_value = 3
-        self.stream.get_cached_content_ids()
-        mock_redis.zrevrank.assert_called_once_with(self.stream.key, self.content2.id)
-        mock_redis.zrevrange.assert_called_once_with(self.stream.key, 4, 4 + self.stream.paginate_by-1)
+        r = get_redis_connection()
+        r.delete(self.stream.key, BaseStream.get_throughs_key(self.stream.key))
+        r.zadd(self.stream.key, {id: id for id in ids})
+        r.hset(BaseStream.get_throughs_key(self.stream.key), mapping=throughs or {id: id for id in ids})
+
+    def test_get_cached_content_ids(self, mock_queryset):
+        self.set_cached_ids(range(1, 11), {id: id * 10 for id in range(1, 11)})
+        self.stream.paginate_by = 3
+        self.assertEqual(self.stream.get_cached_content_ids(), ([10, 9, 8], {10: 100, 9: 90, 8: 80}))
+        self.stream.last_id = 8
+        self.assertEqual(self.stream.get_cached_content_ids(), ([7, 6, 5], {7: 70, 6: 60, 5: 50}))
+        self.stream.last_id = 2
+        self.assertEqual(self.stream.get_cached_content_ids(), ([1], {1: 10}))
+
+    def test_get_cached_content_ids__first_id(self, mock_queryset):
+        self.set_cached_ids(range(1, 11))
+        self.stream.paginate_by = 3
+        self.stream.first_id = 9
+        self.assertEqual(self.stream.get_cached_content_ids(), ([10], {10: 10}))
+        self.assertFalse(self.stream.unfetched_content)
+        self.stream.first_id = 4
+        self.assertEqual(self.stream.get_cached_content_ids(), ([10, 9, 8], {10: 10, 9: 9, 8: 8}))
+        self.assertTrue(self.stream.unfetched_content)
+        self.stream.first_id = 123
+        self.assertEqual(self.stream.get_cached_content_ids(), ([10, 9, 8], {10: 10, 9: 9, 8: 8}))
+        self.assertTrue(self.stream.unfetched_content)
+        self.stream.first_id = 10
+        self.assertEqual(self.stream.get_cached_content_ids(), ([], {}))
+        self.assertFalse(self.stream.unfetched_content)
+        # Window between two ids
+        self.stream.last_id = 9
+        self.stream.first_id = 5
+        self.assertEqual(self.stream.get_cached_content_ids(), ([8, 7, 6], {8: 8, 7: 7, 6: 6}))
+        self.assertFalse(self.stream.unfetched_content)
+        # Nothing is newer than the first id
+        self.stream.last_id = 5
+        self.stream.first_id = 10
+        self.assertEqual(self.stream.get_cached_content_ids(), ([], {}))
+        self.assertFalse(self.stream.unfetched_content)
 
-    @patch("socialhome.streams.streams.get_redis_connection")
-    def test_get_cached_content_ids__returns_empty_list_if_outside_cached_ids(self, mock_get, mock_queryset):
-        mock_redis = Mock(zrevrank=Mock(return_value=None))
-        mock_get.return_value = mock_redis
-        self.stream.stream_type = StreamType.PUBLIC
+    def test_get_cached_content_ids__returns_empty_list_if_outside_cached_ids(self, mock_queryset):
+        self.set_cached_ids(range(1, 11))
         self.stream.last_id = 123
         self.assertEqual(self.stream.get_cached_content_ids(), ([], {}))
-        self.assertFalse(mock_redis.zrevrange.called)
 
-    @patch("socialhome.streams.streams.get_redis_connection")
-    def test_get_cached_range(self, mock_get, mock_queryset):
-        self.stream.stream_type = StreamType.PUBLIC
-        mock_zrevrange = Mock(return_value=[str(self.content2.id), str(self.content1.id)])
-        mock_hmget = Mock(return_value=[str(self.content2.id), str(self.content1.id)])
-        mock_redis = Mock(zrevrange=mock_zrevrange, hmget=mock_hmget)
-        mock_get.return_value = mock_redis
-        ids, throughs = self.stream.get_cached_range(0, 0 + self.stream.paginate_by)
-        self.assertEqual(ids, [self.content2.id, self.content1.id])
-        self.assertEqual(throughs, {self.content2.id: self.content2.id, self.content1.id: self.content1.id})
-        mock_zrevrange.assert_called_once_with(self.stream.key, 0, 0 + self.stream.paginate_by)
-        mock_hmget.assert_called_once_with(BaseStream.get_throughs_key(self.stream.key), keys=[
-            self.content2.id, self.content1.id,
-        ])
-
-        # Non-zero index
-        mock_zrevrange.reset_mock()
-        self.stream.get_cached_range(5, 5 + self.stream.paginate_by)
-        mock_zrevrange.assert_called_once_with(self.stream.key, 5, 5 + self.stream.paginate_by)
+    def test_get_cached_content_ids__uses_one_call(self, mock_queryset):
+        self.set_cached_ids(range(1, 11))
+        self.stream.last_id = 8
+        self.stream.first_id = 2
+        self.stream.init_redis_connection()
+        with patch.object(self.stream.redis, "execute_command", wraps=self.stream.redis.execute_command) as mock_exec:
+            self.stream.get_cached_content_ids()
+            self.assertEqual(mock_exec.call_count, 1)
 
     def test_get_content(self, mock_queryset):
         qs, throughs = self.stream.get_content()
@@ -280,6 +691,14 @@ class TestBaseStream(SocialhomeTestCase):
             stream.get_content_ids()
             self.assertEqual(mock_queryset.call_count, 0)
 
+    def test_get_unfetched_count(self, mock_queryset):
+        self.assertEqual(self.stream.get_unfetched_count(), 2)
+        self.assertEqual(self.stream.get_unfetched_count(limit=1), 1)
+        self.stream.first_id = self.content1.id
+        self.assertEqual(self.stream.get_unfetched_count(), 1)
+        self.stream.first_id = self.content2.id
+        self.assertEqual(self.stream.get_unfetched_count(), 0)
+
     def test_get_key_user_id(self, mock_queryset):
         self.assertEqual(BaseStream.get_key_user_id("spam:eggs:1"), 1)
         self.assertEqual(BaseStream.get_key_user_id("spam:eggs:1:throughs"), 1)
@@ -287,6 +706,14 @@ class TestBaseStream(SocialhomeTestCase):
         self.assertEqual(BaseStream.get_key_user_id("spam:eggs:1:2:throughs"), 2)
         self.assertIsNone(BaseStream.get_key_user_id("spam:eggs:anonymous"))
         self.assertIsNone(BaseStream.get_key_user_id("spam:eggs:anonymous:throughs"))
+        self.assertIsNone(BaseStream.get_key_user_id("spam:eggs:shared"))
+        self.assertIsNone(BaseStream.get_key_user_id("spam:eggs:shared:throughs"))
+
+    def test_is_shared_key(self, mock_queryset):
+        self.assertTrue(BaseStream.is_shared_key("spam:eggs:shared"))
+        self.assertTrue(BaseStream.is_shared_key("spam:eggs:shared:throughs"))
+        self.assertFalse(BaseStream.is_shared_key("spam:eggs:1"))
+        self.assertFalse(BaseStream.is_shared_key("spam:eggs:anonymous"))
 
     def test_init(self, mock_queryset):
         stream = BaseStream(last_id=333, user="user")
@@ -328,6 +755,34 @@ class TestFollowedStream(SocialhomeTestCase):
         super().setUp()
         self.stream = FollowedStream(user=self.user)
 
+    def test_cached_keys(self):
+        self.assertEqual(self.stream.cached_keys, [self.stream.key])
+
+    @override_settings(SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS=1)
+    def test_cached_keys__fanout_on_read(self):
+        r = get_redis_connection()
+        r.delete(FANOUT_ON_READ_PROFILES_KEY)
+        self.addCleanup(r.delete, FANOUT_ON_READ_PROFILES_KEY)
+        self.assertEqual(self.stream.cached_keys, [self.stream.key])
+        now = int(time.time())
+        r.zadd(FANOUT_ON_READ_PROFILES_KEY, {self.remote_profile.id: now, self.other_public_content.author_id: now})
+        stream = FollowedStream(user=self.user)
+        self.assertEqual(
+            stream.cached_keys, [stream.key, "sh:streams:followed:%s:shared" % self.remote_profile.id],
+        )
+        # Profiles not fanned out on read within the precache expiry are not read
+        r.zadd(FANOUT_ON_READ_PROFILES_KEY, {self.remote_profile.id: now - settings.REDIS_DEFAULT_EXPIRY - 1})
+        stream = FollowedStream(user=self.user)
+        self.assertEqual(stream.cached_keys, [stream.key])
+
+    def test_get_cache_key(self):
+        self.assertEqual(self.stream.get_cache_key(self.public_content), self.stream.key)
+        self.stream.fanout_on_read_profile = self.remote_profile
+        profile_key = "sh:streams:followed:%s:shared" % self.remote_profile.id
+        self.assertEqual(self.stream.get_cache_key(self.public_content), profile_key)
+        self.assertEqual(self.stream.get_cache_key(self.site_content), profile_key)
+        self.assertEqual(self.stream.get_cache_key(self.limited_content), self.stream.key)
+
     def test_get_content_ids__uses_cached_ids(self):
         with patch.object(self.stream, "get_cached_content_ids", return_value=([], {})) as mock_cached:
             self.stream.get_content_ids()
@@ -342,11 +797,107 @@ class TestFollowedStream(SocialhomeTestCase):
             all_ids = set(cached_ids + [self.site_content.id])
             self.assertEqual(set(self.stream.get_content_ids()[0]), all_ids)
 
+    @override_settings(SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS=1)
+    def test_get_fanout_keys__fanout_on_read(self):
+        r = get_redis_connection()
+        profile_key = "sh:streams:followed:%s:shared" % self.remote_profile.id
+        followers_key = f"{FANOUT_ON_READ_FOLLOWERS_KEY_PREFIX}{self.remote_profile.id}"
+        r.delete(FANOUT_ON_READ_PROFILES_KEY, followers_key, profile_key, self.stream.key)
+        self.addCleanup(r.delete, FANOUT_ON_READ_PROFILES_KEY, followers_key)
+        cache_keys, _notify_keys = get_fanout_keys(
+            self.public_content, self.remote_profile, [self.user], is_share=False,
+        )
+        self.assertIn(profile_key, cache_keys)
+        self.assertNotIn(self.stream.key, cache_keys)
+        self.assertEqual(r.zrange(FANOUT_ON_READ_PROFILES_KEY, 0, -1), [str(self.remote_profile.id).encode()])
+        add_to_redis(self.public_content, self.public_content, cache_keys)
+        stream = FollowedStream(user=self.user)
+        self.assertEqual(
+            stream.get_cached_content_ids(),
+            ([self.public_content.id], {self.public_content.id: self.public_content.id}),
+        )
+
     def test_get_target_streams(self):
         self.assertEqual(
             len(FollowedStream.get_target_streams(self.public_content, self.user, self.public_content.author)), 1,
         )
 
+    def test_get_unfetched_count(self):
+        r = get_redis_connection()
+        r.delete(self.stream.key)
+        r.zadd(self.stream.key, {id: id for id in range(1, 11)})
+        self.stream.first_id = 4
+        with patch.object(self.stream, "get_window_queryset") as mock_queryset:
+            self.assertEqual(self.stream.get_unfetched_count(), 6)
+            self.assertEqual(self.stream.get_unfetched_count(limit=5), 5)
+            self.stream.last_id = 8
+            self.assertEqual(self.stream.get_unfetched_count(), 3)
+            self.stream.first_id = 10
+            self.assertEqual(self.stream.get_unfetched_count(), 0)
+            self.assertFalse(mock_queryset.called)
+
+    def test_get_unfetched_count__same_scores(self):
+        r = get_redis_connection()
+        r.delete(self.stream.key)
+        # Content added within the same second has the same score
+        r.zadd(self.stream.key, {id: 1 for id in range(1, 10)})
+        self.stream.first_id = 4
+        with patch.object(self.stream, "get_window_queryset") as mock_queryset:
+            self.assertEqual(self.stream.get_unfetched_count(), 5)
+            self.stream.last_id = 8
+            self.assertEqual(self.stream.get_unfetched_count(), 3)
+            self.stream.first_id = 1
+            self.assertEqual(self.stream.get_unfetched_count(), 6)
+            self.assertFalse(mock_queryset.called)
+
+    def test_get_unfetched_count__not_cached(self):
+        get_redis_connection().delete(self.stream.key)
+        self.stream.first_id = self.public_content.id
+        self.assertEqual(self.stream.get_unfetched_count(), 1)
+
+    def test_get_content_ids__merges_authored_and_shared_content(self):
+        share = PublicContentFactory(share_of=self.other_public_content, author=self.remote_profile)
+        self.other_public_content.refresh_from_db()
+        self.assertEqual(self.other_public_content.through, share.id)
+        self.stream.paginate_by = 1
+        pages = []
+        with patch.object(self.stream, "get_cached_content_ids", side_effect=lambda: ([], {})):
+            while len(pages) < 5:
+                ids, throughs = self.stream.get_content_ids()
+                if not ids:
+                    break
+                pages.append((ids, throughs))
+                self.stream.last_id = throughs[ids[-1]]
+        self.assertEqual(pages, [
+            ([self.other_public_content.id], {self.other_public_content.id: share.id}),
+            ([self.site_content.id], {self.site_content.id: self.site_content.id}),
+            ([self.public_content.id], {self.public_content.id: self.public_content.id}),
+        ])
+
+    def test_is_fanout_on_read(self):
+        r = get_redis_connection()
+        followers_key = f"{FANOUT_ON_READ_FOLLOWERS_KEY_PREFIX}{self.remote_profile.id}"
+        r.delete(FANOUT_ON_READ_PROFILES_KEY, followers_key)
+        self.addCleanup(r.delete, FANOUT_ON_READ_PROFILES_KEY, followers_key)
+        self.assertFalse(FollowedStream.is_fanout_on_read(self.remote_profile))
+        with override_settings(SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS=1):
+            self.assertTrue(FollowedStream.is_fanout_on_read(self.remote_profile))
+        self.assertEqual(r.zrange(FANOUT_ON_READ_PROFILES_KEY, 0, -1), [str(self.remote_profile.id).encode()])
+        with override_settings(SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS=2):
+            # The follower count is cached
+            with self.assertNumQueries(0):
+                self.assertFalse(FollowedStream.is_fanout_on_read(self.remote_profile))
+
+    @override_settings(SOCIALHOME_STREAMS_FANOUT_ON_READ_FOLLOWERS=1)
+    def test_is_fanout_on_read__prunes_stale_profiles(self):
+        r = get_redis_connection()
+        followers_key = f"{FANOUT_ON_READ_FOLLOWERS_KEY_PREFIX}{self.remote_profile.id}"
+        r.delete(FANOUT_ON_READ_PROFILES_KEY, followers_key)
+        self.addCleanup(r.delete, FANOUT_ON_READ_PROFILES_KEY, followers_key)
+        r.zadd(FANOUT_ON_READ_PROFILES_KEY, {999999: int(time.time()) - settings.REDIS_DEFAULT_EXPIRY - 10})
+        self.assertTrue(FollowedStream.is_fanout_on_read(self.remote_profile))
+        self.assertEqual(r.zrange(FANOUT_ON_READ_PROFILES_KEY, 0, -1), [str(self.remote_profile.id).encode()])
+
     def test_get_throughs_key(self):
         self.assertEqual(
             self.stream.get_throughs_key(self.stream.key), "sh:streams:followed:%s:throughs" % self.user.id,
@@ -396,6 +947,56 @@ class TestLocalStream(SocialhomeTestCase):
     def test_key(self):
         self.assertEqual(self.stream.key, "sh:streams:local:%s" % self.other_user.id)
 
+    def test_cached_keys(self):
+        self.assertEqual(self.stream.cached_keys, [self.stream.key, "sh:streams:local:shared"])
+        anon_stream = LocalStream(user=AnonymousUser())
+        self.assertEqual(anon_stream.cached_keys, [anon_stream.key])
+
+    def test_get_cache_key(self):
+        self.assertEqual(self.stream.get_cache_key(self.public_content), "sh:streams:local:shared")
+        self.assertEqual(self.stream.get_cache_key(self.site_content), "sh:streams:local:shared")
+        self.assertEqual(self.stream.get_cache_key(self.limited_content), self.stream.key)
+        self.assertEqual(self.stream.get_cache_key(self.self_content), self.stream.key)
+
+    def test_get_unfetched_count__counts_shared_and_user_precaches(self):
+        r = get_redis_connection()
+        r.delete(self.stream.key, "sh:streams:local:shared")
+        r.zadd("sh:streams:local:shared", {1: 1, 3: 3, 4: 4, 6: 6})
+        r.zadd(self.stream.key, {2: 2, 5: 5})
+        self.stream.first_id = 2
+        self.assertEqual(self.stream.get_unfetched_count(), 4)
+        self.stream.first_id = 3
+        self.stream.last_id = 6
+        self.assertEqual(self.stream.get_unfetched_count(), 2)
+
+    def test_get_unfetched_count__counts_content_in_both_precaches_once(self):
+        r = get_redis_connection()
+        r.delete(self.stream.key, "sh:streams:local:shared")
+        r.zadd("sh:streams:local:shared", {1: 1, 3: 3, 4: 4})
+        r.zadd(self.stream.key, {2: 2, 3: 3, 4: 4})
+        self.stream.first_id = 1
+        self.assertEqual(self.stream.get_unfetched_count(), 3)
+
+    def test_get_cached_content_ids__merges_shared_and_user_precaches(self):
+        r = get_redis_connection()
+        r.delete(
+            self.stream.key, BaseStream.get_throughs_key(self.stream.key),
+            "sh:streams:local:shared", "sh:streams:local:shared:throughs",
+        )
+        r.zadd("sh:streams:local:shared", {1: 1, 3: 3, 4: 4, 6: 6})
+        r.hset("sh:streams:local:shared:throughs", mapping={1: 1, 3: 30, 4: 4, 6: 6})
+        r.zadd(self.stream.key, {2: 2, 5: 5})
+        r.hset(BaseStream.get_throughs_key(self.stream.key), mapping={2: 2, 5: 50})
+        self.stream.paginate_by = 3
+        self.assertEqual(self.stream.get_cached_content_ids(), ([6, 5, 4], {6: 6, 5: 50, 4: 4}))
+        stream = LocalStream(user=self.other_user, last_id=4)
+        stream.paginate_by = 3
+        self.assertEqual(stream.get_cached_content_ids(), ([3, 2, 1], {3: 30, 2: 2, 1: 1}))
+        stream = LocalStream(user=self.other_user, first_id=1)
+        stream.paginate_by = 3
+        self.assertEqual(stream.get_cached_content_ids(), ([6, 5, 4], {6: 6, 5: 50, 4: 4}))
+        self.assertTrue(stream.unfetched_content)
+
     def test_only_local_content_returned(self):
         qs, _throughs = self.stream.get_content()
         self.assertEqual(
@@ -428,6 +1029,15 @@ class TestProfileAllStream(SocialhomeTestCase):
             self.stream.get_content_ids()
             mock_cached.assert_called_once_with()
 
+    def test_get_content_ids__merges_authored_and_shared_content(self):
+        share = PublicContentFactory(share_of=self.public_content, author=self.remote_profile)
+        with patch.object(self.stream, "get_cached_content_ids", side_effect=lambda: ([], {})):
+            ids, throughs = self.stream.get_content_ids()
+        self.assertEqual(ids, [self.remote_profile_content.id, self.public_content.id])
+        self.assertEqual(throughs, {
+            self.remote_profile_content.id: self.remote_profile_content.id, self.public_content.id: share.id,
+        })
+
     def test_get_queryset(self):
         qs = self.stream.get_queryset()
         self.assertEqual(set(qs), {self.remote_profile_content})
@@ -495,7 +1105,8 @@ class TestPublicStream(SocialhomeTestCase):
         )
 
     def test_key(self):
-        self.assertEqual(self.stream.key, "sh:streams:public:%s" % self.user.id)
+        self.assertEqual(self.stream.key, "sh:streams:public:shared")
+        self.assertEqual(PublicStream(user=AnonymousUser()).key, "sh:streams:public:shared")
 
     def test_only_public_content_returned(self):
         qs, _throughs = self.stream.get_content()
@@ -1,15 +1,45 @@
 from datetime import timedelta
+from unittest.mock import patch
 
+from asgiref.sync import async_to_sync
 from django.test.utils import override_settings
 from django.utils.timezone import now
 
-from socialhome.streams.tasks import groom_redis_precaches
+from socialhome.streams.tasks import (
+    groom_redis_precaches, load_user_activities, GROOM_CURSOR_KEY, compact_precache_throughs,
+    get_precache_memory_usage, prune_timelines)
+from socialhome.content.tests.factories import PublicContentFactory
+from socialhome.streams.consumers import get_live_groups, mark_present, PRESENCE_KEY_PREFIX
+from socialhome.streams.streams import add_profile_groups, get_profile_groups, PROFILE_GROUPS_KEY_PREFIX
+from socialhome.streams.models import TimelineEntry
 from socialhome.tests.utils import SocialhomeTestCase
 from socialhome.users.models import User
 from socialhome.users.tests.factories import UserFactory
 from socialhome.utils import get_redis_connection
 
 
+class TestCompactPrecacheThroughs(SocialhomeTestCase):
+    def setUp(self):
+        super().setUp()
+        self.r = get_redis_connection()
+        self.r.delete("sh:streams:spamandeggs:1", "sh:streams:spamandeggs:1:throughs")
+        self.r.zadd("sh:streams:spamandeggs:1", {str(x): x for x in range(10)})
+        self.r.hset("sh:streams:spamandeggs:1:throughs", mapping={str(x): str(x) for x in range(10)})
+        self.r.hset("sh:streams:spamandeggs:1:throughs", "5", "50")
+
+    def test_removes_throughs_same_as_content(self):
+        self.assertGreaterEqual(compact_precache_throughs(), 9)
+        self.assertEqual(self.r.hgetall("sh:streams:spamandeggs:1:throughs"), {b"5": b"50"})
+        self.assertEqual(self.r.zcard("sh:streams:spamandeggs:1"), 10)
+
+    def test_get_precache_memory_usage(self):
+        precaches, throughs = get_precache_memory_usage()
+        self.assertGreaterEqual(precaches, self.r.memory_usage("sh:streams:spamandeggs:1"))
+        self.assertGreaterEqual(throughs, self.r.memory_usage("sh:streams:spamandeggs:1:throughs"))
+        compact_precache_throughs()
+        self.assertLess(get_precache_memory_usage()[1], throughs)
+
+
 @override_settings(
     SOCIALHOME_STREAMS_PRECACHE_SIZE=4, SOCIALHOME_STREAMS_PRECACHE_INACTIVE_SIZE=2,
     SOCIALHOME_STREAMS_PRECACHE_INACTIVE_DAYS=10,
@@ -42,6 +72,19 @@ class TestGroomRedisPrecaches(SocialhomeTestCase):
         hitems = {key.decode("utf-8"): value.decode("utf-8") for key, value in hitems.items()}
         self.assertEqual(hitems, expected_h)
 
+    def test_grooming_should_not_touch_notification_keys(self):
+        groups = [f"streams_groom_test__{i}" for i in range(6)]
+        keys = [f"{PROFILE_GROUPS_KEY_PREFIX}{self.user.profile.id}", f"{PRESENCE_KEY_PREFIX}{groups[0]}"]
+        # Profile ids are reused between test runs, so there can be groups left over from other tests
+        self.r.delete(*keys)
+        self.addCleanup(self.r.delete, *keys)
+        for group in groups:
+            add_profile_groups(group, [self.user.profile.id])
+        async_to_sync(mark_present)(groups[0], "channel.1")
+        groom_redis_precaches()
+        self.assertEqual(set(get_profile_groups(self.user.profile.id)), set(groups))
+        self.assertEqual(get_live_groups(groups), {groups[0]})
+
     def test_grooming_should_keep_top_x__inactive_user(self):
         expected_z = {x: str(x ** x) for x in range(8, 10)}
         expected_h = {str(x ** x): str(x ** x + 1) for x in range(8, 10)}
@@ -74,6 +117,15 @@ class TestGroomRedisPrecaches(SocialhomeTestCase):
         self.assertFalse(self.r.exists("sh:streams:spamandeggs:736353:%s" % self.user.id))
         self.assertFalse(self.r.exists("sh:streams:spamandeggs:736353:%s:throughs" % self.user.id))
 
+    def test_grooming_should_trim_shared_keys_as_active(self):
+        self.r.delete("sh:streams:spamandeggs:shared", "sh:streams:spamandeggs:shared:throughs")
+        for x in range(10):
+            self.r.zadd("sh:streams:spamandeggs:shared", {str(x): x})
+            self.r.hset("sh:streams:spamandeggs:shared:throughs", str(x), x)
+        groom_redis_precaches()
+        self.assertEqual(self.r.zrange("sh:streams:spamandeggs:shared", 0, -1), [b"6", b"7", b"8", b"9"])
+        self.assertEqual(self.r.hlen("sh:streams:spamandeggs:shared:throughs"), 4)
+
     def test_user_fetched_from_db_only_once(self):
         User.objects.filter(id=self.user.id).update(
             last_login=now() - timedelta(days=9),
@@ -85,3 +137,63 @@ class TestGroomRedisPrecaches(SocialhomeTestCase):
         )
         with self.assertNumQueries(1):
             groom_redis_precaches()
+
+    @override_settings(SOCIALHOME_STREAMS_PRECACHE_GROOM_TIME_LIMIT=-1)
+    @patch("socialhome.streams.tasks.GROOM_SCAN_COUNT", 1)
+    def test_grooming_continues_from_saved_cursor(self):
+        self.r.delete(GROOM_CURSOR_KEY)
+        keys = ["sh:streams:spamandeggs:%s:shared" % x for x in range(20)]
+        for key in keys:
+            self.r.zadd(key, {"1": 1})
+        self.addCleanup(self.r.delete, *keys)
+        with patch.object(self.r, "scan", wraps=self.r.scan) as mock_scan, \
+                patch("socialhome.streams.tasks.get_redis_connection", return_value=self.r):
+            groom_redis_precaches()
+            self.assertEqual(mock_scan.call_count, 1)
+            cursor = int(self.r.get(GROOM_CURSOR_KEY))
+            self.assertTrue(cursor)
+            groom_redis_precaches()
+            self.assertEqual(mock_scan.call_args[0][0], cursor)
+        with override_settings(SOCIALHOME_STREAMS_PRECACHE_GROOM_TIME_LIMIT=60):
+            groom_redis_precaches()
+        self.assertFalse(self.r.exists(GROOM_CURSOR_KEY))
+
+    def test_load_user_activities(self):
+        inactive_user = UserFactory()
+        User.objects.filter(id=self.user.id).update(last_login=now() - timedelta(days=9))
+        User.objects.filter(id=inactive_user.id).update(last_login=now() - timedelta(days=11))
+        user_activities = {}
+        keys = [
+            "sh:streams:followed:%s" % self.user.id, "sh:streams:local:%s" % inactive_user.id,
+            "sh:streams:local:999999", "sh:streams:local:shared", "sh:streams:public:anonymous",
+        ]
+        with self.assertNumQueries(1):
+            load_user_activities(user_activities, keys)
+        self.assertEqual(user_activities, {self.user.id: True, inactive_user.id: False, 999999: None})
+        with self.assertNumQueries(0):
+            load_user_activities(user_activities, keys)
+
+
+class TestPruneTimelines(SocialhomeTestCase):
+    @override_settings(SOCIALHOME_STREAMS_PRECACHE_SIZE=2)
+    def test_deletes_entries_outside_precache_size(self):
+        contents = [PublicContentFactory() for _ in range(3)]
+        for score, content in enumerate(contents):
+            TimelineEntry.objects.create(key="sh:streams:spam:1", content=content, through=content.id, score=score)
+        TimelineEntry.objects.create(
+            key="sh:streams:spam:2", content=contents[0], through=contents[0].id, score=0,
+        )
+        TimelineEntry.objects.create(key="sh:streams:spam:3", content=contents[0], through=contents[0].id, score=0)
+        TimelineEntry.objects.create(key="sh:streams:spam:3", content=contents[1], through=contents[1].id, score=1)
+        TimelineEntry.objects.create(key="sh:streams:spam:3", content=contents[2], through=contents[2].id, score=2)
+        self.assertEqual(prune_timelines(["sh:streams:spam:1", "sh:streams:spam:2"]), 1)
+        self.assertEqual(
+            set(TimelineEntry.objects.values_list("key", "content_id")),
+            {
+                ("sh:streams:spam:1", contents[1].id), ("sh:streams:spam:1", contents[2].id),
+                ("sh:streams:spam:2", contents[0].id),
+                # Not pruned since not given
+                ("sh:streams:spam:3", contents[0].id), ("sh:streams:spam:3", contents[1].id),
+                ("sh:streams:spam:3", contents[2].id),
+            },
+        )
@@ -1,16 +1,22 @@
 from unittest.mock import patch, Mock
 
 from django.contrib.auth.models import AnonymousUser
+from django.contrib.sites.models import Site
+from django.db import connection
 from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from socialhome.content.models import Tag
 from socialhome.content.tests.factories import (
     PublicContentFactory, SiteContentFactory, SelfContentFactory, LimitedContentFactory)
+from socialhome.streams.streams import (
+    get_profile_groups, PublicStream, BaseStream, PROFILE_GROUPS_KEY_PREFIX)
 from socialhome.streams.tests.utils import MockStream
 from socialhome.streams.viewsets import StreamsAPIBaseView
 from socialhome.tests.utils import SocialhomeAPITestCase
-from socialhome.users.tests.factories import UserFactory
+from socialhome.users.tests.factories import UserFactory, PublicProfileFactory
+from socialhome.utils import get_redis_connection
 
 
 class TestFollowedStreamAPIView(SocialhomeAPITestCase):
@@ -46,6 +52,17 @@ class TestFollowedStreamAPIView(SocialhomeAPITestCase):
         view.get(request)
         mock_serializer.assert_called_once_with([], many=True, context={"throughs": {}, "request": request})
 
+    def test_unfetched_count(self):
+        request = RequestFactory().get("/")
+        request.version = "2.0"
+        view = StreamsAPIBaseView()
+        view.unfetched_count = True
+        view.stream = Mock(ordering="-created", get_unfetched_count=Mock(return_value=3))
+        view.set_stream = Mock()
+        response = view.get(request)
+        self.assertEqual(response.data, {"count": 3})
+        self.assertFalse(view.stream.get_content_ids.called)
+
     @patch("socialhome.streams.viewsets.FollowedStream")
     def test_users_correct_stream_class(self, mock_stream):
         mock_stream.return_value = MockStream()
@@ -133,6 +150,17 @@ class TestProfileAllStreamAPIView(SocialhomeAPITestCase):
         SelfContentFactory(author=cls.profile)
         LimitedContentFactory(author=cls.profile)
 
+    def test_profile_is_recorded_for_empty_page(self):
+        profile = PublicProfileFactory()
+        # Profile ids are reused between test runs, so there can be groups left over from other tests
+        r = get_redis_connection()
+        r.delete(f"{PROFILE_GROUPS_KEY_PREFIX}{profile.id}")
+        self.addCleanup(r.delete, f"{PROFILE_GROUPS_KEY_PREFIX}{profile.id}")
+        with self.login(self.user):
+            self.get("api-streams:profile-all", uuid=profile.uuid)
+        self.assertEqual(self.last_response.data, [])
+        self.assertEqual(get_profile_groups(profile.id), [f"streams_profile_all__{profile.id}__{self.user.id}"])
+
     def test_profile_content_returned(self):
         self.get("api-streams:profile-all", uuid=self.content.author.uuid)
         self.assertEqual(len(self.last_response.data), 2)
@@ -192,6 +220,41 @@ class TestPublicStreamAPIView(SocialhomeAPITestCase):
         self.assertEqual(len(self.last_response.data), 1)
         self.assertEqual(self.last_response.data[0]["id"], self.content.id)
 
+    def test_displayed_profiles_are_recorded(self):
+        user = UserFactory()
+        with self.login(user):
+            self.get("api-streams:public")
+        self.assertIn(f"streams_public__{user.id}", get_profile_groups(self.content.author_id))
+        self.assertIn(f"streams_public__{user.id}", get_profile_groups(self.content2.author_id))
+
+    # Profile updates are queued per author instead of per content, displayed profiles are recorded in Redis
+    @patch("socialhome.streams.viewsets.add_profile_groups")
+    @patch("socialhome.streams.streams.update_profiles")
+    def test_query_count_does_not_depend_on_page_size(self, _mock_update, _mock_add):
+        def create_content(amount):
+            for _i in range(amount):
+                content = PublicContentFactory(author=user.profile)
+                content.mentions.add(self.content.author)
+                PublicContentFactory(share_of=content)
+                PublicContentFactory(parent=PublicContentFactory())
+
+        user = UserFactory()
+        # The content of the user is also added to the precache
+        r = get_redis_connection()
+        keys = [PublicStream(user=user).key, BaseStream.get_throughs_key(PublicStream(user=user).key)]
+        r.delete(*keys)
+        self.addCleanup(r.delete, *keys)
+        create_content(1)
+        # Cached after the first request
+        Site.objects.get_current()
+        with self.login(user), CaptureQueriesContext(connection) as context:
+            self.get("api-streams:public")
+        self.assertEqual(len(self.last_response.data), 4)
+        create_content(13)
+        with self.login(user), self.assertNumQueries(len(context.captured_queries)):
+            self.get("api-streams:public")
+        self.assertEqual(len(self.last_response.data), 30)
+
     @patch("socialhome.streams.viewsets.PublicStream")
     def test_users_correct_stream_class(self, mock_stream):
         mock_stream.return_value = MockStream()
@@ -10,7 +10,7 @@ from socialhome.content.serializers import ContentSerializer
 from socialhome.streams.enums import StreamType
 from socialhome.streams.streams import (
     PublicStream, FollowedStream, TagStream, ProfileAllStream,
-    ProfilePinnedStream, LimitedStream, LocalStream, TagsStream)
+    ProfilePinnedStream, LimitedStream, LocalStream, TagsStream, ProfileStreamBase, add_profile_groups)
 from socialhome.users.models import Profile
 
 
@@ -36,6 +36,7 @@ class StreamsAPIBaseView(APIView):
             qs, throughs = self.get_content()
             serializer = ContentSerializer(qs, many=True, context={"throughs": throughs, "request": request})
             data = serializer.data
+            self.add_profile_groups(qs, serializer.context["throughs_authors"])
         # Hack used to send the ws channel name and relevant context data to the SPA UI
         # This is used in lieu of json context
         if request.version == '2.0':
@@ -43,6 +44,14 @@ class StreamsAPIBaseView(APIView):
                     "data": data}
         return Response(data)
 
+    def add_profile_groups(self, qs, throughs_authors):
+        """Record the profiles displayed in the page, so that profile changes are notified to the stream."""
+        profile_ids = {content.author_id for content in qs} | {author.id for author in throughs_authors.values()}
+        if isinstance(self.stream, ProfileStreamBase):
+            profile_ids.add(self.stream.profile.id)
+        if profile_ids:
+            add_profile_groups(self.stream.notify_key, profile_ids)
+
     def get_content(self):
         return self.stream.get_content()
 
@@ -51,11 +60,7 @@ class StreamsAPIBaseView(APIView):
         # so the stream is always refetched in this case
         if self.stream.ordering == "order": return None
 
-        paginate_by = self.stream.paginate_by
-        self.stream.paginate_by = 500
-        ids, _ = self.stream.get_content_ids()
-        self.stream.paginate_by = paginate_by
-        return len(ids)
+        return self.stream.get_unfetched_count()
 
     def set_stream(self):
         raise NotImplementedError
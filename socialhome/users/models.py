@@ -2,7 +2,7 @@ import logging
 import os
 import re
 import time
-from typing import Dict, Optional
+from typing import Dict, Iterable, Optional, Set
 from uuid import uuid4
 
 # noinspection PyPackageRequirements
@@ -81,7 +81,11 @@ class User(AbstractUser):
 
     @property
     def activity_key(self) -> str:
-        return f"sh:users:activity:{self.id}"
+        return self.get_activity_key(self.id)
+
+    @staticmethod
+    def get_activity_key(user_id: int) -> str:
+        return f"sh:users:activity:{user_id}"
 
     @property
     def url(self):
@@ -137,13 +141,14 @@ class User(AbstractUser):
         )
         picture_warmer.warm()
 
-    def mark_recently_active(self) -> None:
+    def mark_recently_active(self, pipe=None) -> None:
         """
         Flag the user as currently active.
+
+        :param pipe: Optional Redis pipeline to add the command to
         """
-        r = get_redis_connection()
-        r.set(self.activity_key, int(time.time()))
-        r.expire(self.activity_key, settings.SOCIALHOME_USER_ACTIVITY_SECONDS)
+        r = pipe or get_redis_connection()
+        r.set(self.activity_key, int(time.time()), ex=settings.SOCIALHOME_USER_ACTIVITY_SECONDS)
 
     @cached_property
     def recently_active(self) -> bool:
@@ -153,6 +158,22 @@ class User(AbstractUser):
         r = get_redis_connection()
         return r.exists(self.activity_key)
 
+    @staticmethod
+    def get_recently_active_ids(user_ids: Iterable[int]) -> Set[int]:
+        """
+        Return the ID's of the given users that are marked as "active recently".
+
+        Checks all the users in one pipelined Redis call.
+        """
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+        r = get_redis_connection()
+        pipe = r.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.exists(User.get_activity_key(user_id))
+        return {user_id for user_id, exists in zip(user_ids, pipe.execute()) if exists}
+
     def save(self, *args, **kwargs):
         super().save(*args, **kwargs)
 
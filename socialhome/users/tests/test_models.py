@@ -6,9 +6,10 @@ from django.test import override_settings
 
 from socialhome.enums import Visibility
 from socialhome.tests.utils import SocialhomeTestCase
-from socialhome.users.models import Profile
+from socialhome.users.models import Profile, User
 from socialhome.users.tests.factories import ProfileFactory, UserFactory, BaseProfileFactory
 from socialhome.users.utils import get_pony_urls
+from socialhome.utils import get_redis_connection
 
 
 class TestUser(SocialhomeTestCase):
@@ -76,8 +77,14 @@ class TestUser(SocialhomeTestCase):
         mock_r = Mock()
         mock_conn.return_value = mock_r
         self.user.mark_recently_active()
-        mock_r.set.assert_called_once_with(self.user.activity_key, mock.ANY)
-        mock_r.expire.assert_called_once_with(self.user.activity_key, settings.SOCIALHOME_USER_ACTIVITY_SECONDS)
+        mock_r.set.assert_called_once_with(
+            self.user.activity_key, mock.ANY, ex=settings.SOCIALHOME_USER_ACTIVITY_SECONDS,
+        )
+
+    def test_mark_recently_active__pipeline(self):
+        pipe = Mock()
+        self.user.mark_recently_active(pipe)
+        pipe.set.assert_called_once_with(self.user.activity_key, mock.ANY, ex=settings.SOCIALHOME_USER_ACTIVITY_SECONDS)
 
     @patch("socialhome.users.models.get_redis_connection", autospec=True)
     def test_recently_active(self, mock_conn):
@@ -86,6 +93,18 @@ class TestUser(SocialhomeTestCase):
         self.user.recently_active()
         mock_r.exists.assert_called_once_with(self.user.activity_key)
 
+    def test_get_recently_active_ids(self):
+        user2 = UserFactory()
+        user3 = UserFactory()
+        r = get_redis_connection()
+        keys = [User.get_activity_key(user.id) for user in (self.user, user2, user3)]
+        r.delete(*keys)
+        self.addCleanup(r.delete, *keys)
+        self.user.mark_recently_active()
+        user3.mark_recently_active()
+        self.assertEqual(User.get_recently_active_ids([self.user.id, user2.id, user3.id]), {self.user.id, user3.id})
+        self.assertEqual(User.get_recently_active_ids([]), set())
+
 
 class TestProfile(SocialhomeTestCase):
     @classmethod
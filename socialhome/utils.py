@@ -1,13 +1,18 @@
+import asyncio
 import datetime
+import weakref
 
 import pytz
 import redis
+import redis.asyncio
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
 from django.utils.timezone import make_aware
 
 redis_connection = None
+# Async Redis connections are bound to the event loop they are used in
+async_redis_connections = weakref.WeakKeyDictionary()
 
 
 def get_full_url(path):
@@ -30,6 +35,16 @@ def get_redis_connection():
     return redis_connection
 
 
+def get_async_redis_connection():
+    """Get an asyncio Redis connection for the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in async_redis_connections:
+        async_redis_connections[loop] = redis.asyncio.StrictRedis(
+            host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB, password=settings.REDIS_PASSWORD,
+        )
+    return async_redis_connections[loop]
+
+
 def is_dst(zonename):
     """Check if current time in a time zone is in dst.
 